@@ -0,0 +1,65 @@
+"""Measures the compression ratio and the encode / decode speed of the lossless codec on a
+capture of raw counts: a .npy or .csv file of shape (n_samples, n_channels) given with --capture,
+or --seconds of data recorded from a board (the simulated Cyton by default, whose clean sine
+waves compress far better than real EEG)."""
+import argparse
+import time
+
+import numpy as np
+
+from pyOpenBCI import OpenBCICyton
+from pyOpenBCI.utils.codec import decode_block, encode_block
+
+
+def record(port, seconds):
+    board = OpenBCICyton(port=port)
+    samples = []
+
+    def collect(sample):
+        samples.append(sample.channels_data)
+        if len(samples) >= seconds * 250:
+            board.stop_stream()
+
+    board.start_stream(collect)
+    board.disconnect()
+    return np.array(samples)
+
+
+def load(path):
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--capture', help='.npy or .csv file of counts')
+parser.add_argument('--port', default='sim://')
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--block-size', type=int, default=250)
+parser.add_argument('--runs', type=int, default=5)
+args = parser.parse_args()
+
+data = load(args.capture) if args.capture else record(args.port, args.seconds)
+data = np.round(data).astype(np.int32)
+blocks = [data[i:i + args.block_size] for i in range(0, len(data), args.block_size)]
+
+encode_time = decode_time = 0.
+for _ in range(args.runs):
+    start = time.time()
+    payloads = [encode_block(block) for block in blocks]
+    encode_time += time.time() - start
+    start = time.time()
+    decoded = [decode_block(payload) for payload in payloads]
+    decode_time += time.time() - start
+assert all(np.array_equal(block, block_decoded) for block, block_decoded in zip(blocks, decoded))
+
+raw_mb = data.size * 4 / 1e6 * args.runs
+encoded = sum(len(payload) for payload in payloads)
+print("samples:         %d x %d channels, blocks of %d" % (data.shape[0], data.shape[1],
+                                                          args.block_size))
+print("int32 size:      %d bytes" % (data.size * 4))
+print("encoded size:    %d bytes" % encoded)
+print("ratio:           %.2f x int32, %.2f x float64" % (data.size * 4. / encoded,
+                                                        data.size * 8. / encoded))
+print("encode:          %.1f MB/s of int32" % (raw_mb / encode_time))
+print("decode:          %.1f MB/s of int32" % (raw_mb / decode_time))
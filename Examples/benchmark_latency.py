@@ -0,0 +1,136 @@
+"""Measures the end-to-end latency, from a sample being read by the driver to a consumer being
+done with it, on a loopback: the simulated Cyton (--source cyton), the simulated WiFi Shield
+streaming over a local TCP connection (--source wifi), or a capture of counts replayed through
+the simulated Cyton (--source replay --capture file.npy). Two consumers get every block:
+'feedback' acts on it at once, 'display' takes --work milliseconds. They run in the acquisition
+loop (--threading direct), on their own threads (dispatcher) or in an asyncio event loop
+(asyncio). Compare configurations with e.g.:
+    python Examples/benchmark_latency.py --block-size 10
+    python Examples/benchmark_latency.py --block-size 10 --threading dispatcher
+    python Examples/benchmark_latency.py --source wifi --latency 2000
+"""
+import argparse
+import asyncore
+import threading
+import time
+
+import numpy as np
+
+from pyOpenBCI import Dispatcher, LatencyHarness, OpenBCICyton, SampleBlocker
+from pyOpenBCI.utils.aio import BlockStream
+from pyOpenBCI.utils.simulator import WiFiShieldSimulator
+from pyOpenBCI.wifi import WiFiShieldServer
+
+
+def load(path):
+    if path.endswith('.npy'):
+        return np.load(path)
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+
+def cyton_source(args):
+    board = OpenBCICyton(port=args.port, daisy=args.daisy)
+    if args.source == 'replay':
+        board.ser.data = np.round(load(args.capture)).astype(np.int64)
+    return board.start_stream, board.stop_stream, 2 if args.daisy else 1
+
+
+def wifi_source(args):
+    # the gains are set by OpenBCIWiFi when it connects to a real shield
+    server = WiFiShieldServer('127.0.0.1', 0, gains=[24] * (16 if args.daisy else 8),
+                              daisy=args.daisy)
+    shield = WiFiShieldSimulator(server.socket.getsockname(), sample_rate=args.sample_rate,
+                                 latency=args.latency, daisy=args.daisy)
+    stopped = threading.Event()
+
+    def run(callback):
+        server.set_callback(callback)
+        shield.start()
+        while not stopped.is_set():
+            asyncore.loop(timeout=0.05, count=1)
+        shield.stop()
+        server.close()
+
+    return run, stopped.set, None
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--source', choices=['cyton', 'wifi', 'replay'], default='cyton')
+parser.add_argument('--port', default='sim://', help='serial port of a real Cyton to measure it')
+parser.add_argument('--capture', help='.npy or .csv file of counts to replay')
+parser.add_argument('--daisy', action='store_true')
+parser.add_argument('--sample-rate', type=int, default=1000, help='of the WiFi Shield')
+parser.add_argument('--latency', type=int, default=10000,
+                    help='micro seconds between two writes of the WiFi Shield')
+parser.add_argument('--block-size', type=int, default=25)
+parser.add_argument('--threading', choices=['direct', 'dispatcher', 'asyncio'],
+                    default='direct')
+parser.add_argument('--work', type=float, default=5., help='milliseconds taken by display')
+parser.add_argument('--seconds', type=float, default=10.)
+parser.add_argument('--warmup', type=float, default=1.)
+args = parser.parse_args()
+if args.source == 'replay' and not args.capture:
+    parser.error('--source replay needs --capture')
+
+run, stop, id_step = wifi_source(args) if args.source == 'wifi' else cyton_source(args)
+harness = LatencyHarness()
+
+
+def feedback(block):
+    pass
+
+
+def stop_at(end):
+    """Stage stopping the board from the acquisition loop once `end` is passed."""
+    stopped = []
+
+    def check(block):
+        if not stopped and time.time() >= end:
+            stopped.append(True)
+            stop()
+        return block
+    return check
+
+
+def display(block):
+    time.sleep(args.work / 1e3)
+
+
+stages = [harness.monitor(args.source)]
+consumers = [harness.wrap(args.source, 'feedback', feedback),
+             harness.wrap(args.source, 'display', display)]
+threading.Timer(args.warmup, harness.clear).start()
+
+if args.threading == 'asyncio':
+    import asyncio
+
+    async def consume(stream):
+        end = time.time() + args.warmup + args.seconds
+        async with stream:
+            async for block in stream:
+                for consumer in consumers:
+                    consumer(block)
+                if time.time() >= end:
+                    break
+
+    stream = BlockStream(run, stop, block_size=args.block_size, stages=stages, id_step=id_step)
+    asyncio.get_event_loop().run_until_complete(consume(stream))
+else:
+    dispatcher = None
+    if args.threading == 'dispatcher':
+        dispatcher = Dispatcher()
+        for name, consumer in zip(['feedback', 'display'], consumers):
+            dispatcher.add(consumer, policy='drop_oldest', max_queue=16, name=name)
+        consumers = dispatcher
+    stages.append(stop_at(time.time() + args.warmup + args.seconds))
+    run(SampleBlocker(consumers, block_size=args.block_size, stages=stages, id_step=id_step))
+    if dispatcher is not None:
+        dispatcher.close()
+        for name, stats in dispatcher.stats().items():
+            if stats['dropped']:
+                print("%s dropped %d blocks" % (name, stats['dropped']))
+
+print("source: %s, block size: %d, threading: %s%s" % (
+    args.source, args.block_size, args.threading,
+    ', latency: %d us' % args.latency if args.source == 'wifi' else ''))
+print(harness.report())
@@ -0,0 +1,68 @@
+"""Measures the time from creating an OpenBCICyton to its first sample, and the time a
+reconnect asked while streaming takes to resume the stream, against the simulated Cyton board
+(or a real one with --port)."""
+import argparse
+import time
+from threading import Thread
+
+from pyOpenBCI import OpenBCICyton
+
+
+class FirstSample(Exception):
+    pass
+
+
+def stop_at_first_sample(sample):
+    raise FirstSample()
+
+
+def time_to_first_sample(board):
+    start = time.time()
+    try:
+        board.start_stream(stop_at_first_sample)
+    except FirstSample:
+        pass
+    return time.time() - start
+
+
+def time_to_resume(board):
+    """Time from a reconnection asked by another thread while streaming, as the connection
+    watchdog does, to the first sample after it."""
+    reconnects = board.metrics.reconnects
+    asked = []
+
+    def on_sample(sample):
+        if not asked:
+            asked.append(time.time())
+            Thread(target=board.reconnect).start()
+        elif board.metrics.reconnects > reconnects:
+            raise FirstSample()
+
+    try:
+        board.start_stream(on_sample)
+    except FirstSample:
+        pass
+    return time.time() - asked[0]
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--port', default='sim://')
+parser.add_argument('--runs', type=int, default=5)
+args = parser.parse_args()
+
+connect_times, first_sample_times, reconnect_times = [], [], []
+for _ in range(args.runs):
+    start = time.time()
+    board = OpenBCICyton(port=args.port)
+    connect_times.append(time.time() - start)
+    first_sample_times.append(connect_times[-1] + time_to_first_sample(board))
+
+    reconnect_times.append(time_to_resume(board))
+    board.stop_stream()
+    board.disconnect()
+
+print("connect:         %.3f s (min %.3f s)" % (sum(connect_times) / args.runs, min(connect_times)))
+print("first sample:    %.3f s (min %.3f s)" % (sum(first_sample_times) / args.runs,
+                                               min(first_sample_times)))
+print("reconnect:       %.3f s (min %.3f s)" % (sum(reconnect_times) / args.runs,
+                                               min(reconnect_times)))
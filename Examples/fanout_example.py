@@ -0,0 +1,28 @@
+"""Shares the stream of a board with other processes. Run the server once, then as many
+subscribers as needed:
+    python Examples/fanout_example.py serve --port sim://
+    python Examples/fanout_example.py subscribe
+"""
+import argparse
+
+from pyOpenBCI import BlockClient, BlockServer, OpenBCICyton, SampleBlocker
+
+parser = argparse.ArgumentParser()
+parser.add_argument('role', choices=['serve', 'subscribe'])
+parser.add_argument('--port', default=None, help='serial port of the Cyton, sim:// to simulate')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--tcp-port', type=int, default=5560)
+args = parser.parse_args()
+address = (args.host, args.tcp_port)
+
+if args.role == 'serve':
+    board = OpenBCICyton(port=args.port)
+    server = BlockServer(address, board=board)
+    print("Serving on %s:%d" % address)
+    board.start_stream(SampleBlocker([], block_size=25, stages=[server], id_step=1))
+else:
+    client = BlockClient(address)
+    print("Subscribed to %s" % client.description.get('name'))
+    for block in client:
+        print("%d samples%s, first: %s" % (len(block), ' after a gap' if block.gap else '',
+                                          block.data[0]))
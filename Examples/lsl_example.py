@@ -1,26 +1,11 @@
-from pyOpenBCI import OpenBCICyton
-from pylsl import StreamInfo, StreamOutlet
-import numpy as np
+from pyOpenBCI import OpenBCICyton, LSLSink
 
-SCALE_FACTOR_EEG = (4500000)/24/(2**23-1) #uV/count
-SCALE_FACTOR_AUX = 0.002 / (2**4)
+# the channel count, sample rate and units of the streams come from the board
+board = OpenBCICyton(daisy=False)
+sink = LSLSink(board)
 
+print("Creating LSL streams %s and %s\n" % (sink.description['name'],
+                                            sink.aux_description['name']))
 
-print("Creating LSL stream for EEG. \nName: OpenBCIEEG\nID: OpenBCItestEEG\n")
-
-info_eeg = StreamInfo('OpenBCIEEG', 'EEG', 8, 250, 'float32', 'OpenBCItestEEG')
-
-print("Creating LSL stream for AUX. \nName: OpenBCIAUX\nID: OpenBCItestEEG\n")
-
-info_aux = StreamInfo('OpenBCIAUX', 'AUX', 3, 250, 'float32', 'OpenBCItestAUX')
-
-outlet_eeg = StreamOutlet(info_eeg)
-outlet_aux = StreamOutlet(info_aux)
-
-def lsl_streamers(sample):
-    outlet_eeg.push_sample(np.array(sample.channels_data)*SCALE_FACTOR_EEG)
-    outlet_aux.push_sample(np.array(sample.aux_data)*SCALE_FACTOR_AUX)
-
-board = OpenBCICyton()
-
-board.start_stream(lsl_streamers)
+# the data is pushed in uVolts and G, a chunk per block of samples
+board.start_stream(sink.blocker())
@@ -1,19 +1,40 @@
 import serial
 from serial import Serial
 
-from threading import Timer
+from threading import Event, Thread, Timer, current_thread
 import time
 import logging
+import re
 import sys
 import struct
 import numpy as np
 import atexit
 import datetime
 import glob
+import timeit
+
+from .utils.aio import BlockStream
+from .utils.cache import cache_delete, cache_get, cache_set
+from .utils.config import BoardConfig, batch_commands
+from .utils.impedance import ImpedanceEstimator, lead_off_commands
+from .utils.metrics import StreamStats
+from .utils.profiling import clock_ns
+from .utils.simulator import SIMULATED_PORT, CytonSimulator
+from .utils.stream import SampleBlocker
+
 # Define variables
 SAMPLE_RATE = 250.0  # Hz
 START_BYTE = 0xA0  # start of data packet
 END_BYTE = 0xC0  # end of data packet
+# Commands are forwarded by the dongle to the board in radio packets of 32 bytes
+COMMAND_BATCH_LENGTH = 31
+COMMAND_BATCH_DELAY = 0.01  # seconds between two batches of commands
+RESET_COMMAND_DELAY = 0.5  # seconds the board takes to restart after a 'v'
+# seconds between two soft reset attempts when the board does not answer
+RESET_RETRY_INTERVAL = 2.0
+# USB ids of the FTDI chip of the Cyton Dongle
+FTDI_VID = 0x0403
+FTDI_PID = 0x6015
 
 
 
@@ -33,14 +54,21 @@ class OpenBCICyton(object):
 
         max_packets_skipped: An integer specifying how many packets can be dropped before attempting to reconnect.
 
+        connect_timeout: A float specifying the maximum seconds to wait for the board to answer a soft reset. Use port='sim://' to connect to a simulated board.
+
+        scaled: A boolean, True to output the channels data in uVolts and the accelerometer data in G (as NumPy arrays), using the gains set on the board. False outputs the raw counts.
+
     """
-    def __init__(self, port=None, daisy=False, baud=115200, timeout=None, max_packets_skipped=1):
+    def __init__(self, port=None, daisy=False, baud=115200, timeout=None, max_packets_skipped=1,
+                 connect_timeout=5.0, scaled=False):
         self._logger = logging.getLogger(self.__class__.__name__)
 
         self.baud = baud
         self.timeout = timeout
         self.daisy = daisy
         self.max_packets_skipped = max_packets_skipped
+        self.connect_timeout = connect_timeout
+        self.scaled = scaled
         self.streaming = False
         if port:
             self.port = port
@@ -51,26 +79,34 @@ class OpenBCICyton(object):
             self.board_type = "CytonDaisy"
         else:
             self.board_type = "Cyton"
+        # what has been set on the board, see apply_config
+        self.config = BoardConfig('daisy' if self.daisy else 'cyton')
+        self._update_scale()
 
         # Connecting to the board
-        self.ser = Serial(port=self.port, baudrate=self.baud, timeout=self.timeout)
+        if self.port == SIMULATED_PORT:
+            self.ser = CytonSimulator(daisy=self.daisy, timeout=self.timeout)
+        else:
+            self.ser = Serial(port=self.port, baudrate=self.baud, timeout=self.timeout)
 
         self._logger.info("Serial established.")
 
-        # Perform a soft reset of the board
-        time.sleep(2)
-        self.ser.write(b'v')
-
-
-        # wait for device to be ready
-        time.sleep(1)
-
+        # Perform a soft reset of the board, ready as soon as it answers
         if port != "loop://":
-            self.print_incoming_text()
+            self.soft_reset()
+        else:
+            self.ser.write(b'v')
 
 
         self.packets_dropped = 0
         self.read_state = 0
+        # cumulative counters of the stream, see stats
+        self.metrics = StreamStats()
+        # Profiler of the stages of the acquisition, see set_profiler
+        self.profiler = None
+        # thread running start_stream, reconnections asked from other threads are done by it
+        self._stream_thread = None
+        self._reconnect_requested = Event()
         self.last_odd_sample = OpenBCISample(-1, [], [], self.start_time, self.board_type)  # used for daisy
 
 
@@ -83,40 +119,107 @@ class OpenBCICyton(object):
             self._logger.info("Closing serial.")
             self.ser.close()
 
-    def find_port(self):
-        """Finds the port to which the Cyton Dongle is connected to."""
+    def find_port(self, deadline=5.0):
+        """Finds the port to which the Cyton Dongle is connected to.
+
+        The last port a board was found on is tried first. Otherwise every candidate port is
+        probed at the same time, and the first one answering with the OpenBCI banner within
+        `deadline` seconds is returned.
+        """
+        cached_port = cache_get('cyton', 'port')
+        if cached_port:
+            if self._probe_ports([cached_port], deadline) == cached_port:
+                return cached_port
+            cache_delete('cyton', 'port')
+
+        ports = [port for port in self._candidate_ports() if port != cached_port]
+        openbci_port = self._probe_ports(ports, deadline)
+        if not openbci_port:
+            raise OSError('Cannot find OpenBCI port.')
+        cache_set('cyton', 'port', openbci_port)
+        return openbci_port
+
+    def _candidate_ports(self):
+        """Lists the serial ports that can be a Cyton Dongle. Ports of the dongle FTDI chip are
+        picked by USB VID/PID without opening them, ports of other USB devices are skipped."""
+        try:
+            from serial.tools import list_ports
+            port_infos = list(list_ports.comports())
+        except ImportError:
+            port_infos = []
+
+        dongle_ports = []
+        unknown_ports = []
+        other_ports = set()
+        for info in port_infos:
+            if isinstance(info, tuple):
+                # older pyserial: (device, description, hwid)
+                device, hwid, vid, pid = info[0], info[2], None, None
+            else:
+                device, hwid = info.device, info.hwid
+                vid, pid = getattr(info, 'vid', None), getattr(info, 'pid', None)
+            if vid is None:
+                match = re.search(r'VID:PID=([0-9A-Fa-f]{4}):([0-9A-Fa-f]{4})', hwid or '')
+                if match:
+                    vid, pid = int(match.group(1), 16), int(match.group(2), 16)
+            if (vid, pid) == (FTDI_VID, FTDI_PID):
+                dongle_ports.append(device)
+            elif vid is None:
+                unknown_ports.append(device)
+            else:
+                other_ports.add(device)
+        if dongle_ports:
+            return dongle_ports
+
         # Find serial port names per OS
         if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
+            ports = [info[0] if isinstance(info, tuple) else info.device for info in port_infos] \
+                if port_infos else ['COM%s' % (i + 1) for i in range(256)]
         elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
             ports = glob.glob('/dev/ttyUSB*')
         elif sys.platform.startswith('darwin'):
             ports = glob.glob('/dev/tty.usbserial*')
         else:
             raise EnvironmentError('Error finding ports on your operating system')
-
-        openbci_port = ''
-        for port in ports:
-            try:
-                s = Serial(port=port, baudrate=self.baud, timeout=self.timeout)
-                s.write(b'v')
-                line = ''
-                time.sleep(2)
-                if s.inWaiting():
-                    line = ''
-                    c = ''
-                    while '$$$' not in line:
-                        c = s.read().decode('utf-8', errors='replace')
-                        line += c
-                    if 'OpenBCI' in line:
-                        openbci_port = port
-                s.close()
-            except (OSError, serial.SerialException):
-                pass
-        if openbci_port == '':
-            raise OSError('Cannot find OpenBCI port.')
-        else:
-            return openbci_port
+        return unknown_ports + [port for port in ports
+                                if port not in unknown_ports and port not in other_ports]
+
+    def _probe_ports(self, ports, deadline):
+        """Probes all the ports concurrently, returns the first one a board answered on."""
+        found = Event()
+        result = []
+        end = time.time() + deadline
+        probes = [Thread(target=self._probe_port, args=(port, end, found, result))
+                  for port in ports]
+        for probe in probes:
+            probe.daemon = True
+            probe.start()
+        # a probe is done when its port failed or the deadline passed
+        for probe in probes:
+            probe.join(max(end - time.time(), 0))
+            if found.is_set():
+                break
+        return result[0] if result else None
+
+    def _probe_port(self, port, end, found, result):
+        """Writes 'v' to `port` and reads the answer in bulk until '$$$', the deadline, or
+        another probe finding the board."""
+        try:
+            s = Serial(port=port, baudrate=self.baud, timeout=0.05)
+        except (OSError, serial.SerialException, ValueError):
+            return
+        try:
+            s.write(b'v')
+            line = ''
+            while '$$$' not in line and not found.is_set() and time.time() < end:
+                line += s.read(max(s.inWaiting(), 1)).decode('utf-8', errors='replace')
+            if 'OpenBCI' in line and not found.is_set():
+                result.append(port)
+                found.set()
+        except (OSError, serial.SerialException):
+            pass
+        finally:
+            s.close()
 
     def stop_stream(self):
         """Stops Stream from the Cyton board."""
@@ -124,21 +227,29 @@ class OpenBCICyton(object):
         self.ser.write(b's')
 
     def reconnect(self):
-        """Attempts to reconnect to the Cyton board if the connection was lost."""
+        """Attempts to reconnect to the Cyton board if the connection was lost. Called from
+        another thread while streaming, the streaming loop reconnects before its next sample,
+        the serial port is only read by that loop."""
+        stream_thread = self._stream_thread
+        if stream_thread is not None and stream_thread is not current_thread():
+            self._reconnect_requested.set()
+            return
+        self._reconnect_requested.clear()
         self.packets_dropped = 0
         self._logger.info("Reconnecting...")
 
+        self.metrics.reconnects += 1
+        self.metrics.restart_ids()
+
         # Stop stream
         self.stop_stream()
-        time.sleep(0.5)
 
-        # Soft reset of the board
-        self.ser.write(b'v')
-        time.sleep(0.5)
+        # Soft reset of the board, drops whatever was still in flight
+        self.soft_reset()
+        self.read_state = 0
 
         # Start stream
         self.ser.write(b'b')
-        time.sleep(0.5)
         self.streaming = True
 
     def check_connection(self, max_packets_skipped=1, interval=2):
@@ -158,8 +269,14 @@ class OpenBCICyton(object):
 
     def parse_board_data(self, maxbytes2skip=3000):
         """Parses the data from the Cyton board into an OpenBCISample object."""
+        profiler = self.profiler
+
         def read_board(n):
+            if profiler is not None:
+                read_start = clock_ns()
             bb = self.ser.read(n)
+            if profiler is not None:
+                profiler.record('read', read_start)
             if not bb:
                 self._logger.warning("Device appears to be stalling. "
                                      "Quitting...")
@@ -168,6 +285,7 @@ class OpenBCICyton(object):
                 sys.exit()
                 return '\xFF'
             else:
+                self.metrics.read(len(bb))
                 return bb
 
         for rep in range(maxbytes2skip):
@@ -176,7 +294,9 @@ class OpenBCICyton(object):
             if self.read_state == 0:
                 b = read_board(1)
 
-                if struct.unpack('B', b)[0] == START_BYTE:
+                if struct.unpack('B', b)[0] != START_BYTE:
+                    self.metrics.resync_bytes += 1
+                else:
                     if rep != 0:
                         self._logger.info(
                             "Skipped %d bytes before start found" % rep)
@@ -189,26 +309,18 @@ class OpenBCICyton(object):
 
             # Channel data
             elif self.read_state == 1:
-                channels_data = []
-                for c in range(8):
-                    # Read 3 byte integers
-                    literal_read = read_board(3)
-
-                    unpacked = struct.unpack('3B', literal_read)
-                    log_bytes_in = log_bytes_in + '|' + str(literal_read)
-
-                    # Translate 3 byte int into 2s complement
-                    if unpacked[0] > 127:
-                        pre_fix = bytes(bytearray.fromhex('FF'))
-                    else:
-                        pre_fix = bytes(bytearray.fromhex('00'))
-
-                    literal_read = pre_fix + literal_read
-
-                    myInt = struct.unpack('>i', literal_read)[0]
-
-                    # Append channel to channels data
-                    channels_data.append(myInt)
+                # 8 channels of 3 byte integers, decoded at once
+                literal_read = read_board(24)
+                log_bytes_in = log_bytes_in + '|' + str(literal_read)
+                if profiler is not None:
+                    profile_start = clock_ns()
+                decode_start = timeit.default_timer()
+                channels_data = decode_24bit(literal_read)
+                if not self.scaled:
+                    channels_data = channels_data.tolist()
+                self.metrics.decode_seconds += timeit.default_timer() - decode_start
+                if profiler is not None:
+                    profiler.record('decode', profile_start)
 
                 self.read_state = 2
 
@@ -233,12 +345,16 @@ class OpenBCICyton(object):
                 self.read_state = 0 # resets to read next packet
 
                 if val == END_BYTE:
-                    sample = OpenBCISample(packet_id, channels_data, aux_data, self.start_time, self.board_type)
+                    sample = OpenBCISample(packet_id, channels_data, aux_data, self.start_time, self.board_type,
+                                           arrival=time.time())
                     self.packets_dropped = 0
+                    # with a Daisy, a sample takes two packets
+                    self.metrics.packet_id(packet_id, samples_per_packet=0.5 if self.daisy else 1)
                     return sample
                 else:
                     self._logger.warning("ID:<%d> <Unexpected END_BYTE found <%s> instead of <%s>" % (packet_id, val, END_BYTE))
                     self.packets_dropped = self.packets_dropped + 1
+                    self.metrics.bad_stop_bytes += 1
 
 
     def write_command(self, command):
@@ -252,7 +368,77 @@ class OpenBCICyton(object):
                 print(line)
         else:
             self.ser.write(command.encode())
-            time.sleep(0.5)
+            self.config.update_from_commands(command)
+            self._update_scale()
+            # only the soft reset needs the board to settle, the dongle just needs its
+            # commands apart like the batches of write_commands
+            time.sleep(RESET_COMMAND_DELAY if 'v' in command else COMMAND_BATCH_DELAY)
+
+    def write_commands(self, commands):
+        """Sends a list of string commands to the Cyton board in as few writes as possible,
+        without waiting after every single command."""
+        for i, batch in enumerate(batch_commands(commands, COMMAND_BATCH_LENGTH)):
+            if i:
+                time.sleep(COMMAND_BATCH_DELAY)
+            self.ser.write(batch.encode())
+            self.config.update_from_commands(batch)
+        self._update_scale()
+
+    def apply_config(self, config):
+        """Configures the board as described by a BoardConfig, only sending the commands needed
+        to go from the current configuration of the board to this one."""
+        commands = self.config.commands_to(config)
+        if commands:
+            self.write_commands(commands)
+        self.config = config.copy()
+        self._update_scale()
+
+    def measure_impedance(self, channels=None, seconds=2.0, parallel=True):
+        """Measures the impedance of the electrodes of `channels` (1 based, all if None) from
+        their response to the lead-off current, over `seconds` of data, and returns a dict
+        {channel: Ohms}. All the channels are driven at the same time if `parallel`, one after
+        the other otherwise."""
+        if self.streaming:
+            self.stop_stream()
+        if channels is None:
+            channels = range(1, self.config.num_channels + 1)
+        channels = list(channels)
+        groups = [channels] if parallel else [[channel] for channel in channels]
+        # the samples of the Cyton + Daisy combine two packets
+        sample_rate = self.config.sample_rate / (2 if self.daisy else 1)
+        volts_per_unit = 1e-6 if self.scaled else self._channel_scale * 1e-6
+        impedances = {}
+        for group in groups:
+            estimator = ImpedanceEstimator(sample_rate, volts_per_unit)
+            needed = int(seconds * sample_rate)
+
+            def measured(block, estimator=estimator, needed=needed):
+                if estimator.count >= needed:
+                    self.stop_stream()
+
+            self.write_commands(lead_off_commands(group))
+            try:
+                self.start_stream(SampleBlocker(measured, block_size=max(1, int(sample_rate // 10)),
+                                                stages=[estimator], id_step=2 if self.daisy else 1))
+            finally:
+                self.write_commands(lead_off_commands(group, enabled=False))
+            values = estimator.impedances()
+            for channel in group:
+                impedances[channel] = float(values[channel - 1]) if values is not None else None
+        return impedances
+
+    def _update_scale(self):
+        """Precomputes the scale factors from the gains of the current configuration."""
+        self._channel_scale = self.config.scale_factors()
+        self._accel_scale = self.config.accel_scale
+
+    def _scale_sample(self, sample):
+        """Converts the channels data of a sample to uVolts, and the aux data to G when it holds
+        the accelerometer data."""
+        sample.channels_data = self._channel_scale * sample.channels_data
+        if self.config.aux_mode == 'accel':
+            sample.aux_data = self._accel_scale * np.asarray(sample.aux_data, dtype=np.float64)
+        return sample
 
 
     def start_stream(self, callback):
@@ -265,17 +451,42 @@ class OpenBCICyton(object):
         if not isinstance(callback, list):
             callback = [callback]
 
+        # a reconnection asked during a previous stream is not wanted anymore
+        self._reconnect_requested.clear()
+        self._stream_thread = current_thread()
+        try:
+            self._stream(callback)
+        finally:
+            self._stream_thread = None
+
+    def _stream(self, callback):
+        """Streaming loop of start_stream."""
         # checks connection
         self.check_connection(max_packets_skipped=self.max_packets_skipped)
 
         while self.streaming:
+            if self._reconnect_requested.is_set():
+                self.reconnect()
 
             #read current sample
             sample = self.parse_board_data()
+            profiler = self.profiler
 
             if not self.daisy:
+                 if self.scaled:
+                     if profiler is not None:
+                         profile_start = clock_ns()
+                     sample = self._scale_sample(sample)
+                     if profiler is not None:
+                         profiler.record('scale', profile_start)
+                 if profiler is not None:
+                     profile_start = clock_ns()
+                 callback_start = timeit.default_timer()
                  for call in callback:
                      call(sample)
+                 self.metrics.delivered(1, timeit.default_timer() - callback_start)
+                 if profiler is not None:
+                     profiler.record('callback', profile_start)
 
             # When daisy is connected wait to concatenate two samples
             else:
@@ -285,35 +496,104 @@ class OpenBCICyton(object):
 
                 # Check if the next sample ID is concecutive, if not the packet is dropped
                 elif sample.id - 1 == self.last_odd_sample.id:
+                    if profiler is not None:
+                        profile_start = clock_ns()
                     # The auxiliary data is the average between the two samples.
                     avg_aux_data = list((np.array(sample.aux_data) + np.array(self.last_odd_sample.aux_data)) / 2)
 
-                    sample_with_daisy = OpenBCISample(sample.id, sample.channels_data + self.last_odd_sample.channels_data, avg_aux_data, self.start_time, self.board_type)
-
+                    if self.scaled:
+                        channels_data = np.concatenate((sample.channels_data, self.last_odd_sample.channels_data))
+                    else:
+                        channels_data = sample.channels_data + self.last_odd_sample.channels_data
+                    sample_with_daisy = OpenBCISample(sample.id, channels_data, avg_aux_data, self.start_time, self.board_type,
+                                                      arrival=sample.arrival)
+                    if profiler is not None:
+                        profiler.record('daisy', profile_start)
+                    if self.scaled:
+                        if profiler is not None:
+                            profile_start = clock_ns()
+                        sample_with_daisy = self._scale_sample(sample_with_daisy)
+                        if profiler is not None:
+                            profiler.record('scale', profile_start)
+
+                    if profiler is not None:
+                        profile_start = clock_ns()
+                    callback_start = timeit.default_timer()
                     for call in callback:
                         call(sample_with_daisy)
+                    self.metrics.delivered(1, timeit.default_timer() - callback_start)
+                    if profiler is not None:
+                        profiler.record('callback', profile_start)
                         
-    def print_incoming_text(self):
+    def set_profiler(self, profiler):
+        """Records the spans of the stages of the acquisition (read, decode, scale, daisy,
+        callback) into a Profiler, None to stop profiling."""
+        self.profiler = profiler
+
+    def stats(self):
+        """Returns a snapshot of the counters of the stream (see StreamStats), the queue depth
+        being the bytes waiting in the serial port buffer."""
+        try:
+            queue_depth = self.ser.in_waiting
+        except (AttributeError, IOError, OSError, serial.SerialException):
+            queue_depth = 0
+        return self.metrics.snapshot(queue_depth=queue_depth)
+
+    def stream(self, block_size=25, stages=None, disconnect=True, max_queue=100):
+        """Returns the blocks of samples as an asynchronous iterator, for asyncio applications:
+        async for block in board.stream(block_size=25). The serial port is read on a thread of
+        its own. Closing the stream stops the board and, if `disconnect`, closes the port."""
+        return BlockStream(self.start_stream, self.stop_stream,
+                           release=self.disconnect if disconnect else None,
+                           block_size=block_size, stages=stages, id_step=2 if self.daisy else 1,
+                           max_queue=max_queue)
+
+    def soft_reset(self):
+        """Soft resets the board and waits for its banner. 'v' is sent again every
+        RESET_RETRY_INTERVAL seconds in case the dongle was not ready, until connect_timeout."""
+        end = time.time() + self.connect_timeout
+        while True:
+            self.ser.write(b'v')
+            if self.print_incoming_text(min(end, time.time() + RESET_RETRY_INTERVAL)):
+                return
+            if time.time() >= end:
+                self._logger.warning("No Message")
+                return
+
+    def read_until(self, terminator, end):
+        """Reads in bulk until `terminator` is received or the time `end` is reached."""
+        timeout = self.ser.timeout
+        self.ser.timeout = 0.01
+        data = b''
+        try:
+            while terminator not in data and time.time() < end:
+                data += self.ser.read(max(self.ser.inWaiting(), 1))
+        finally:
+            self.ser.timeout = timeout
+        return data
+
+    def print_incoming_text(self, end=None):
         """
         When starting the connection, print all the debug data until
-        we get to a line with the end sequence '$$$'.
+        we get to a line with the end sequence '$$$', or until the time `end`.
+        Returns True if the end sequence was found.
         """
-        line = ''
-        # Wait for device to send data
-        time.sleep(1)
-
-        if self.ser.inWaiting():
-            line = ''
-            c = ''
-            # Look for end sequence $$$
-            while '$$$' not in line:
-                # we're supposed to get UTF8 text, but the board might behave otherwise
-                c = self.ser.read().decode('utf-8',
-                                           errors='replace')
-                line += c
+        if end is None:
+            end = time.time() + self.connect_timeout
+        # we're supposed to get UTF8 text, but the board might behave otherwise
+        line = self.read_until(b'$$$', end).decode('utf-8', errors='replace')
+        if '$$$' in line:
             self._logger.debug(line)
-        else:
-            self.warn("No Message")
+            return True
+        return False
+
+
+def decode_24bit(data):
+    """Decodes big endian 3 byte two's complement integers into an int32 array."""
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+    values = (raw[:, 0] << 16) | (raw[:, 1] << 8) | raw[:, 2]
+    # sign extension of the 24 bit values
+    return values - ((values & 0x800000) << 1)
 
 
 class OpenBCISample():
@@ -325,11 +605,13 @@ class OpenBCISample():
         aux_data: An array with the aux data from the board.
         start_time: A string with the stream start time.
         board_type: A string specifying the board type, e.g 'cyton', 'daisy', 'ganglion'
+        arrival: The time.time() at which the end of the packet was read from the serial port.
     """
 
-    def __init__(self, packet_id, channels_data, aux_data, init_time, board_type):
+    def __init__(self, packet_id, channels_data, aux_data, init_time, board_type, arrival=None):
         self.id = packet_id
         self.channels_data = channels_data
         self.aux_data = aux_data
         self.start_time = init_time
         self.board_type = board_type
+        self.arrival = arrival
@@ -3,14 +3,21 @@ import datetime
 import logging
 import sys
 import threading
+import time
+import timeit
 import warnings
 
 import numpy as np
 from bitstring import BitArray
-from bluepy.btle import DefaultDelegate, Peripheral, Scanner
+from bluepy.btle import BTLEException, DefaultDelegate, Peripheral, Scanner
+
+from .utils.aio import BlockStream
+from .utils.cache import cache_delete, cache_get, cache_set
+from .utils.config import BoardConfig, batch_commands
+from .utils.metrics import StreamStats
+from .utils.profiling import clock_ns
 
 # TODO: Add aux data
-# TODO: Reconnecting when dropped
 
 SAMPLE_RATE = 200.0  # Hz
 DELTA_T = 1.0 / SAMPLE_RATE
@@ -21,32 +28,74 @@ BLE_SERVICE = "fe84"
 BLE_CHAR_RECEIVE = "2d30c082f39f4ce6923f3484ea480596"
 BLE_CHAR_SEND = "2d30c083f39f4ce6923f3484ea480596"
 BLE_CHAR_DISCONNECT = "2d30c084f39f4ce6923f3484ea480596"
+# longest value written to a characteristic in a single BLE write
+BLE_MAX_WRITE = 20
+# seconds between checks for a discovered Ganglion while scanning
+SCAN_INTERVAL = 0.1
+# cache key of the last Ganglion found when no name was requested
+ANY_GANGLION = '*'
+# packet ids of the impedance values of channels 1 to 4 and of the reference
+IMPEDANCE_PACKET_IDS = {201: 1, 202: 2, 203: 3, 204: 4, 205: 'ref'}
+# the Ganglion sends its impedances in kOhms
+IMPEDANCE_UNIT = 1000.
+
+
+class GanglionScanDelegate(DefaultDelegate):
+    """ Scan delegate used by bluepy, remembers the first advertised Ganglion
+    (or the Ganglion named `name`) so that the scan can stop right away."""
+
+    def __init__(self, name=None):
+        DefaultDelegate.__init__(self)
+        self.name = name
+        self.found = None
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        if self.found:
+            return
+        # 9 is the Complete Local Name, 8 the Shortened Local Name
+        dev_name = dev.getValueText(9) or dev.getValueText(8)
+        if not dev_name or not dev_name.startswith('Ganglion'):
+            return
+        if self.name is None or dev_name == self.name:
+            self.found = (dev_name, dev.addr)
 
 
-def _find_mac():
+def _find_mac(name=None, timeout=5, use_cache=True):
     """Finds and returns the mac address of the first Ganglion board
-    found"""
-    scanner = Scanner()
-    devices = scanner.scan(5)
-
-    if len(devices) < 1:
-        raise OSError(
-            'No nearby Devices found. Make sure your Bluetooth Connection '
-            'is on.')
-
-    else:
-        gang_macs = []
-        for dev in devices:
-            for adtype, desc, value in dev.getScanData():
-                if desc == 'Complete Local Name' and value.startswith(
-                        'Ganglion'):
-                    gang_macs.append(dev.addr)
-                    print(value)
-
-    if len(gang_macs) < 1:
-        raise OSError('Cannot find OpenBCI Ganglion Mac address.')
-    else:
-        return gang_macs[0]
+    found, or of the Ganglion advertising `name`. The scan stops as soon as
+    the board is seen, and the address is cached so that the next call does
+    not need to scan (nor root privileges) at all."""
+    key = name or ANY_GANGLION
+    if use_cache:
+        mac = cache_get('ganglion', key)
+        if mac:
+            return mac
+
+    delegate = GanglionScanDelegate(name)
+    scanner = Scanner().withDelegate(delegate)
+    scanner.clear()
+    scanner.start()
+    try:
+        end = time.time() + timeout
+        while not delegate.found and time.time() < end:
+            scanner.process(min(SCAN_INTERVAL, max(end - time.time(), 0.01)))
+    finally:
+        try:
+            scanner.stop()
+        except Exception as e:
+            logging.getLogger(__name__).debug(e)
+
+    if not delegate.found:
+        if name:
+            raise OSError('Cannot find OpenBCI Ganglion %s.' % name)
+        raise OSError('Cannot find OpenBCI Ganglion Mac address. Make sure '
+                      'your Bluetooth Connection is on.')
+
+    found_name, mac = delegate.found
+    print(found_name)
+    cache_set('ganglion', found_name, mac)
+    cache_set('ganglion', ANY_GANGLION, mac)
+    return mac
 
 
 class OpenBCIGanglion(object):
@@ -61,34 +110,80 @@ class OpenBCIGanglion(object):
         be a string comprising six hex bytes separated by colons,
         e.g. "11:22:33:ab:cd:ed". If no mac address specified, a connection
         will be stablished with the first Ganglion found (Will need root
-        privilages).
+        privilages the first time, the address is then cached).
 
         max_packets_skipped: An integer specifying how many packets can be
         dropped before attempting to reconnect.
+
+        name: The advertised name of the Ganglion to connect to when no mac
+        address is specified, e.g. "Ganglion-1234". None connects to the
+        first Ganglion found.
+
+        scan_timeout: Maximum seconds to scan for the Ganglion.
+
+        scaled: A boolean, True to output the channels data in uVolts instead
+        of raw counts.
     """
 
-    def __init__(self, mac=None, max_packets_skipped=15):
+    def __init__(self, mac=None, max_packets_skipped=15, name=None,
+                 scan_timeout=5, scaled=False):
         self._logger = logging.getLogger(self.__class__.__name__)
 
+        self.name = name
+        self.scan_timeout = scan_timeout
+        self.scaled = scaled
+        self._mac_from_scan = not mac
         if not mac:
-            self.mac_address = _find_mac()
+            self.mac_address = _find_mac(name, scan_timeout)
         else:
             self.mac_address = mac
         self._logger.debug(
-            'Connecting to Ganglion with MAC address %s' % mac)
+            'Connecting to Ganglion with MAC address %s' % self.mac_address)
 
         self.max_packets_skipped = max_packets_skipped
         self._stop_streaming = threading.Event()
         self._stop_streaming.set()
         self.board_type = 'Ganglion'
+        # what has been set on the board, see apply_config
+        self.config = BoardConfig('ganglion', aux_mode=None)
+        # cumulative counters of the stream, kept across connections, see stats
+        self.metrics = StreamStats()
+        # Profiler of the stages of the acquisition, see set_profiler
+        self.profiler = None
 
         atexit.register(self.disconnect)
 
-        self.connect()
+        try:
+            self.connect()
+        except BTLEException:
+            if not self._mac_from_scan:
+                raise
+            # the cached address may be stale, scan again
+            self._forget_mac()
+            self.mac_address = _find_mac(name, scan_timeout, use_cache=False)
+            self.connect()
+
+    def _forget_mac(self):
+        cache_delete('ganglion', self.name or ANY_GANGLION)
 
     def write_command(self, command):
         """Sends string command to the Ganglion board."""
         self.char_write.write(str.encode(command))
+        self.config.update_from_commands(command)
+
+    def write_commands(self, commands):
+        """Sends a list of string commands to the Ganglion board in as few BLE writes as
+        possible."""
+        for batch in batch_commands(commands, BLE_MAX_WRITE):
+            self.write_command(batch)
+
+    def apply_config(self, config):
+        """Configures the board as described by a BoardConfig, only sending the commands needed
+        to go from the current configuration of the board to this one."""
+        commands = self.config.commands_to(config)
+        if commands:
+            self.write_commands(commands)
+        self.config = config.copy()
 
     def connect(self):
         """Establishes connection with the specified Ganglion board."""
@@ -103,7 +198,11 @@ class OpenBCIGanglion(object):
         self.char_discon = \
             self.service.getCharacteristics(BLE_CHAR_DISCONNECT)[0]
 
-        self.ble_delegate = GanglionDelegate(self.max_packets_skipped)
+        self.ble_delegate = GanglionDelegate(
+            self.max_packets_skipped,
+            self.config.scale_factors() if self.scaled else None,
+            self.metrics)
+        self.ble_delegate.profiler = self.profiler
         self.ganglion.setDelegate(self.ble_delegate)
 
         self.desc_notify = self.char_read.getDescriptors(forUUID=0x2902)[0]
@@ -117,6 +216,43 @@ class OpenBCIGanglion(object):
 
         self._logger.debug("Connection established.")
 
+    def reconnect(self):
+        """Connects again to the Ganglion after a BLE dropout. The known mac
+        address is used, no scan is needed."""
+        self._logger.warning('Reconnecting to Ganglion %s' % self.mac_address)
+        self.metrics.reconnects += 1
+        try:
+            self.ganglion.disconnect()
+        except Exception as e:
+            self._logger.debug(e)
+        self.connect()
+        # the board may have been power cycled, send the settings again
+        commands = BoardConfig('ganglion', aux_mode=None).commands_to(self.config)
+        self.config = BoardConfig('ganglion', aux_mode=None)
+        if commands:
+            self.write_commands(commands)
+        if not self._stop_streaming.is_set():
+            self.write_command('b')
+
+    def measure_impedance(self, seconds=5.0):
+        """Asks the Ganglion to measure the impedance of its electrodes and returns a dict
+        {channel: Ohms}, the reference electrode is 'ref'. Returns after `seconds` if the
+        board did not send all the values."""
+        if not self._stop_streaming.is_set():
+            self.stop_stream()
+        self.ble_delegate.impedances = {}
+        self.write_command('z')
+        try:
+            end = time.time() + seconds
+            while len(self.ble_delegate.impedances) < len(IMPEDANCE_PACKET_IDS) and \
+                    time.time() < end:
+                self.ganglion.waitForNotifications(SCAN_INTERVAL)
+                # the data packets sent meanwhile are not wanted
+                self.ble_delegate.getSamples()
+        finally:
+            self.write_command('Z')
+        return dict(self.ble_delegate.impedances)
+
     def disconnect(self):
         """Disconnets from the Ganglion board."""
         if not self._stop_streaming.is_set():
@@ -158,17 +294,65 @@ class OpenBCIGanglion(object):
             callback = [callback]
 
         while not self._stop_streaming.is_set():
+            profiler = self.profiler
+            if profiler is not None:
+                profile_start = clock_ns()
             try:
                 self.ganglion.waitForNotifications(DELTA_T)
+            except BTLEException as e:
+                self._logger.warning("BLE connection dropped: %s" % e)
+                try:
+                    self.reconnect()
+                except Exception as e:
+                    self._logger.error("Could not reconnect: %s" % e)
+                    sys.exit(1)
             except Exception as e:
                 self._logger.error("Something went wrong: ", e)
                 sys.exit(1)
 
+            if profiler is not None:
+                # the decoding runs within, as the notifications are handled
+                profiler.record('wait', profile_start)
+
             samples = self.ble_delegate.getSamples()
             if samples:
+                if profiler is not None:
+                    profile_start = clock_ns()
+                callback_start = timeit.default_timer()
                 for sample in samples:
                     for call in callback:
                         call(sample)
+                self.metrics.delivered(len(samples), timeit.default_timer() - callback_start)
+                if profiler is not None:
+                    profiler.record('callback', profile_start)
+
+    def set_profiler(self, profiler):
+        """Records the spans of the stages of the acquisition (wait, decode, callback) into a
+        Profiler, None to stop profiling."""
+        self.profiler = profiler
+        self.ble_delegate.profiler = profiler
+
+    def stats(self):
+        """Returns a snapshot of the counters of the stream (see StreamStats), the queue depth
+        being the samples parsed and not given to the callbacks yet."""
+        return self.metrics.snapshot(queue_depth=len(self.ble_delegate.samples))
+
+    def stream(self, block_size=20, stages=None, disconnect=True, max_queue=100,
+               accel_data_on=False):
+        """Returns the blocks of samples as an asynchronous iterator, for asyncio applications:
+        async for block in board.stream(block_size=20). The Bluetooth notifications are
+        received on a thread of their own. Closing the stream stops the board and, if
+        `disconnect`, disconnects from it."""
+
+        def release():
+            # bluepy is not thread safe, 's' is sent once the notifications thread is done
+            self.write_command('s')
+            if disconnect:
+                self.disconnect()
+
+        return BlockStream(lambda callback: self.start_stream(callback, accel_data_on),
+                           self._stop_streaming.set, release=release, block_size=block_size,
+                           stages=stages, max_queue=max_queue)
 
 
 class GanglionDelegate(DefaultDelegate):
@@ -178,10 +362,18 @@ class GanglionDelegate(DefaultDelegate):
 
     __boardname = 'Ganglion'
 
-    def __init__(self, max_packets_skipped=15):
+    def __init__(self, max_packets_skipped=15, scale=None, metrics=None):
 
         DefaultDelegate.__init__(self)
         self.max_packets_skipped = max_packets_skipped
+        # uVolts per count of every channel, None to output raw counts
+        self.scale = scale
+        # counters of the stream, see OpenBCIGanglion.stats
+        self.metrics = metrics if metrics is not None else StreamStats()
+        # Profiler of the decoding, see OpenBCIGanglion.set_profiler
+        self.profiler = None
+        # last impedance received for every channel, in Ohms
+        self.impedances = {}
         self.last_values = [0, 0, 0, 0]
         self.last_id = -1
         self.samples = []
@@ -196,7 +388,19 @@ class GanglionDelegate(DefaultDelegate):
 
         if len(data) < 1:
             warnings.warn('A packet should at least hold one byte...')
+        arrival = time.time()
+        received = len(self.samples)
+        self.metrics.read(len(data))
+        profiler = self.profiler
+        if profiler is not None:
+            profile_start = clock_ns()
+        decode_start = timeit.default_timer()
         self.parse_raw(data)
+        self.metrics.decode_seconds += timeit.default_timer() - decode_start
+        if profiler is not None:
+            profiler.record('decode', profile_start)
+        for sample in self.samples[received:]:
+            sample.arrival = arrival
 
     def parse_raw(self, raw_data):
         """Parses the data from the Cyton board into an OpenBCISample object."""
@@ -208,19 +412,29 @@ class GanglionDelegate(DefaultDelegate):
         bit_array = BitArray()
 
         start_byte = raw_data[0]
+        if start_byte in IMPEDANCE_PACKET_IDS:
+            # impedance packets are not part of the sequence of data packets
+            self.parse_impedance(start_byte, raw_data)
+            return
         dropped, dummy_samples = self.check_dropped(start_byte)
         self.last_id = start_byte
+        self.metrics.frames += 1
+        if dropped > 0:
+            self.metrics.id_gaps += 1
+            # two samples per packet
+            self.metrics.lost_samples += 2 * dropped
 
         if self._wait_for_full_pkt:
             if start_byte != 0:
                 self._logger.warning('Need to wait for next full packet...')
+                self.metrics.resync_bytes += len(raw_data)
                 if dropped > 0:
                     self.samples.extend(dummy_samples)
                 else:
                     self.samples.extend([
-                        OpenBCISample(start_byte, [np.NaN] * 4, [],
+                        OpenBCISample(start_byte, [np.nan] * 4, [],
                                       self.start_time, self.__boardname),
-                        OpenBCISample(start_byte, [np.NaN] * 4, [],
+                        OpenBCISample(start_byte, [np.nan] * 4, [],
                                       self.start_time, self.__boardname)
 
                     ])
@@ -251,8 +465,11 @@ class GanglionDelegate(DefaultDelegate):
             self.last_values = np.array(results, dtype=np.int32)
 
             # store the sample
+            values = self.last_values
+            if self.scale is not None:
+                values = self.scale * values
             self.samples.append(
-                OpenBCISample(start_byte, self.last_values, [],
+                OpenBCISample(start_byte, values, [],
                               self.start_time, self.__boardname))
 
         elif 1 <= start_byte <= 200:
@@ -280,15 +497,28 @@ class GanglionDelegate(DefaultDelegate):
             # expected timestamp with respect to the most-recent full-size
             # packet received
 
+            values1, values2 = self.last_values1, self.last_values
+            if self.scale is not None:
+                # both samples of the packet are scaled at once
+                values1, values2 = self.scale * np.vstack((values1, values2))
+
             # store both samples
             self.samples.append(
-                OpenBCISample(start_byte, self.last_values1, [],
+                OpenBCISample(start_byte, values1, [],
                               self.start_time, self.__boardname))
 
             self.samples.append(
-                OpenBCISample(start_byte, self.last_values, [],
+                OpenBCISample(start_byte, values2, [],
                               self.start_time, self.__boardname))
 
+    def parse_impedance(self, packet_id, raw_data):
+        """Parses an impedance packet, the value is ASCII text ending with 'Z'."""
+        text = bytes(bytearray(raw_data[1:])).split(b'Z')[0].strip()
+        if not text.isdigit():
+            self._logger.warning('Invalid impedance packet %r' % bytes(bytearray(raw_data)))
+            return
+        self.impedances[IMPEDANCE_PACKET_IDS[packet_id]] = int(text) * IMPEDANCE_UNIT
+
     def getSamples(self):
         """Returns the last OpenBCI Samples in the stack"""
         old_samples = self.samples
@@ -313,9 +543,9 @@ class GanglionDelegate(DefaultDelegate):
             dummy_samples = []
             for i in range(dropped, -1, -1):
                 dummy_samples.extend([
-                    OpenBCISample(num - i, [np.NaN] * 4, [],
+                    OpenBCISample(num - i, [np.nan] * 4, [],
                                   self.start_time, self.__boardname),
-                    OpenBCISample(num - i, [np.NaN] * 4, [],
+                    OpenBCISample(num - i, [np.nan] * 4, [],
                                   self.start_time, self.__boardname)
 
                 ])
@@ -339,12 +569,15 @@ class OpenBCISample():
         start_time: A string with the stream start time.
         board_type: A string specifying the board type, e.g 'cyton', 'daisy',
         'ganglion'
+        arrival: The time.time() at which the Bluetooth notification holding
+        the sample was received.
     """
 
     def __init__(self, packet_id, channels_data, aux_data,
-                 init_time, board_type):
+                 init_time, board_type, arrival=None):
         self.id = packet_id
         self.channels_data = channels_data
         self.aux_data = aux_data
         self.start_time = init_time
         self.board_type = board_type
+        self.arrival = arrival
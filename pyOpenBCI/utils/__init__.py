@@ -1 +1,18 @@
 from .ssdp import SSDPResponse
+from .config import BoardConfig, ChannelSettings
+from .stream import Block, ClockDejitter, SampleBlocker, concatenate_blocks
+from .filters import IIRFilter
+from .ringbuffer import RingBuffer, RingReader
+from .spectral import BandPower
+from .resample import Resampler
+from .quality import QualityMonitor
+from .impedance import ImpedanceEstimator
+from .codec import encode_block, decode_block, write_block, read_block
+from .lsl import LSLSink, MemoryOutlet
+from .fanout import BlockServer, BlockClient
+from .sharedring import SharedRingBuffer, SharedRingReader
+from .aio import BlockStream
+from .consumers import Consumer, Dispatcher
+from .metrics import MetricsServer, StreamStats
+from .profiling import Profiler
+from .latency import LatencyHarness, LatencyMonitor
@@ -0,0 +1,204 @@
+"""
+asyncio interface to the boards: the blocks of samples of any board as an asynchronous
+iterator.
+
+The drivers stream in a blocking loop (the serial port of the Cyton, the Bluetooth
+notifications of the Ganglion, the asyncore loop of the WiFi Shield), BlockStream runs that
+loop on a thread of its own and hands the blocks over to the event loop. The event loop is
+only woken up when the consumer waits for a block, and once for all the blocks received
+meanwhile, never per sample. Blocks the consumer is too slow to take are dropped, oldest first,
+and the next block is marked as following a gap.
+
+Closing the stream, leaving an `async with`, or cancelling the task waiting for a block stops
+the board (sends 's') and releases it (closes the serial port, the Bluetooth connection or
+the WiFi Shield session) unless disconnect=False is given to stream().
+
+Needs Python 3.5 or later.
+
+EXAMPLE USE:
+async def main():
+    board = OpenBCICyton()
+    async with board.stream(block_size=25) as blocks:
+        async for block in blocks:
+            print(block.data.mean(axis=0))
+
+asyncio.get_event_loop().run_until_complete(main())
+"""
+import collections
+import logging
+import threading
+
+from .stream import SampleBlocker
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+# seconds given to the streaming loop to end by itself once the board is stopped
+STOP_TIMEOUT = 1.
+
+
+class BlockStream(object):
+    """ Asynchronous iterator over the blocks of a board, see the stream method of the boards.
+
+    Args:
+        run: Function streaming the board, blocking until it is stopped, called with the
+        callback to give the samples to, e.g. board.start_stream.
+        stop: Function stopping the streaming, called from another thread.
+        release: Function releasing the board once stopped, None to leave it connected.
+        block_size: Number of samples in a block.
+        stages: Processing stages applied to the blocks on the streaming thread.
+        id_step: Difference between the ids of two consecutive samples, see SampleBlocker.
+        max_queue: Number of blocks waiting for the consumer before dropping the oldest.
+
+    Attributes:
+        dropped: Number of blocks dropped because the consumer did not keep up.
+    """
+
+    def __init__(self, run, stop, release=None, block_size=25, stages=None, id_step=None,
+                 max_queue=100):
+        if asyncio is None:
+            raise ImportError('Streaming with asyncio needs Python 3.5 or later')
+        self._run = run
+        self._stop = stop
+        self._release = release
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._blocker = SampleBlocker(self._put, block_size, stages=stages, id_step=id_step)
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._blocks = collections.deque()
+        self._loop = None
+        self._thread = None
+        self._waiter = None
+        self._wake_pending = False
+        self._finished = False
+        self._error = None
+        self._closed = False
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_event_loop()
+        self._thread = threading.Thread(target=self._stream)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stream(self):
+        """Streaming thread."""
+        try:
+            self._run(self._blocker)
+            self._blocker.flush()
+        except SystemExit:
+            # the drivers exit when the board stalls, the stream just ends
+            if not self._closed:
+                self._logger.warning('The board stopped streaming')
+        except Exception as e:
+            # the board is released from under the loop when closing
+            if not self._closed:
+                self._error = e
+        with self._lock:
+            self._finished = True
+        self._wake()
+
+    def _put(self, block):
+        """Streaming thread, queues a block for the consumer."""
+        with self._lock:
+            self._blocks.append(block)
+            if len(self._blocks) > self.max_queue:
+                self._blocks.popleft()
+                self.dropped += 1
+                self._blocks[0] = self._blocks[0].replace(gap=True)
+        self._wake()
+
+    def _wake(self):
+        """Wakes the event loop up if the consumer waits and it was not done yet."""
+        with self._lock:
+            if self._waiter is None or self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            self._loop.call_soon_threadsafe(self._deliver)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+
+    def _deliver(self):
+        """Event loop, completes the future the consumer waits for."""
+        with self._lock:
+            self._wake_pending = False
+            waiter = self._waiter
+            if waiter is None or waiter.done():
+                self._waiter = None
+                return
+            if self._blocks:
+                block = self._blocks.popleft()
+            elif self._finished:
+                block = None
+            else:
+                return
+            self._waiter = None
+        if block is not None:
+            waiter.set_result(block)
+        else:
+            waiter.set_exception(self._error or StopAsyncIteration())
+
+    def _waiter_done(self, waiter):
+        if waiter.cancelled():
+            # the consumer was cancelled, the board is stopped without blocking the loop
+            self._loop.run_in_executor(None, self.close)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """Returns a future of the next block."""
+        self._start()
+        future = self._loop.create_future()
+        with self._lock:
+            if self._blocks:
+                future.set_result(self._blocks.popleft())
+                return future
+            if self._finished:
+                future.set_exception(self._error or StopAsyncIteration())
+                return future
+            self._waiter = future
+        future.add_done_callback(self._waiter_done)
+        return future
+
+    def __aenter__(self):
+        self._start()
+        future = self._loop.create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, exc_type, exc, traceback):
+        return self.aclose()
+
+    def aclose(self):
+        """Returns a future of the closing of the stream, which runs on a worker thread."""
+        loop = self._loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.close)
+
+    def close(self):
+        """Stops the board, waits for the streaming thread and releases the board. Blocks, use
+        aclose from the event loop."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._thread is not None and self._thread.is_alive():
+            try:
+                self._stop()
+            except Exception as e:
+                self._logger.warning('Could not stop the board: %s' % e)
+            self._thread.join(STOP_TIMEOUT)
+        if self._release is not None:
+            try:
+                # also ends a streaming loop blocked on a read
+                self._release()
+            except Exception as e:
+                self._logger.warning('Could not release the board: %s' % e)
+        if self._thread is not None:
+            self._thread.join(STOP_TIMEOUT)
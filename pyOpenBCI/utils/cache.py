@@ -0,0 +1,86 @@
+"""
+Small on disk cache for the results of board discovery (serial port of the dongle, address of a
+WiFi Shield, MAC address of a Ganglion), so that connecting again to a known board can skip the
+scan. Entries can expire after a time to live in seconds.
+
+The cache lives in ~/.pyOpenBCI/cache.json, set the PYOPENBCI_CACHE environment variable to use
+another file.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+# the discovery threads update the cache at the same time, each update is a read-modify-write
+_lock = threading.Lock()
+
+
+def cache_path():
+    """Returns the path of the cache file."""
+    return os.environ.get('PYOPENBCI_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.pyOpenBCI', 'cache.json'))
+
+
+def _load():
+    try:
+        with open(cache_path(), 'r') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save(data):
+    path = cache_path()
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # a temporary file of its own, other processes may be writing the cache too
+        fd, tmp_path = tempfile.mkstemp(dir=directory or None, prefix='cache.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            if hasattr(os, 'replace'):
+                os.replace(tmp_path, path)
+            else:
+                os.rename(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        # the cache is an optimization only
+        _logger.debug("Could not write the discovery cache %s: %s" % (path, e))
+
+
+def cache_get(section, key):
+    """Returns the cached value of `key` in `section`, None if missing or expired."""
+    entry = _load().get(section, {}).get(str(key))
+    if not entry:
+        return None
+    expires = entry.get('expires')
+    if expires is not None and expires < time.time():
+        return None
+    return entry.get('value')
+
+
+def cache_set(section, key, value, ttl=None):
+    """Caches `value` for `key` in `section`, for `ttl` seconds or forever if None."""
+    with _lock:
+        data = _load()
+        data.setdefault(section, {})[str(key)] = {
+            'value': value,
+            'expires': time.time() + ttl if ttl is not None else None
+        }
+        _save(data)
+
+
+def cache_delete(section, key):
+    """Forgets `key` in `section`, e.g. when the cached value turned out to be stale."""
+    with _lock:
+        data = _load()
+        if data.get(section, {}).pop(str(key), None) is not None:
+            _save(data)
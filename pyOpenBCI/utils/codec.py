@@ -0,0 +1,154 @@
+"""
+Lossless compression of blocks of 24 bit counts, for storing and forwarding the raw data of the
+boards in a fraction of the size of int32 or float64 arrays.
+
+Every channel of a block is predicted from its previous samples (no prediction, delta, or
+second order linear prediction, whichever gives the smallest residuals), the residuals are
+zigzag encoded to small unsigned integers and bit-packed with the width of the largest one.
+Encoding and decoding are vectorized with NumPy over the whole block.
+
+Format of an encoded block (big endian):
+    magic 'OB', version (1 byte), n_samples (uint32), n_channels (uint16)
+    for every channel: order (uint8), width (uint8), `order` warm-up samples (int32)
+    the residuals of all the channels, channel after channel, packed in `width` bits
+
+EXAMPLE USE:
+payload = encode_block(block.data)  # block of counts, from a board created with scaled=False
+data = decode_block(payload)  # int32 array of shape (n_samples, n_channels)
+"""
+import struct
+
+import numpy as np
+
+MAGIC = b'OB'
+VERSION = 1
+MAX_ORDER = 2
+_HEADER = struct.Struct('>2sBIH')
+_CHANNEL = struct.Struct('>BB')
+_LENGTH = struct.Struct('>I')
+
+
+def _residuals(data, order):
+    """Prediction residuals of every channel, for the samples after the first `order` ones."""
+    if order == 0:
+        return data
+    if order == 1:
+        return data[1:] - data[:-1]
+    return data[2:] - 2 * data[1:-1] + data[:-2]
+
+
+def _zigzag(values):
+    return (values << 1) ^ (values >> 63)
+
+
+def _unzigzag(values):
+    return (values >> 1) ^ -(values & 1)
+
+
+def _bit_width(values):
+    """Number of bits of the largest of every column of unsigned values."""
+    if len(values) == 0:
+        return np.zeros(values.shape[1], dtype=np.int64)
+    largest = values.max(axis=0)
+    return np.where(largest > 0, np.floor(np.log2(np.maximum(largest, 1))).astype(np.int64) + 1,
+                    0)
+
+
+def _pack(values, width):
+    """Packs unsigned `values` in `width` bits each, most significant bit first."""
+    if width == 0 or len(values) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    shifts = np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((values[:, np.newaxis] >> shifts) & 1).astype(np.uint8).ravel()
+
+
+def _unpack(bits, count, width):
+    if width == 0:
+        return np.zeros(count, dtype=np.int64)
+    weights = np.left_shift(1, np.arange(width - 1, -1, -1, dtype=np.int64))
+    return bits.reshape(count, width).astype(np.int64).dot(weights)
+
+
+def encode_block(data):
+    """Encodes `data`, an integer array of shape (n_samples, n_channels) of 24 bit counts (or
+    any values fitting in int32), and returns the bytes."""
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    if data.dtype.kind not in 'iu':
+        if not np.array_equal(data, np.round(data)):
+            raise ValueError('Only integer counts can be encoded without loss')
+    data = data.astype(np.int64)
+    count, num_channels = data.shape
+
+    # residuals and their width for every order, the narrowest order is kept per channel
+    orders = range(min(MAX_ORDER, max(count - 1, 0)) + 1)
+    candidates = [_zigzag(_residuals(data, order)) for order in orders]
+    # bits needed by every channel for every order, warm-up samples included
+    costs = np.array([_bit_width(values) * (count - order) + 32 * order
+                      for order, values in zip(orders, candidates)])
+    best = costs.argmin(axis=0)
+
+    header = [_HEADER.pack(MAGIC, VERSION, count, num_channels)]
+    bits = []
+    for channel in range(num_channels):
+        order = int(best[channel])
+        values = candidates[order][:, channel]
+        width = int(_bit_width(values[:, np.newaxis])[0])
+        header.append(_CHANNEL.pack(order, width))
+        header.append(data[:order, channel].astype('>i4').tobytes())
+        bits.append(_pack(values, width))
+    packed = np.packbits(np.concatenate(bits)) if bits else np.zeros(0, dtype=np.uint8)
+    return b''.join(header) + packed.tobytes()
+
+
+def decode_block(payload):
+    """Decodes the bytes of encode_block, returns an int32 array of shape
+    (n_samples, n_channels)."""
+    magic, version, count, num_channels = _HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not an encoded block of version %d' % VERSION)
+    offset = _HEADER.size
+    channels = []
+    for _ in range(num_channels):
+        order, width = _CHANNEL.unpack_from(payload, offset)
+        offset += _CHANNEL.size
+        warm_up = np.frombuffer(payload, dtype='>i4', count=order, offset=offset)
+        offset += 4 * order
+        channels.append((order, width, warm_up.astype(np.int64)))
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8, offset=offset))
+
+    data = np.zeros((count, num_channels), dtype=np.int64)
+    position = 0
+    for channel, (order, width, warm_up) in enumerate(channels):
+        size = (count - order) * width
+        residuals = _unzigzag(_unpack(bits[position:position + size], count - order, width))
+        position += size
+        column = data[:, channel]
+        column[:order] = warm_up
+        if order == 0:
+            column[:] = residuals
+        elif order == 1:
+            column[1:] = warm_up[0] + np.cumsum(residuals)
+        else:
+            # second differences integrate twice: first differences, then values
+            first_differences = (warm_up[1] - warm_up[0]) + np.cumsum(residuals)
+            column[2:] = warm_up[1] + np.cumsum(first_differences)
+    return data.astype(np.int32)
+
+
+def write_block(stream, data):
+    """Writes an encoded block preceded by its length to a file-like object, see read_block."""
+    payload = encode_block(data)
+    stream.write(_LENGTH.pack(len(payload)))
+    stream.write(payload)
+    return len(payload) + _LENGTH.size
+
+
+def read_block(stream):
+    """Reads a block written by write_block, returns None at the end of the stream."""
+    length = stream.read(_LENGTH.size)
+    if len(length) < _LENGTH.size:
+        return None
+    (size,) = _LENGTH.unpack(length)
+    return decode_block(stream.read(size))
@@ -0,0 +1,248 @@
+"""
+Configuration model of the Cyton, Cyton + Daisy and Ganglion boards.
+
+A BoardConfig remembers what has been set on the board (channels on/off, gain, input type,
+bias, SRB, sample rate, aux mode) so that only the commands needed to go from the current
+state to a desired one are sent. See the Cyton and Ganglion SDKs for the commands.
+
+EXAMPLE USE:
+desired = board.config.copy()
+desired.set_channel(3, gain=8)
+desired.set_channel(4, enabled=False)
+board.apply_config(desired)
+"""
+import copy
+
+import numpy as np
+
+# Channel select characters of the x...X command, and the on/off shortcuts
+CHANNEL_SELECT = "12345678QWERTYUI"
+CHANNEL_OFF = "12345678qwertyui"
+CHANNEL_ON = "!@#$%^&*QWERTYUI"
+
+GAINS = [1, 2, 4, 6, 8, 12, 24]
+INPUT_TYPES = ['normal', 'shorted', 'bias_meas', 'mvdd', 'temp', 'testsig', 'bias_drp',
+               'bias_drn']
+
+# Index in these lists is the digit sent after '~'
+CYTON_SAMPLE_RATES = [16000, 8000, 4000, 2000, 1000, 500, 250]
+GANGLION_SAMPLE_RATES = [25600, 12800, 6400, 3200, 1600, 800, 400, 200]
+
+# Index in this list is the digit sent after '/'
+CYTON_AUX_MODES = ['accel', 'debug', 'analog', 'digital', 'marker']
+
+DEFAULT_GAIN = {'cyton': 24, 'daisy': 24, 'ganglion': 51}
+DEFAULT_SAMPLE_RATE = {'cyton': 250, 'daisy': 250, 'ganglion': 200}
+NUM_CHANNELS = {'cyton': 8, 'daisy': 16, 'ganglion': 4}
+
+# Reference voltages of the ADCs, and full scale of their 24 bit counts
+ADS1299_VREF = 4.5
+MCP3912_VREF = 1.2
+FULL_SCALE_COUNTS = 2 ** 23 - 1
+# Accelerometer G per count, the Cyton sends 16 bit values left justified by 4 bits
+ACCEL_SCALE = {'cyton': 0.002 / 2 ** 4, 'daisy': 0.002 / 2 ** 4, 'ganglion': 0.032}
+
+
+def batch_commands(commands, max_length):
+    """Concatenates commands in as few strings of at most `max_length` characters as possible,
+    a single command is never split."""
+    batches = []
+    batch = ''
+    for command in commands:
+        if batch and len(batch) + len(command) > max_length:
+            batches.append(batch)
+            batch = ''
+        batch += command
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class ChannelSettings(object):
+    """ Settings of a single ADS1299 channel.
+
+    Attributes:
+        enabled: A boolean, False powers the channel down.
+        gain: The PGA gain, one of 1, 2, 4, 6, 8, 12, 24.
+        input_type: An int index into INPUT_TYPES, 0 is the normal electrode input.
+        bias: A boolean indicating if the channel is included in the bias generation.
+        srb2: A boolean indicating if the channel is connected to SRB2.
+        srb1: A boolean indicating if all the N inputs are connected to SRB1.
+    """
+
+    def __init__(self, enabled=True, gain=24, input_type=0, bias=True, srb2=True, srb1=False):
+        if gain not in GAINS:
+            raise ValueError('Gain %s is not supported, use one of %s' % (gain, GAINS))
+        if not 0 <= input_type < len(INPUT_TYPES):
+            raise ValueError('Input type %s is not supported' % input_type)
+        self.enabled = bool(enabled)
+        self.gain = gain
+        self.input_type = input_type
+        self.bias = bool(bias)
+        self.srb2 = bool(srb2)
+        self.srb1 = bool(srb1)
+
+    def command(self, channel):
+        """Returns the x...X command setting `channel` (1 based) to these settings."""
+        return 'x%s%d%d%d%d%d%dX' % (CHANNEL_SELECT[channel - 1], not self.enabled,
+                                     GAINS.index(self.gain), self.input_type, self.bias,
+                                     self.srb2, self.srb1)
+
+    def same_except_power(self, other):
+        return (self.gain, self.input_type, self.bias, self.srb2, self.srb1) == \
+            (other.gain, other.input_type, other.bias, other.srb2, other.srb1)
+
+    def __eq__(self, other):
+        return isinstance(other, ChannelSettings) and self.enabled == other.enabled and \
+            self.same_except_power(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<ChannelSettings(enabled=%s, gain=%d, input_type=%s, bias=%s, srb2=%s, " \
+               "srb1=%s)>" % (self.enabled, self.gain, INPUT_TYPES[self.input_type], self.bias,
+                              self.srb2, self.srb1)
+
+
+class BoardConfig(object):
+    """ State of the configurable settings of a board.
+
+    Args:
+        board_type: 'cyton', 'daisy' or 'ganglion'.
+        sample_rate: The sample rate of the board in Hz, None when it is not known.
+        aux_mode: 'accel', 'debug', 'analog', 'digital' or 'marker' for the Cyton, 'accel' or
+        None for the Ganglion.
+        test_signal: True when the internal square wave is enabled.
+    """
+
+    def __init__(self, board_type='cyton', sample_rate=None, aux_mode='accel', test_signal=False):
+        if board_type not in NUM_CHANNELS:
+            raise ValueError('Board type %s is not supported' % board_type)
+        self.board_type = board_type
+        self.sample_rate = sample_rate or DEFAULT_SAMPLE_RATE[board_type]
+        self.aux_mode = aux_mode
+        self.test_signal = test_signal
+        self.channels = [ChannelSettings() for _ in range(NUM_CHANNELS[board_type])]
+
+    @property
+    def num_channels(self):
+        return len(self.channels)
+
+    @property
+    def gains(self):
+        """The gain of every channel, as used for scaling counts to volts."""
+        if self.board_type == 'ganglion':
+            # the Ganglion has a fixed gain, only the channel power can be set
+            return [DEFAULT_GAIN['ganglion']] * self.num_channels
+        return [channel.gain for channel in self.channels]
+
+    def scale_factors(self):
+        """Microvolts per count of every channel, as an array to multiply the channels data
+        by."""
+        if self.board_type == 'ganglion':
+            # the Ganglion front end adds a gain of 1.5 to its fixed gain
+            vref, gains = MCP3912_VREF, np.array(self.gains) * 1.5
+        else:
+            vref, gains = ADS1299_VREF, np.array(self.gains, dtype=np.float64)
+        return vref * 1e6 / gains / FULL_SCALE_COUNTS
+
+    @property
+    def accel_scale(self):
+        """G per count of the accelerometer data."""
+        return ACCEL_SCALE[self.board_type]
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def set_channel(self, channel, **settings):
+        """Changes some of the settings of `channel` (1 based), see ChannelSettings."""
+        if not 1 <= channel <= self.num_channels:
+            raise ValueError('Cannot set non-existant channel %s' % channel)
+        current = self.channels[channel - 1]
+        values = dict(enabled=current.enabled, gain=current.gain, input_type=current.input_type,
+                      bias=current.bias, srb2=current.srb2, srb1=current.srb1)
+        values.update(settings)
+        self.channels[channel - 1] = ChannelSettings(**values)
+
+    def set_sample_rate(self, sample_rate):
+        if sample_rate not in self._sample_rates():
+            raise ValueError('Sample rate not supported: %s' % sample_rate)
+        self.sample_rate = sample_rate
+
+    def _sample_rates(self):
+        if self.board_type == 'ganglion':
+            return GANGLION_SAMPLE_RATES
+        return CYTON_SAMPLE_RATES
+
+    def commands_to(self, desired):
+        """Returns the list of commands taking the board from this configuration to `desired`."""
+        if desired.board_type != self.board_type:
+            raise ValueError('Cannot configure a %s board as a %s board' %
+                             (self.board_type, desired.board_type))
+        commands = []
+        if desired.sample_rate is not None and desired.sample_rate != self.sample_rate:
+            commands.append('~%d' % self._sample_rates().index(desired.sample_rate))
+        if desired.aux_mode != self.aux_mode:
+            if self.board_type == 'ganglion':
+                commands.append('n' if desired.aux_mode == 'accel' else 'N')
+            else:
+                commands.append('/%d' % CYTON_AUX_MODES.index(desired.aux_mode))
+        for i, (current, wanted) in enumerate(zip(self.channels, desired.channels)):
+            if current == wanted:
+                continue
+            if self.board_type == 'ganglion' or current.same_except_power(wanted):
+                # the single character shortcuts keep the other settings of the channel
+                commands.append(CHANNEL_ON[i] if wanted.enabled else CHANNEL_OFF[i])
+            else:
+                commands.append(wanted.command(i + 1))
+        if desired.test_signal != self.test_signal:
+            commands.append('[' if desired.test_signal else ']')
+        return commands
+
+    def update_from_commands(self, text):
+        """Updates this configuration from commands written directly to the board, so that the
+        model follows settings changed with write_command."""
+        i = 0
+        while i < len(text):
+            c = text[i]
+            if c == 'x' and i + 8 < len(text) and text[i + 8] == 'X':
+                fields = text[i + 1:i + 8]
+                channel = CHANNEL_SELECT.find(fields[0]) + 1
+                if 1 <= channel <= self.num_channels and fields[1:].isdigit():
+                    digits = [int(d) for d in fields[1:]]
+                    self.channels[channel - 1] = ChannelSettings(
+                        enabled=not digits[0], gain=GAINS[min(digits[1], len(GAINS) - 1)],
+                        input_type=min(digits[2], len(INPUT_TYPES) - 1), bias=digits[3],
+                        srb2=digits[4], srb1=digits[5])
+                i += 9
+                continue
+            if c == 'z' and i + 4 < len(text) and text[i + 4] == 'Z':
+                # lead-off settings, not part of this model
+                i += 5
+                continue
+            if c in '~/' and i + 1 < len(text) and text[i + 1].isdigit():
+                index = int(text[i + 1])
+                if c == '~' and index < len(self._sample_rates()):
+                    self.sample_rate = self._sample_rates()[index]
+                elif c == '/' and self.board_type != 'ganglion' and index < len(CYTON_AUX_MODES):
+                    self.aux_mode = CYTON_AUX_MODES[index]
+                i += 2
+                continue
+            if self.board_type == 'ganglion' and c in 'nN':
+                self.aux_mode = 'accel' if c == 'n' else None
+            elif c in CHANNEL_OFF[:self.num_channels]:
+                self.channels[CHANNEL_OFF.index(c)].enabled = False
+            elif c in CHANNEL_ON[:self.num_channels]:
+                self.channels[CHANNEL_ON.index(c)].enabled = True
+            elif c == 'd':
+                self.channels = [ChannelSettings() for _ in self.channels]
+            elif c == 'v':
+                self.__init__(self.board_type, aux_mode=self.aux_mode)
+            elif c in '[]':
+                self.test_signal = c == '['
+            i += 1
+
+    def __repr__(self):
+        return "<BoardConfig(%s, %s Hz, aux=%s, %d channels)>" % (
+            self.board_type, self.sample_rate, self.aux_mode, self.num_channels)
@@ -0,0 +1,219 @@
+"""
+Consumers of a stream running apart from the acquisition, each with its own queue and worker
+thread, so that a slow consumer never makes the board lose data, nor delays the others.
+
+A Dispatcher is a stage giving every block to its consumers. A consumer is registered with a
+policy deciding what happens when its queue is full:
+    'block': the acquisition waits for the consumer, nothing is lost, for recorders
+    'drop_oldest': the oldest queued block is dropped, for live displays
+    'drop_newest': the new block is dropped
+    'coalesce': the new block is merged into the last queued one, nothing is lost but the
+    consumer gets fewer, larger blocks (a block is never merged across a gap, a block
+    following a gap is queued over max_queue instead)
+The block following dropped ones is marked as following a gap. The lag, queue depth and drop
+counters of every consumer are available with stats().
+
+EXAMPLE USE:
+dispatcher = Dispatcher()
+dispatcher.add(recorder.write, policy='block', max_queue=1000)
+dispatcher.add(update_plot, policy='drop_oldest', max_queue=4)
+board.start_stream(SampleBlocker(dispatcher, block_size=25))
+print(dispatcher.stats())
+"""
+import collections
+import logging
+import threading
+import time
+
+from .stream import Block, concatenate_blocks
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+
+class Consumer(object):
+    """ A callback called with the blocks on a worker thread, fed through a bounded queue.
+
+    Args:
+        callback: A function called with every block.
+        policy: What to do when the queue is full, one of POLICIES.
+        max_queue: Number of blocks the queue holds.
+        name: Name of the consumer in the stats, the name of the callback by default.
+    """
+
+    def __init__(self, callback, policy='drop_oldest', max_queue=16, name=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy %s, use one of %s' % (policy, ', '.join(POLICIES)))
+        if max_queue < 1:
+            raise ValueError('max_queue must be at least 1')
+        self.callback = callback
+        self.policy = policy
+        self.max_queue = max_queue
+        self.name = name or getattr(callback, '__name__', None) or repr(callback)
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._condition = threading.Condition()
+        # [block, time queued] pairs
+        self._queue = collections.deque()
+        self._gap_next = False
+        self._closed = False
+        self._busy = False
+        self.delivered = 0
+        self.dropped = 0
+        self.dropped_samples = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.lag = 0.
+        self.max_lag = 0.
+        self.errors = 0
+        self._thread = threading.Thread(target=self._work, name='Consumer %s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drop(self, block):
+        self.dropped += 1
+        self.dropped_samples += len(block)
+
+    def put(self, block):
+        """Queues a block, following the policy when the queue is full."""
+        now = time.time()
+        with self._condition:
+            if self._closed:
+                return
+            if self._gap_next:
+                block = block.replace(gap=True)
+                self._gap_next = False
+            queue = self._queue
+            if len(queue) >= self.max_queue:
+                if self.policy == 'block':
+                    while len(queue) >= self.max_queue and not self._closed:
+                        self._condition.wait()
+                    if self._closed:
+                        return
+                elif self.policy == 'drop_newest':
+                    self._drop(block)
+                    self._gap_next = True
+                    return
+                elif self.policy == 'coalesce':
+                    if not block.gap:
+                        # the block is merged where it would have been queued, keeping its
+                        # time of arrival for the lag
+                        queue[-1][0] = concatenate_blocks([queue[-1][0], block])
+                        self.coalesced += 1
+                        return
+                    # a block following a gap cannot be merged, it is queued over max_queue
+                    # rather than dropped, the next blocks are merged into it
+                else:
+                    self._drop(queue.popleft()[0])
+                    if queue:
+                        queue[0][0] = queue[0][0].replace(gap=True)
+                    else:
+                        block = block.replace(gap=True)
+            queue.append([block, now])
+            self.max_depth = max(self.max_depth, len(queue))
+            self._condition.notify_all()
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        self.put(block)
+        return block
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                block, queued = self._queue.popleft()
+                self._busy = True
+                self.lag = time.time() - queued
+                self.max_lag = max(self.max_lag, self.lag)
+                # room for a blocked producer
+                self._condition.notify_all()
+            try:
+                self.callback(block)
+            except Exception:
+                self.errors += 1
+                self._logger.exception('Consumer %s failed on %r' % (self.name, block))
+            with self._condition:
+                self._busy = False
+                self.delivered += 1
+                self._condition.notify_all()
+
+    @property
+    def depth(self):
+        """Number of blocks waiting in the queue."""
+        return len(self._queue)
+
+    def stats(self):
+        """Returns a dict of the counters of the consumer: queue depth (and its maximum),
+        blocks delivered, dropped (and their samples) and coalesced, callback errors, and lag
+        in seconds between queuing and delivery of the last block (and its maximum)."""
+        with self._condition:
+            return dict(policy=self.policy, depth=len(self._queue), max_depth=self.max_depth,
+                        max_queue=self.max_queue, delivered=self.delivered,
+                        dropped=self.dropped, dropped_samples=self.dropped_samples,
+                        coalesced=self.coalesced, errors=self.errors, lag=self.lag,
+                        max_lag=self.max_lag, busy=self._busy)
+
+    def join(self, timeout=None):
+        """Waits until the queued blocks are delivered, returns False on timeout."""
+        end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._queue or self._busy:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, drain=True, timeout=None):
+        """Stops the worker, after delivering the queued blocks if `drain`."""
+        if drain:
+            self.join(timeout)
+        with self._condition:
+            self._closed = True
+            if not drain:
+                self._queue.clear()
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+
+class Dispatcher(object):
+    """ Stage giving every block to consumers running on their own threads, see Consumer.
+
+    Args:
+        consumers: Consumers to start with.
+    """
+
+    def __init__(self, consumers=None):
+        self.consumers = list(consumers or [])
+        self._lock = threading.Lock()
+
+    def add(self, callback, policy='drop_oldest', max_queue=16, name=None):
+        """Registers a consumer, returns its Consumer."""
+        consumer = Consumer(callback, policy, max_queue, name)
+        with self._lock:
+            self.consumers = self.consumers + [consumer]
+        return consumer
+
+    def remove(self, consumer, drain=True):
+        """Unregisters a consumer and stops its worker."""
+        with self._lock:
+            self.consumers = [c for c in self.consumers if c is not consumer]
+        consumer.close(drain)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if isinstance(block, Block):
+            for consumer in self.consumers:
+                consumer.put(block)
+        return block
+
+    def stats(self):
+        """Returns the stats of every consumer, by name."""
+        return dict((consumer.name, consumer.stats()) for consumer in self.consumers)
+
+    def close(self, drain=True, timeout=None):
+        """Stops every consumer, after delivering their queued blocks if `drain`."""
+        for consumer in self.consumers:
+            consumer.close(drain, timeout)
@@ -0,0 +1,392 @@
+"""
+Local fan-out of a board stream to other processes (recorder, visualizer, classifier...), as
+only one process can own the serial port, the Bluetooth connection or the WiFi Shield socket.
+
+BlockServer is a stage publishing every block to any number of subscribers connected to Unix
+domain and / or TCP sockets. Every block is framed once, then queued for every subscriber,
+which has its own sending thread: when a subscriber does not keep up, its queue fills up and
+its oldest (or newest) blocks are dropped, acquisition and the other subscribers go on. The
+first block a subscriber receives after dropped ones is marked as following a gap.
+BlockClient connects to a server and reassembles the Blocks.
+
+Frame (the header big endian, the arrays little endian):
+    magic 'OF', version (1 byte), kind (1 byte), length of the payload (uint32)
+    kind 0, hello, sent on connection: the description of the stream as JSON
+    kind 1, block: flags (1 byte: 1 gap, 2 aux, 4 ids, 8 timestamps, 16 float64),
+        n_samples (uint32), n_channels (uint16), n_aux (uint16),
+        data (float32 or float64), aux (same type), ids (int32), timestamps (float64)
+
+EXAMPLE USE:
+server = BlockServer(['/tmp/openbci.sock', ('127.0.0.1', 5560)], board=board)
+board.start_stream(SampleBlocker([], block_size=25, stages=[server]))
+
+# in another process
+for block in BlockClient('/tmp/openbci.sock'):
+    print(block.data.shape)
+"""
+import collections
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+
+import numpy as np
+
+from .lsl import describe_board
+from .stream import Block
+
+MAGIC = b'OF'
+VERSION = 1
+HELLO = 0
+BLOCK = 1
+_FRAME = struct.Struct('>2sBBI')
+_BLOCK = struct.Struct('>BIHH')
+# flags of the block frames
+GAP, HAS_AUX, HAS_IDS, HAS_TIMESTAMPS, DOUBLE = 1, 2, 4, 8, 16
+# offset of the flags of a block in its frame
+_FLAGS_OFFSET = _FRAME.size
+ACCEPT_INTERVAL = 0.1
+
+
+def encode_frame(block, dtype=np.float32):
+    """Returns the frame of a Block, its data and aux converted to `dtype` (float32 or
+    float64, float32 keeps the 24 bit counts exact)."""
+    dtype = np.dtype(dtype).newbyteorder('<')
+    flags = GAP if block.gap else 0
+    if dtype.itemsize == 8:
+        flags |= DOUBLE
+    parts = [np.ascontiguousarray(block.data, dtype=dtype).tobytes()]
+    num_aux = 0
+    if block.aux is not None:
+        flags |= HAS_AUX
+        num_aux = block.aux.shape[1]
+        parts.append(np.ascontiguousarray(block.aux, dtype=dtype).tobytes())
+    if block.ids is not None:
+        flags |= HAS_IDS
+        parts.append(np.asarray(block.ids, dtype='<i4').tobytes())
+    if block.timestamps is not None:
+        flags |= HAS_TIMESTAMPS
+        parts.append(np.asarray(block.timestamps, dtype='<f8').tobytes())
+    payload = _BLOCK.pack(flags, len(block), block.data.shape[1], num_aux) + b''.join(parts)
+    return _FRAME.pack(MAGIC, VERSION, BLOCK, len(payload)) + payload
+
+
+def decode_block_frame(payload, **attributes):
+    """Returns the Block of the payload of a block frame, `attributes` are given to the
+    Block."""
+    flags, count, num_channels, num_aux = _BLOCK.unpack_from(payload, 0)
+    dtype = np.dtype('<f8' if flags & DOUBLE else '<f4')
+    offset = _BLOCK.size
+
+    def take(dtype, size):
+        array = np.frombuffer(payload, dtype=dtype, count=size, offset=offset)
+        return array, offset + size * dtype.itemsize
+
+    data, offset = take(dtype, count * num_channels)
+    aux = ids = timestamps = None
+    if flags & HAS_AUX:
+        aux, offset = take(dtype, count * num_aux)
+        aux = aux.reshape(count, num_aux)
+    if flags & HAS_IDS:
+        ids, offset = take(np.dtype('<i4'), count)
+    if flags & HAS_TIMESTAMPS:
+        timestamps, offset = take(np.dtype('<f8'), count)
+    return Block(data.reshape(count, num_channels), aux=aux, ids=ids, timestamps=timestamps,
+                 gap=bool(flags & GAP), **attributes)
+
+
+def _hello_frame(description):
+    payload = json.dumps(description).encode('utf-8')
+    return _FRAME.pack(MAGIC, VERSION, HELLO, len(payload)) + payload
+
+
+def _listen(address):
+    if isinstance(address, tuple):
+        family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    else:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix domain sockets are not supported here, use (host, port)')
+        if os.path.exists(address):
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise ValueError('%s exists and is not a Unix domain socket' % address)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+                # left by a server that was not closed
+                os.unlink(address)
+            else:
+                # like a TCP port, the address of a running server is not taken over
+                raise socket.error(errno.EADDRINUSE, '%s is in use by another server' % address)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(5)
+    return listener
+
+
+def _connect(address, timeout=None):
+    if isinstance(address, tuple):
+        return socket.create_connection(address, timeout)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    client.connect(address)
+    return client
+
+
+class Subscriber(object):
+    """ Connection of a subscriber to a BlockServer, with its queue of frames and the thread
+    sending them.
+
+    Attributes:
+        address: Address of the subscriber.
+        sent: Number of blocks sent.
+        dropped: Number of blocks dropped because the subscriber did not keep up.
+    """
+
+    def __init__(self, connection, address, hello, max_queue, drop_oldest, on_close):
+        self.connection = connection
+        self.address = address
+        self.max_queue = max_queue
+        self.drop_oldest = drop_oldest
+        self.sent = 0
+        self.dropped = 0
+        self._on_close = on_close
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+        # the next block queued follows dropped ones
+        self._gap_next = False
+        self._closed = False
+        self._hello = hello
+        self._thread = threading.Thread(target=self._send_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, frame):
+        """Queues a frame, dropping one when the queue is full. Never blocks on the socket."""
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._frames) >= self.max_queue:
+                self.dropped += 1
+                if not self.drop_oldest:
+                    self._gap_next = True
+                    return
+                self._frames.popleft()
+                if self._frames:
+                    self._frames[0][1] = True
+                else:
+                    self._gap_next = True
+            self._frames.append([frame, self._gap_next])
+            self._gap_next = False
+            self._condition.notify()
+
+    def _next_frame(self):
+        with self._condition:
+            while not self._frames and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+            frame, gap = self._frames.popleft()
+            if gap:
+                # the subscriber missed blocks just before this one
+                frame = bytearray(frame)
+                frame[_FLAGS_OFFSET] |= GAP
+            return frame
+
+    def _send_loop(self):
+        try:
+            self.connection.sendall(self._hello)
+            while True:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                self.connection.sendall(frame)
+                self.sent += 1
+        except (socket.error, OSError):
+            pass
+        self.close()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.connection.close()
+        self._on_close(self)
+
+
+class BlockServer(object):
+    """ Stage publishing every block to the subscribers connected to its sockets.
+
+    Args:
+        addresses: An address, or a list of addresses, to listen on: a path for a Unix domain
+        socket, a (host, port) tuple for TCP.
+        board: The board streamed, to send its description (see describe_board) to the
+        subscribers when they connect.
+        description: A dict sent to the subscribers when they connect, instead of the
+        description of the board.
+        max_queue: Number of blocks queued for a subscriber before dropping some.
+        drop_oldest: True to drop the oldest queued block when a queue is full, False to drop
+        the new block.
+        dtype: Type of the data sent, float32 or float64.
+    """
+
+    def __init__(self, addresses, board=None, description=None, max_queue=100,
+                 drop_oldest=True, dtype=np.float32):
+        if not isinstance(addresses, list):
+            addresses = [addresses]
+        if description is None and board is not None:
+            description = describe_board(board)[0]
+        self.description = description or {}
+        self.max_queue = max_queue
+        self.drop_oldest = drop_oldest
+        self.dtype = dtype
+        self.subscribers = []
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._addresses = addresses
+        self._listeners = [_listen(address) for address in addresses]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def addresses(self):
+        """The addresses listened on, with the ports picked by the system for port 0."""
+        return [listener.getsockname() for listener in self._listeners]
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            try:
+                readable = select.select(self._listeners, [], [], ACCEPT_INTERVAL)[0]
+            except (socket.error, OSError, ValueError):
+                # listeners closed
+                break
+            for listener in readable:
+                try:
+                    connection, address = listener.accept()
+                except (socket.error, OSError):
+                    continue
+                if listener.family != getattr(socket, 'AF_UNIX', None):
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                subscriber = Subscriber(connection, address or listener.getsockname(),
+                                        _hello_frame(self.description), self.max_queue,
+                                        self.drop_oldest, self._remove)
+                with self._lock:
+                    self.subscribers.append(subscriber)
+                self._logger.info('Subscriber %s connected' % (subscriber.address,))
+
+    def _remove(self, subscriber):
+        with self._lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+                self._logger.info('Subscriber %s left, %d blocks dropped' %
+                                  (subscriber.address, subscriber.dropped))
+
+    def publish(self, block):
+        """Queues `block` for every subscriber."""
+        with self._lock:
+            subscribers = list(self.subscribers)
+        if not subscribers:
+            return
+        frame = encode_frame(block, self.dtype)
+        for subscriber in subscribers:
+            subscriber.put(frame)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        self.publish(block)
+        return block
+
+    def close(self):
+        """Disconnects the subscribers and stops listening."""
+        self._stop.set()
+        self._thread.join()
+        for listener in self._listeners:
+            listener.close()
+        for address in self._addresses:
+            if not isinstance(address, tuple) and os.path.exists(address):
+                os.unlink(address)
+        with self._lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.close()
+
+
+class BlockClient(object):
+    """ Subscriber of a BlockServer, returning the Blocks it publishes.
+
+    Args:
+        address: Address of the server, a path for a Unix domain socket or a (host, port)
+        tuple for TCP.
+        timeout: Seconds to wait for the connection and then for every block, None to wait
+        for ever.
+
+    Attributes:
+        description: The description of the stream sent by the server.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.connection = _connect(address, timeout)
+        self._header = bytearray(_FRAME.size)
+        kind, payload = self._read_frame()
+        if kind != HELLO:
+            raise ValueError('Not a BlockServer at %s' % (address,))
+        self.description = json.loads(payload.decode('utf-8'))
+
+    def _read_exactly(self, buffer):
+        view = memoryview(buffer)
+        while len(view):
+            received = self.connection.recv_into(view)
+            if received == 0:
+                return False
+            view = view[received:]
+        return True
+
+    def _read_frame(self):
+        if not self._read_exactly(self._header):
+            return None, None
+        magic, version, kind, length = _FRAME.unpack(bytes(self._header))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a frame of version %d' % VERSION)
+        payload = bytearray(length)
+        if not self._read_exactly(payload):
+            return None, None
+        return kind, payload
+
+    def read(self):
+        """Returns the next Block, None when the server closed the connection."""
+        while True:
+            kind, payload = self._read_frame()
+            if kind is None:
+                return None
+            if kind == BLOCK:
+                return decode_block_frame(payload,
+                                          board_type=self.description.get('board_type'))
+
+    def __iter__(self):
+        while True:
+            block = self.read()
+            if block is None:
+                return
+            yield block
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,203 @@
+"""
+Causal IIR filters for the streams of the boards, processing a whole block of samples of every
+channel per call.
+
+The filters are cascades of second-order sections (SOS, one row [b0, b1, b2, 1, a1, a2] per
+section, as in scipy.signal). Their state is carried from one block to the next, so filtering
+a stream block by block gives the same result as filtering it at once, and is started again
+on the blocks following a gap. scipy.signal.sosfilt is used when SciPy is installed, the same
+filter is computed with NumPy otherwise.
+
+EXAMPLE USE:
+filters = IIRFilter.notch(50, sample_rate=250).then(IIRFilter.bandpass(1, 40, sample_rate=250))
+board.start_stream(SampleBlocker(print_block, block_size=25, stages=[filters], id_step=1))
+"""
+import numpy as np
+
+try:
+    from scipy import signal as _signal
+except ImportError:
+    _signal = None
+
+from .stream import Block
+
+
+def notch_sos(frequency, sample_rate, quality=30.):
+    """Second-order notch filter removing `frequency` (e.g. 50 or 60 Hz mains), `quality` is
+    the frequency divided by the -3 dB bandwidth."""
+    w0 = 2 * np.pi * frequency / sample_rate
+    beta = np.tan(w0 / quality / 2)
+    gain = 1 / (1 + beta)
+    return np.array([[gain, -2 * gain * np.cos(w0), gain,
+                      1., -2 * gain * np.cos(w0), 2 * gain - 1]])
+
+
+def butter_sos(order, cutoff, sample_rate, btype='lowpass'):
+    """Butterworth 'lowpass' or 'highpass' filter of `order` with a -3 dB `cutoff` in Hz,
+    designed with the bilinear transform."""
+    if btype not in ('lowpass', 'highpass'):
+        raise ValueError('Filter type %s is not supported' % btype)
+    if not 0 < cutoff < sample_rate / 2.:
+        raise ValueError('Cutoff %s Hz is not between 0 and %s Hz' % (cutoff, sample_rate / 2.))
+    fs2 = 2. * sample_rate
+    warped = fs2 * np.tan(np.pi * cutoff / sample_rate)
+    # zeros at z = -1 for a lowpass, z = 1 for a highpass
+    sign = 1. if btype == 'lowpass' else -1.
+    sections = []
+    for k in range(order // 2):
+        pole = np.exp(1j * np.pi * (2 * k + order + 1) / (2. * order))
+        s = pole * warped if btype == 'lowpass' else warped / pole
+        z = (fs2 + s) / (fs2 - s)
+        a = [1., -2 * z.real, abs(z) ** 2]
+        b = [1., 2 * sign, 1.]
+        sections.append(b + a)
+    if order % 2:
+        z = (fs2 - warped) / (fs2 + warped)
+        sections.append([1., sign, 0., 1., -z, 0.])
+    sos = np.array(sections)
+    # unit gain at DC for a lowpass, at Nyquist for a highpass
+    for section in sos:
+        point = 1. if btype == 'lowpass' else -1.
+        b = section[0] + section[1] * point + section[2]
+        a = section[3] + section[4] * point + section[5]
+        section[:3] *= a / b
+    return sos
+
+
+def sos_steady_state(sos):
+    """State of every section, of shape (n_sections, 2), once a constant input of 1 has gone
+    through the filter for long enough; scale it by the first sample to start without a
+    transient."""
+    zi = np.zeros((len(sos), 2))
+    scale = 1.
+    for i, (b0, b1, b2, a0, a1, a2) in enumerate(sos):
+        dc_gain = (b0 + b1 + b2) / (a0 + a1 + a2)
+        # transposed direct form II: y = b0 x + z0, z0 = b1 x - a1 y + z1, z1 = b2 x - a2 y
+        z1 = b2 - a2 * dc_gain
+        z0 = b1 - a1 * dc_gain + z1
+        zi[i] = scale * np.array([z0, z1])
+        scale *= dc_gain
+    return zi
+
+
+def _sosfilt(sos, data, zi):
+    """Filters `data` of shape (n_samples, n_channels) with state `zi` of shape
+    (n_sections, 2, n_channels), in place of scipy.signal.sosfilt."""
+    y = data.copy()
+    for i, (b0, b1, b2, _, a1, a2) in enumerate(sos):
+        z0, z1 = zi[i, 0], zi[i, 1]
+        for n in range(len(y)):
+            x = y[n]
+            out = b0 * x + z0
+            z0 = b1 * x - a1 * out + z1
+            z1 = b2 * x - a2 * out
+            y[n] = out
+        zi[i, 0], zi[i, 1] = z0, z1
+    return y, zi
+
+
+# blocks up to this length are filtered with precomputed matrices when SciPy is not installed
+MAX_MATRIX_BLOCK = 256
+
+
+def _block_matrices(sos, length):
+    """Matrices filtering a block of `length` samples of any number of channels at once:
+    y = T x + O zi and zi' = B x + A zi, with zi flattened to (2 n_sections, n_channels)."""
+    size = 2 * len(sos)
+    # impulse on every sample of the block, from a zero state
+    impulses, states = _sosfilt(sos, np.eye(length), np.zeros((len(sos), 2, length)))
+    # unit value in every state variable, with no input
+    free, free_states = _sosfilt(sos, np.zeros((length, size)),
+                                 np.eye(size).reshape(len(sos), 2, size))
+    return (impulses, free, states.reshape(size, length), free_states.reshape(size, size))
+
+
+class IIRFilter(object):
+    """ Causal filter stage applying second-order sections to every channel of a block.
+
+    Args:
+        sos: An array of shape (n_sections, 6), see notch_sos and butter_sos.
+        steady_start: True to start (and restart after a gap) as if the first sample had always
+        been there, so that the large DC offsets of the raw EEG data do not ring through the
+        filter. False to start from a zero state.
+    """
+
+    def __init__(self, sos, steady_start=True):
+        self.sos = np.atleast_2d(np.asarray(sos, dtype=np.float64))
+        if self.sos.shape[1] != 6:
+            raise ValueError('Second-order sections must have 6 coefficients')
+        self.steady_start = steady_start
+        self._zi_unit = sos_steady_state(self.sos)
+        self.zi = None
+        self._matrices = {}
+
+    @classmethod
+    def notch(cls, frequency, sample_rate, quality=30., harmonics=1, **kwargs):
+        """Notch filter removing `frequency` and its first `harmonics` - 1 harmonics."""
+        sos = [notch_sos(frequency * h, sample_rate, quality)
+               for h in range(1, harmonics + 1) if frequency * h < sample_rate / 2.]
+        return cls(np.vstack(sos), **kwargs)
+
+    @classmethod
+    def bandpass(cls, low, high, sample_rate, order=4, **kwargs):
+        """Butterworth bandpass filter, as a highpass at `low` Hz followed by a lowpass at
+        `high` Hz, each of `order`."""
+        return cls(np.vstack([butter_sos(order, low, sample_rate, 'highpass'),
+                              butter_sos(order, high, sample_rate, 'lowpass')]), **kwargs)
+
+    @classmethod
+    def highpass(cls, cutoff, sample_rate, order=4, **kwargs):
+        return cls(butter_sos(order, cutoff, sample_rate, 'highpass'), **kwargs)
+
+    @classmethod
+    def lowpass(cls, cutoff, sample_rate, order=4, **kwargs):
+        return cls(butter_sos(order, cutoff, sample_rate, 'lowpass'), **kwargs)
+
+    def then(self, other):
+        """Returns a single filter applying this filter then `other`."""
+        return IIRFilter(np.vstack([self.sos, other.sos]), self.steady_start)
+
+    def reset(self):
+        """Forgets the state, the next block is filtered as the start of a new stream."""
+        self.zi = None
+
+    def _initial_state(self, first):
+        if not self.steady_start:
+            return np.zeros((len(self.sos), 2, len(first)))
+        return self._zi_unit[:, :, np.newaxis] * first[np.newaxis, np.newaxis, :]
+
+    def filter(self, data, gap=False):
+        """Filters `data` of shape (n_samples, n_channels), continuing from the previous call
+        unless `gap` is True."""
+        data = np.asarray(data, dtype=np.float64)
+        if len(data) == 0:
+            return data
+        if gap or self.zi is None or self.zi.shape[2] != data.shape[1]:
+            self.zi = self._initial_state(data[0])
+        if _signal is not None:
+            filtered, self.zi = _signal.sosfilt(self.sos, data, axis=0, zi=self.zi)
+        elif len(data) <= MAX_MATRIX_BLOCK:
+            filtered = self._filter_matrices(data)
+        else:
+            filtered, self.zi = _sosfilt(self.sos, data, self.zi)
+        return filtered
+
+    def _filter_matrices(self, data):
+        """The blocks of a stream mostly have the same length, the filter is then two matrix
+        products per block instead of a loop over the samples."""
+        matrices = self._matrices.get(len(data))
+        if matrices is None:
+            if len(self._matrices) > 8:
+                self._matrices.clear()
+            matrices = self._matrices[len(data)] = _block_matrices(self.sos, len(data))
+        impulses, free, states, free_states = matrices
+        zi = self.zi.reshape(-1, data.shape[1])
+        filtered = impulses.dot(data) + free.dot(zi)
+        self.zi = (states.dot(data) + free_states.dot(zi)).reshape(self.zi.shape)
+        return filtered
+
+    def __call__(self, block):
+        """Filters a Block, or an array of shape (n_samples, n_channels)."""
+        if isinstance(block, Block):
+            return block.replace(data=self.filter(block.data, block.gap))
+        return self.filter(block)
@@ -0,0 +1,124 @@
+"""
+Electrode impedance of the Cyton (serial or WiFi Shield), from its lead-off response.
+
+In lead-off mode the ADS1299 drives a 6 nA AC current at 31.25 Hz (31.2 Hz in the datasheet)
+through the electrodes of the selected channels, all channels can be driven at the same time.
+The voltage at that frequency, followed with a lock-in (StreamingDFT) over the blocks of the
+stream, divided by the current gives the impedance of the electrode plus the 2.2 kOhms series
+resistor of the board, which is removed.
+
+The Ganglion measures its impedances itself, see OpenBCIGanglion.measure_impedance.
+
+EXAMPLE USE:
+impedances = board.measure_impedance(seconds=2)  # {channel: Ohms}
+"""
+import numpy as np
+
+from .config import CHANNEL_SELECT
+from .spectral import StreamingDFT
+from .stream import Block, SampleBlocker, _as_list
+
+# ADS1299 AC lead-off excitation, fCLK / 2 ** 17
+LEAD_OFF_FREQUENCY = 4.096e6 / 2 ** 17
+LEAD_OFF_CURRENT = 6e-9  # Amperes
+# resistor in series with every electrode input of the Cyton
+SERIES_RESISTANCE = 2200.  # Ohms
+
+
+def lead_off_commands(channels, enabled=True, p_input=True, n_input=False):
+    """Returns the z...Z commands driving (or no longer driving) the lead-off current through
+    the P (electrode) and / or N (reference) input of `channels` (1 based)."""
+    return ['z%s%d%dZ' % (CHANNEL_SELECT[channel - 1], enabled and p_input, enabled and n_input)
+            for channel in channels]
+
+
+class ImpedanceEstimator(object):
+    """ Stage estimating the impedance of every channel from the lead-off response.
+
+    Args:
+        sample_rate: Sample rate of the stream in Hz.
+        volts_per_unit: Volts per unit of the data, a number or an array with one value per
+        channel: 1e-6 for data in uVolts (scaled=True), board.config.scale_factors() * 1e-6 for
+        raw counts, 1 for the WiFi Shield.
+        frequency: Frequency of the lead-off current in Hz.
+        current: Amplitude of the lead-off current in Amperes.
+        series_resistance: Resistance in Ohms removed from the estimates.
+        settle_seconds: Time ignored after the start (or a gap), while the lead-off current
+        settles.
+    """
+
+    def __init__(self, sample_rate, volts_per_unit=1e-6, frequency=LEAD_OFF_FREQUENCY,
+                 current=LEAD_OFF_CURRENT, series_resistance=SERIES_RESISTANCE,
+                 settle_seconds=0.2):
+        self.sample_rate = sample_rate
+        self.volts_per_unit = np.asarray(volts_per_unit, dtype=np.float64)
+        self.current = current
+        self.series_resistance = series_resistance
+        self.settle = int(settle_seconds * sample_rate)
+        self._lock_in = StreamingDFT([frequency], sample_rate)
+        self.reset()
+
+    def reset(self):
+        """Starts the estimation again, e.g. after a gap in the stream."""
+        self._lock_in.reset()
+        self._skipped = 0
+
+    @property
+    def count(self):
+        """Number of samples the estimates are made of."""
+        return self._lock_in.count
+
+    def update(self, data):
+        """Adds samples, an array of shape (n_samples, n_channels)."""
+        if self._skipped < self.settle:
+            skip = min(self.settle - self._skipped, len(data))
+            self._skipped += skip
+            data = data[skip:]
+        self._lock_in.update(data)
+
+    def impedances(self):
+        """Impedance of every channel in Ohms, None before any sample."""
+        amplitudes = self._lock_in.amplitudes()
+        if amplitudes is None:
+            return None
+        volts = amplitudes[0] * self.volts_per_unit
+        return np.maximum(volts / self.current - self.series_resistance, 0.)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if isinstance(block, Block):
+            if block.gap:
+                self.reset()
+            self.update(block.data)
+        else:
+            self.update(np.asarray(block, dtype=np.float64))
+        return block
+
+
+class ImpedanceTap(object):
+    """ Callback for start_stream estimating the impedances from the samples and filling the
+    imp_data of every sample with the latest estimates (an array in Ohms, empty until the first
+    estimate), before calling `callback`.
+
+    Args:
+        callback: A function, or a list of functions, called with every sample.
+        estimator: An ImpedanceEstimator.
+        block_size: Number of samples between two updates of the estimates.
+    """
+
+    def __init__(self, callback, estimator, block_size=25):
+        self.callbacks = _as_list(callback)
+        self.estimator = estimator
+        self.latest = []
+        self._blocker = SampleBlocker(self._update, block_size, stages=[estimator])
+
+    def _update(self, block):
+        impedances = self.estimator.impedances()
+        if impedances is not None and self.estimator.count:
+            self.latest = impedances
+
+    def __call__(self, sample):
+        self._blocker(sample)
+        sample.imp_data = self.latest
+        for call in self.callbacks:
+            call(sample)
@@ -0,0 +1,156 @@
+"""
+End-to-end latency of the acquisition, for closed-loop applications: the delay from a sample
+entering the host to a consumer being done with it, and how it varies.
+
+The drivers stamp every sample with the time.time() at which it was read from the serial
+port, the Bluetooth notification or the socket (`sample.arrival`), and SampleBlocker keeps
+these stamps as the timestamps of the blocks. A LatencyMonitor records the delay from the
+arrival of every sample of the blocks it sees to now: as the last stage of a SampleBlocker it
+measures when the blocks are ready for the consumers (mostly the wait for a block to fill),
+wrapped around a consumer when that consumer is done. A LatencyHarness keeps the monitors of
+several boards and consumers and reports their percentiles.
+
+Stages replacing the timestamps (ClockDejitter) must come after the monitors, the delays would
+be measured from the fitted times otherwise. Examples/benchmark_latency.py compares block
+sizes, WiFi Shield latencies and threading modes on simulated boards or a replayed capture.
+
+EXAMPLE USE:
+harness = LatencyHarness()
+dispatcher = Dispatcher()
+dispatcher.add(harness.wrap('cyton', 'feedback', feedback), policy='drop_oldest')
+dispatcher.add(harness.wrap('cyton', 'recorder', recorder.write), policy='block')
+board.start_stream(SampleBlocker(dispatcher, 25, stages=[harness.monitor('cyton')]))
+print(harness.report())
+"""
+import collections
+import threading
+import time
+
+import numpy as np
+
+# upper bounds in seconds of the buckets of the histograms, from 0.25 ms to about 2 s
+LATENCY_BUCKETS = tuple(0.00025 * 2 ** k for k in range(14))
+
+
+class LatencyMonitor(object):
+    """ Records the delays from the arrival of the samples of the blocks to now, the most
+    recent `capacity` are kept.
+
+    Attributes:
+        recorded: Number of delays recorded, including the ones not kept.
+    """
+
+    def __init__(self, capacity=100000):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self._latencies = np.zeros(capacity)
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def record(self, arrivals, now=None):
+        """Records the delays from `arrivals`, time.time() values, to `now` (time.time() if
+        None)."""
+        if now is None:
+            now = time.time()
+        latencies = now - np.asarray(arrivals, dtype=np.float64).ravel()
+        count = len(latencies)
+        capacity = self.capacity
+        if count > capacity:
+            latencies = latencies[-capacity:]
+        n = len(latencies)
+        with self._lock:
+            # the delays that did not fit are skipped
+            position = (self.recorded + count - n) % capacity
+            first = min(n, capacity - position)
+            self._latencies[position:position + first] = latencies[:first]
+            self._latencies[:n - first] = latencies[first:]
+            self.recorded += count
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if block.timestamps is not None:
+            self.record(block.timestamps)
+        return block
+
+    def wrap(self, callback):
+        """Returns `callback` recording the delays of the samples of every block it is done
+        with."""
+        def wrapped(block):
+            result = callback(block)
+            if block.timestamps is not None:
+                self.record(block.timestamps)
+            return result
+        return wrapped
+
+    def latencies(self):
+        """Returns the delays kept, in seconds, in no particular order."""
+        with self._lock:
+            return self._latencies[:min(self.recorded, self.capacity)].copy()
+
+    def clear(self):
+        """Forgets the delays recorded so far."""
+        with self._lock:
+            self.recorded = 0
+
+    def stats(self):
+        """Returns a dict of statistics of the delays kept, in seconds: count, mean, p50, p95,
+        p99, max, and the histogram as `buckets`, a list of (upper bound, count) with None for
+        the last bound. None when nothing was recorded."""
+        latencies = self.latencies()
+        if not len(latencies):
+            return None
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies),
+                             minlength=len(LATENCY_BUCKETS) + 1)
+        return dict(count=len(latencies), mean=float(latencies.mean()), p50=float(p50),
+                    p95=float(p95), p99=float(p99), max=float(latencies.max()),
+                    buckets=list(zip(list(LATENCY_BUCKETS) + [None], counts.tolist())))
+
+
+class LatencyHarness(object):
+    """ LatencyMonitors of several boards and consumers, see monitor and wrap.
+
+    Args:
+        capacity: Number of delays kept by every monitor.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        # (board, consumer): LatencyMonitor, in the order they were created
+        self.monitors = collections.OrderedDict()
+
+    def monitor(self, board, consumer=None):
+        """Returns the monitor of `consumer` of `board`, created if needed. Without a consumer,
+        the monitor of the blocks of the board, to use as the last stage of its SampleBlocker."""
+        key = (board, consumer)
+        monitor = self.monitors.get(key)
+        if monitor is None:
+            monitor = self.monitors[key] = LatencyMonitor(self.capacity)
+        return monitor
+
+    def wrap(self, board, consumer, callback):
+        """Returns `callback` recording the delays of the consumer `consumer` of `board`."""
+        return self.monitor(board, consumer).wrap(callback)
+
+    def clear(self):
+        """Forgets the delays recorded so far, e.g. after warming up."""
+        for monitor in self.monitors.values():
+            monitor.clear()
+
+    def stats(self):
+        """Returns the stats of every monitor, by (board, consumer)."""
+        return collections.OrderedDict((key, monitor.stats())
+                                       for key, monitor in self.monitors.items())
+
+    def report(self):
+        """Returns the percentiles of every monitor as a text table, in milliseconds."""
+        lines = ['%-12s %-14s %9s %8s %8s %8s %8s' %
+                 ('board', 'consumer', 'samples', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+        for (board, consumer), stats in self.stats().items():
+            if stats is None:
+                continue
+            lines.append('%-12s %-14s %9d %8.2f %8.2f %8.2f %8.2f' % (
+                board, consumer if consumer is not None else '(blocks)', stats['count'],
+                stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3, stats['max'] * 1e3))
+        return '\n'.join(lines)
@@ -0,0 +1,189 @@
+"""
+Lab Streaming Layer outlet for the boards, pushing a chunk per block instead of a sample at a
+time.
+
+LSLSink describes the streams from the board itself: number of channels, sample rate, labels,
+units and gains of the channels, and pushes the channels data in uVolts, and the accelerometer
+data in G when the board has one, whatever the scaling of the board. Each block is pushed
+with a single push_chunk, stamped with the arrival times of its samples fitted on a straight
+line (ClockDejitter) to remove the jitter of the serial port, Bluetooth or network buffering.
+
+pylsl is only needed for the real outlets, MemoryOutlet keeps the chunks in memory instead,
+e.g. to test a pipeline without pylsl or a network.
+
+EXAMPLE USE:
+board = OpenBCICyton(daisy=True)
+sink = LSLSink(board)
+board.start_stream(sink.blocker())
+"""
+import time
+
+import numpy as np
+
+from .stream import Block, ClockDejitter, SampleBlocker
+
+try:
+    import pylsl
+except ImportError:
+    pylsl = None
+
+ACCEL_LABELS = ['AccelX', 'AccelY', 'AccelZ']
+# duration of the chunks pushed by default, in seconds
+DEFAULT_CHUNK_SECONDS = 0.04
+
+
+def local_clock():
+    """Clock of the LSL timestamps, time.time() when pylsl is not installed."""
+    if pylsl is None:
+        return time.time()
+    return pylsl.local_clock()
+
+
+def describe_board(board, name=None, source_id=None):
+    """Returns the descriptions of the EEG stream and of the aux stream of `board` (None
+    without accelerometer, or on the WiFi Shield): dicts of the arguments of a pylsl
+    StreamInfo, plus the 'channels' of the stream with their label, unit, type and gain."""
+    config = getattr(board, 'config', None)
+    if config is None:
+        raise ValueError('The board type is not known, connect the board first')
+    board_type = config.board_type
+    wifi = hasattr(board, 'getSampleRate')
+    if wifi:
+        # WiFi Shield, the daisy samples are sent at the rate of the board
+        sample_rate = board.getSampleRate()
+        if not sample_rate:
+            raise ValueError('Set the sample rate of the WiFi Shield to stream it')
+    else:
+        # the serial port sends the Cyton and Daisy samples one after the other
+        sample_rate = config.sample_rate / (2. if board_type == 'daisy' else 1.)
+    name = name or 'OpenBCI%s' % board_type.capitalize()
+    source_id = source_id or 'OpenBCI%s%s' % (board_type.capitalize(),
+                                              getattr(board, 'ip_address', None) or
+                                              getattr(board, 'port', None) or
+                                              getattr(board, 'mac_address', None) or '')
+    eeg = dict(name=name + 'EEG', type='EEG', channel_count=config.num_channels,
+               nominal_srate=float(sample_rate), channel_format='float32',
+               source_id=source_id + 'EEG', board_type=board_type,
+               channels=[dict(label='Ch%d' % (channel + 1), unit='microvolts', type='EEG',
+                              gain=gain) for channel, gain in enumerate(config.gains)])
+    # the WiFi Shield keeps the accelerometer data apart from the aux data of its samples
+    if config.aux_mode != 'accel' or wifi:
+        return eeg, None
+    aux = dict(eeg, name=name + 'AUX', type='Accelerometer', channel_count=len(ACCEL_LABELS),
+               source_id=source_id + 'AUX',
+               channels=[dict(label=label, unit='g', type='Accelerometer')
+                         for label in ACCEL_LABELS])
+    return eeg, aux
+
+
+def _pylsl_outlet(description, chunk_size=0, max_buffered=360):
+    if pylsl is None:
+        raise ImportError('pylsl is needed for LSL outlets, install it with pip install pylsl')
+    info = pylsl.StreamInfo(description['name'], description['type'],
+                            description['channel_count'], description['nominal_srate'],
+                            description['channel_format'], description['source_id'])
+    desc = info.desc()
+    desc.append_child_value('manufacturer', 'OpenBCI')
+    desc.append_child_value('board', description['board_type'])
+    channels = desc.append_child('channels')
+    for channel in description['channels']:
+        element = channels.append_child('channel')
+        for key, value in sorted(channel.items()):
+            element.append_child_value(key, str(value))
+    return pylsl.StreamOutlet(info, chunk_size, max_buffered)
+
+
+class MemoryOutlet(object):
+    """ Stand-in for a pylsl StreamOutlet keeping the chunks pushed in memory.
+
+    Attributes:
+        description: The description of the stream, see describe_board.
+        chunks: The (data, timestamp) pushed, timestamp being the time of the last sample.
+    """
+
+    def __init__(self, description):
+        self.description = description
+        self.chunks = []
+
+    def push_chunk(self, x, timestamp=0.0, pushthrough=True):
+        self.chunks.append((np.array(x), timestamp))
+
+    def have_consumers(self):
+        return True
+
+    def data(self):
+        """All the samples pushed, an array of shape (n_samples, n_channels)."""
+        if not self.chunks:
+            return np.zeros((0, self.description['channel_count']), dtype=np.float32)
+        return np.concatenate([chunk for chunk, _ in self.chunks])
+
+
+class LSLSink(object):
+    """ Stage pushing every block to an LSL outlet, and its aux data to a second one.
+
+    Args:
+        board: The board streamed, an OpenBCICyton, OpenBCIGanglion or connected OpenBCIWiFi.
+        name: Prefix of the names of the streams, OpenBCI<board type> by default.
+        source_id: Prefix of the source ids of the streams, from the board type and port or
+        address by default.
+        aux: False to leave the accelerometer data out.
+        outlet_factory: A function taking the description of a stream (see describe_board) and
+        returning an outlet, MemoryOutlet to test without pylsl. pylsl outlets by default.
+        dejitter: False to keep the arrival times of the samples as timestamps.
+    """
+
+    def __init__(self, board, name=None, source_id=None, aux=True, outlet_factory=None,
+                 dejitter=True):
+        self.board = board
+        self.description, self.aux_description = describe_board(board, name, source_id)
+        if not aux:
+            self.aux_description = None
+        factory = outlet_factory or _pylsl_outlet
+        self.outlet = factory(self.description)
+        self.aux_outlet = factory(self.aux_description) if self.aux_description else None
+        self.sample_rate = self.description['nominal_srate']
+        self.clock = ClockDejitter(self.sample_rate) if dejitter else None
+        self.clock_offset = local_clock() - time.time()
+
+    def _scales(self):
+        """Factors bringing the data of the board to uVolts and G."""
+        config = self.board.config
+        if hasattr(self.board, 'getSampleRate'):
+            # the WiFi Shield parser outputs Volts
+            return 1e6, 1.
+        if getattr(self.board, 'scaled', False):
+            return 1., 1.
+        return config.scale_factors(), config.accel_scale
+
+    def blocker(self, block_size=None, stages=None):
+        """Returns the SampleBlocker to give to start_stream, making blocks of `block_size`
+        samples (DEFAULT_CHUNK_SECONDS of data by default) and applying `stages` before pushing
+        them."""
+        if block_size is None:
+            block_size = max(1, int(round(self.sample_rate * DEFAULT_CHUNK_SECONDS)))
+        id_step = None
+        if not hasattr(self.board, 'getSampleRate') and \
+                self.description['board_type'] in ('cyton', 'daisy'):
+            id_step = 2 if self.description['board_type'] == 'daisy' else 1
+        return SampleBlocker(self, block_size, stages=stages, id_step=id_step)
+
+    def push(self, block):
+        """Pushes the data of `block` as a chunk, and its aux data."""
+        if len(block) == 0:
+            return
+        timestamps = block.timestamps
+        if self.clock is not None:
+            timestamps = self.clock.timestamps(timestamps, block.gap)
+        # LSL stamps a chunk with the time of its last sample, on its own clock
+        timestamp = float(timestamps[-1]) + self.clock_offset
+        data_scale, aux_scale = self._scales()
+        self.outlet.push_chunk(np.asarray(block.data * data_scale, dtype=np.float32), timestamp)
+        if self.aux_outlet is not None and block.aux is not None:
+            self.aux_outlet.push_chunk(np.asarray(block.aux * aux_scale, dtype=np.float32),
+                                       timestamp)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if isinstance(block, Block):
+            self.push(block)
+        return block
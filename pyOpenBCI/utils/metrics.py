@@ -0,0 +1,190 @@
+"""
+Runtime metrics of the boards, to watch acquisition nodes in production.
+
+Every board keeps a StreamStats, updated by its driver as it reads and decodes the stream,
+and returns a snapshot of it with board.stats(): cumulative counters (bytes read, read calls
+and their sizes, frames decoded, bytes skipped to resync, id gaps and lost samples, bad stop
+bytes, reconnects, time spent decoding and in the callbacks) and gauges (queue depth,
+effective sample rate). The counters are never reset.
+
+MetricsServer serves the stats of any number of boards over HTTP in the Prometheus text
+format, for fleet dashboards to scrape.
+
+EXAMPLE USE:
+print(board.stats()['lost_samples'])
+
+server = MetricsServer({'cyton': board}, ('0.0.0.0', 9108))  # http://host:9108/metrics
+"""
+import bisect
+import threading
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds in bytes of the buckets of the read size histogram
+READ_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+# seconds over which the effective sample rate is measured
+RATE_WINDOW = 1.
+
+# (name, Prometheus type, help) of the metrics of a snapshot
+METRICS = [
+    ('bytes_read', 'counter', 'Bytes read from the board'),
+    ('reads', 'counter', 'Read calls, or notifications, returning data'),
+    ('frames', 'counter', 'Packets decoded'),
+    ('resync_bytes', 'counter', 'Bytes skipped to find the start of a packet again'),
+    ('id_gaps', 'counter', 'Jumps in the packet ids'),
+    ('lost_samples', 'counter', 'Samples missing in the id jumps'),
+    ('bad_stop_bytes', 'counter', 'Packets dropped for a wrong stop byte'),
+    ('reconnects', 'counter', 'Reconnections to the board'),
+    ('samples', 'counter', 'Samples given to the callbacks'),
+    ('decode_seconds', 'counter', 'Time spent decoding packets'),
+    ('callback_seconds', 'counter', 'Time spent in the callbacks'),
+    ('queue_depth', 'gauge', 'Data received and not processed yet'),
+    ('sample_rate', 'gauge', 'Samples per second given to the callbacks'),
+]
+
+
+class StreamStats(object):
+    """ Counters of the stream of a board, updated by its driver, see board.stats()."""
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.reads = 0
+        self.read_sizes = [0] * (len(READ_SIZE_BUCKETS) + 1)
+        self.frames = 0
+        self.resync_bytes = 0
+        self.id_gaps = 0
+        self.lost_samples = 0
+        self.bad_stop_bytes = 0
+        self.reconnects = 0
+        self.samples = 0
+        self.decode_seconds = 0.
+        self.callback_seconds = 0.
+        self.sample_rate = 0.
+        self._last_id = None
+        self._rate_start = None
+        self._rate_samples = 0
+
+    def read(self, size):
+        """Counts a read of `size` bytes."""
+        self.reads += 1
+        self.bytes_read += size
+        self.read_sizes[bisect.bisect_left(READ_SIZE_BUCKETS, size)] += 1
+
+    def packet_id(self, packet_id, samples_per_packet=1, modulo=256):
+        """Counts a decoded packet and the packets missing before it, from its id."""
+        self.frames += 1
+        if self._last_id is not None:
+            lost = (packet_id - self._last_id - 1) % modulo
+            if lost:
+                self.id_gaps += 1
+                self.lost_samples += lost * samples_per_packet
+        self._last_id = packet_id
+
+    def restart_ids(self):
+        """The next packet id does not follow the previous one, e.g. after a reconnection."""
+        self._last_id = None
+
+    def delivered(self, count, seconds, now=None):
+        """Counts `count` samples given to the callbacks in `seconds`."""
+        self.samples += count
+        self.callback_seconds += seconds
+        now = timeit.default_timer() if now is None else now
+        if self._rate_start is None:
+            self._rate_start = now
+            self._rate_samples = self.samples
+        elif now - self._rate_start >= RATE_WINDOW:
+            self.sample_rate = (self.samples - self._rate_samples) / (now - self._rate_start)
+            self._rate_start = now
+            self._rate_samples = self.samples
+
+    def snapshot(self, queue_depth=0):
+        """Returns the counters and gauges as a dict, with the read size histogram as
+        `read_sizes`: a list of (upper bound in bytes, count) with None for the last bound."""
+        values = dict((name, getattr(self, name)) for name, kind, _ in METRICS
+                      if name != 'queue_depth')
+        values['queue_depth'] = queue_depth
+        values['read_sizes'] = list(zip(list(READ_SIZE_BUCKETS) + [None], self.read_sizes))
+        return values
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+def prometheus_text(snapshots, prefix='openbci'):
+    """Returns the Prometheus text exposition of `snapshots`, a dict of board name: stats()."""
+    lines = []
+    for name, kind, description in METRICS:
+        metric = '%s_%s%s' % (prefix, name, '_total' if kind == 'counter' else '')
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for board, snapshot in sorted(snapshots.items()):
+            lines.append('%s{%s} %r' % (metric, _labels({'board': board}), snapshot[name]))
+    metric = '%s_read_size_bytes' % prefix
+    lines.append('# HELP %s Size of the reads' % metric)
+    lines.append('# TYPE %s histogram' % metric)
+    for board, snapshot in sorted(snapshots.items()):
+        cumulative = 0
+        for bound, count in snapshot['read_sizes']:
+            cumulative += count
+            labels = _labels({'board': board, 'le': '+Inf' if bound is None else bound})
+            lines.append('%s_bucket{%s} %d' % (metric, labels, cumulative))
+        labels = _labels({'board': board})
+        lines.append('%s_sum{%s} %d' % (metric, labels, snapshot['bytes_read']))
+        lines.append('%s_count{%s} %d' % (metric, labels, snapshot['reads']))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    """ HTTP server exposing the stats of boards at /metrics, in the Prometheus text format,
+    on a thread of its own.
+
+    Args:
+        boards: A dict of name: board, the name labels the metrics of the board. Anything
+        with a stats() method returning a StreamStats snapshot can be given.
+        address: (host, port) to listen on, port 0 to let the system pick one (see address).
+        prefix: Prefix of the metric names.
+    """
+
+    def __init__(self, boards, address=('127.0.0.1', 9108), prefix='openbci'):
+        self.boards = boards
+        self.prefix = prefix
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer(address, Handler)
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def render(self):
+        """Returns the current metrics of the boards in the Prometheus text format."""
+        return prometheus_text(dict((name, board.stats()) for name, board in
+                                    self.boards.items()), self.prefix)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,188 @@
+"""
+Profiling of the stages of the acquisition, to find where the time goes when the throughput
+drops: reading the serial port or the socket, decoding the packets, merging the daisy samples,
+or the callbacks.
+
+A Profiler given to a board with set_profiler records a span, start and duration in
+nanoseconds, for every stage of every packet. The spans go into preallocated arrays used as a
+circular buffer, the oldest spans are overwritten once it is full. Without a profiler the
+drivers only test that there is none. The spans are exported as a latency histogram per stage
+(stats, report) and as a Chrome trace (write_chrome_trace), to open in chrome://tracing or
+https://ui.perfetto.dev.
+
+Stages recorded by the drivers:
+    Cyton: read, decode, scale, daisy, callback
+    Ganglion: wait (for the Bluetooth notifications), decode, callback
+    WiFi Shield: read, decode, daisy, callback
+
+EXAMPLE USE:
+profiler = Profiler()
+board.set_profiler(profiler)
+board.start_stream(SampleBlocker(callback, 25, stages=[profiler.wrap('filter', iir)]))
+print(profiler.report())
+profiler.write_chrome_trace('trace.json')
+"""
+import array
+import itertools
+import json
+import os
+import timeit
+
+import numpy as np
+
+try:
+    from time import perf_counter_ns as clock_ns
+except ImportError:
+    def clock_ns():
+        return int(timeit.default_timer() * 1e9)
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+# upper bounds in nanoseconds of the buckets of the histograms, from 1 us to about 1 s
+HISTOGRAM_BUCKETS = tuple(2 ** k for k in range(10, 31))
+
+
+class Profiler(object):
+    """ Records spans of the stages of the acquisition into a preallocated circular buffer.
+
+    Args:
+        capacity: Number of spans kept, the oldest are overwritten.
+
+    Attributes:
+        recorded: Number of spans recorded, including the overwritten ones.
+    """
+
+    def __init__(self, capacity=100000):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self._names = []
+        self._ids = {}
+        self._stages = array.array('h', [0]) * capacity
+        self._starts = array.array('q', [0]) * capacity
+        self._durations = array.array('q', [0]) * capacity
+        self._threads = array.array('Q', [0]) * capacity
+        # next() on a count is atomic, spans recorded by several threads never collide
+        self._counter = itertools.count()
+        self.recorded = 0
+        self.origin = clock_ns()
+
+    def _stage_id(self, name):
+        stage = self._ids.get(name)
+        if stage is None:
+            stage = self._ids[name] = len(self._names)
+            self._names.append(name)
+        return stage
+
+    def record(self, name, start, end=None):
+        """Records a span of the stage `name`, from `start` to `end` (clock_ns() values, now if
+        None)."""
+        if end is None:
+            end = clock_ns()
+        index = next(self._counter)
+        self.recorded = index + 1
+        index %= self.capacity
+        self._stages[index] = self._stage_id(name)
+        self._starts[index] = start
+        self._durations[index] = end - start
+        self._threads[index] = get_ident()
+
+    def span(self, name):
+        """Context manager recording a span of the stage `name`:
+        with profiler.span('plot'): update_plot()"""
+        return _Span(self, name)
+
+    def wrap(self, name, function):
+        """Returns `function` recording a span of the stage `name` at every call, e.g. to
+        profile the stages of a SampleBlocker or a callback."""
+        def wrapped(*args, **kwargs):
+            start = clock_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, start)
+        return wrapped
+
+    def clear(self):
+        """Forgets the spans recorded so far."""
+        self._counter = itertools.count()
+        self.recorded = 0
+
+    def spans(self):
+        """Returns the spans kept, oldest first, as NumPy arrays: stage ids (indices in
+        `stages`), starts and durations in nanoseconds, and thread ids."""
+        count = min(self.recorded, self.capacity)
+        first = self.recorded - count
+        order = (np.arange(first, first + count) % self.capacity) if count else \
+            np.zeros(0, dtype=int)
+        return tuple(np.frombuffer(values, dtype=values.typecode)[order] for values in
+                     (self._stages, self._starts, self._durations, self._threads))
+
+    @property
+    def stages(self):
+        """Names of the stages recorded, by stage id."""
+        return list(self._names)
+
+    def stats(self):
+        """Returns a dict of stage name: latency statistics of the spans kept, in nanoseconds:
+        count, total, mean, p50, p95, p99, max, and the histogram as `buckets`, a list of
+        (upper bound, count) with None for the last bound."""
+        stages, _, durations, _ = self.spans()
+        result = {}
+        for stage, name in enumerate(self._names):
+            values = durations[stages == stage]
+            if not len(values):
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS, values),
+                                 minlength=len(HISTOGRAM_BUCKETS) + 1)
+            result[name] = dict(
+                count=len(values), total=int(values.sum()), mean=float(values.mean()),
+                p50=float(p50), p95=float(p95), p99=float(p99), max=int(values.max()),
+                buckets=list(zip(list(HISTOGRAM_BUCKETS) + [None], counts.tolist())))
+        return result
+
+    def report(self):
+        """Returns the statistics of every stage as a text table, in microseconds."""
+        stats = self.stats()
+        total = float(sum(s['total'] for s in stats.values())) or 1.
+        lines = ['%-12s %9s %7s %9s %9s %9s %9s %9s' %
+                 ('stage', 'count', 'time %', 'mean us', 'p50 us', 'p95 us', 'p99 us',
+                  'max us')]
+        for name, s in sorted(stats.items(), key=lambda item: -item[1]['total']):
+            lines.append('%-12s %9d %7.1f %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                name, s['count'], 100 * s['total'] / total, s['mean'] / 1e3, s['p50'] / 1e3,
+                s['p95'] / 1e3, s['p99'] / 1e3, s['max'] / 1e3))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """Returns the spans kept in the Chrome trace event format, as a dict."""
+        stages, starts, durations, threads = self.spans()
+        pid = os.getpid()
+        names = self._names
+        events = [{'name': names[stage], 'ph': 'X', 'pid': pid, 'tid': int(thread),
+                   'ts': (start - self.origin) / 1e3, 'dur': duration / 1e3}
+                  for stage, start, duration, thread in
+                  zip(stages.tolist(), starts.tolist(), durations.tolist(), threads.tolist())]
+        return {'traceEvents': events, 'displayTimeUnit': 'ns'}
+
+    def write_chrome_trace(self, path):
+        """Writes the spans kept to `path` in the Chrome trace event format."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class _Span(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.profiler.record(self.name, self.start)
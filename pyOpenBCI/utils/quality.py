@@ -0,0 +1,149 @@
+"""
+Online signal quality of every channel, to notice a bad electrode while recording.
+
+QualityMonitor is a stage keeping running statistics of every channel over short intervals,
+updated a block at a time for all the channels with a constant cost per sample: mean and
+standard deviation (Welford's algorithm, merged block by block), RMS, fraction of the samples
+near the rails of the 24 bit ADC, flatline, and the ratio of the mains (50 or 60 Hz) power to
+the total power. At the end of every interval a quality vector is published.
+
+The statistics are computed on the data as the board outputs it, counts by default. For data
+scaled to uVolts (scaled=True) or Volts (WiFi Shield), pass the scale factors so that the
+thresholds in counts are converted.
+
+EXAMPLE USE:
+def print_quality(quality, block):
+    print(quality['railed'], quality['line_ratio'])
+
+monitor = QualityMonitor(sample_rate=250, callback=print_quality)
+board.start_stream(SampleBlocker([], block_size=25, stages=[monitor]))
+"""
+import numpy as np
+
+from .spectral import StreamingDFT
+from .stream import Block, _as_list
+
+# the ADC of the Cyton and Ganglion outputs 24 bit counts
+RAIL_COUNTS = 2 ** 23
+
+# fields of the quality vector published for every channel
+QUALITY_DTYPE = np.dtype([
+    ('mean', np.float64),  # mean of the channel
+    ('std', np.float64),  # standard deviation
+    ('rms', np.float64),  # root mean square, including the mean
+    ('railed', np.float64),  # fraction of the samples near the rails
+    ('flat', np.bool_),  # True when the channel does not move
+    ('line_ratio', np.float64),  # fraction of the power at the mains frequency
+    ('ok', np.bool_),  # True when none of the above points at a bad electrode
+])
+
+
+class QualityMonitor(object):
+    """ Stage publishing the signal quality of every channel a few times per second.
+
+    Args:
+        sample_rate: Sample rate of the stream in Hz.
+        callback: A function, or a list of functions, called at the end of every interval with
+        the quality vector, a structured array of QUALITY_DTYPE with one element per channel,
+        and the Block that ended the interval.
+        publish_rate: Number of quality vectors published per second.
+        scale: Units of the data per count, a number or an array with one value per channel,
+        e.g. board.config.scale_factors() for data in uVolts.
+        line_frequencies: Mains frequencies checked, the largest ratio is published.
+        rail_fraction: Samples above this fraction of the full scale are near the rails.
+        max_railed: Largest fraction of samples near the rails of a good channel.
+        flat_std: Standard deviation in counts below which a channel is flat.
+        max_line_ratio: Largest fraction of the power at the mains frequency of a good channel.
+    """
+
+    def __init__(self, sample_rate, callback=None, publish_rate=4., scale=1.,
+                 line_frequencies=(50., 60.), rail_fraction=0.95, max_railed=0.01,
+                 flat_std=1., max_line_ratio=0.5):
+        self.sample_rate = sample_rate
+        self.callbacks = _as_list(callback)
+        self.interval = max(1, int(round(sample_rate / float(publish_rate))))
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.rail_threshold = rail_fraction * RAIL_COUNTS * self.scale
+        self.flat_std = flat_std * self.scale
+        self.max_railed = max_railed
+        self.max_line_ratio = max_line_ratio
+        nyquist = sample_rate / 2.
+        self._line = StreamingDFT([f for f in line_frequencies if f < nyquist], sample_rate)
+        self.quality = None
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self._count = 0
+        self._mean = None
+        self._m2 = None
+        self._square_sum = None
+        self._railed = None
+        self._line.reset()
+
+    def reset(self):
+        """Drops the current interval, e.g. after a gap in the stream."""
+        self._reset_interval()
+
+    def _accumulate(self, data):
+        count = len(data)
+        mean = data.mean(axis=0)
+        m2 = ((data - mean) ** 2).sum(axis=0)
+        if self._count == 0:
+            self._mean, self._m2 = mean, m2
+            self._square_sum = (data ** 2).sum(axis=0)
+            self._railed = (np.abs(data) >= self.rail_threshold).sum(axis=0)
+        else:
+            # merge of the statistics of two sets of samples (Chan et al.)
+            total = self._count + count
+            delta = mean - self._mean
+            self._mean = self._mean + delta * count / total
+            self._m2 = self._m2 + m2 + delta ** 2 * self._count * count / total
+            self._square_sum += (data ** 2).sum(axis=0)
+            self._railed += (np.abs(data) >= self.rail_threshold).sum(axis=0)
+        self._count += count
+        if len(self._line.frequencies):
+            self._line.update(data)
+
+    def _publish(self):
+        count = self._count
+        quality = np.zeros(len(self._mean), dtype=QUALITY_DTYPE)
+        variance = self._m2 / count
+        quality['mean'] = self._mean
+        quality['std'] = np.sqrt(variance)
+        quality['rms'] = np.sqrt(self._square_sum / count)
+        quality['railed'] = self._railed / float(count)
+        quality['flat'] = quality['std'] < self.flat_std
+        if len(self._line.frequencies):
+            # power of a sine of amplitude a is a ** 2 / 2
+            line_power = (self._line.amplitudes() ** 2 / 2).max(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.where(variance > 0, line_power / variance, 0.)
+            quality['line_ratio'] = np.minimum(ratio, 1.)
+        quality['ok'] = (quality['railed'] <= self.max_railed) & ~quality['flat'] & \
+            (quality['line_ratio'] <= self.max_line_ratio)
+        self.quality = quality
+        self._reset_interval()
+        return quality
+
+    def process(self, data, block=None):
+        """Adds samples, an array of shape (n_samples, n_channels), publishing the quality at
+        the end of every interval."""
+        start = 0
+        while start < len(data):
+            take = min(len(data) - start, self.interval - self._count)
+            self._accumulate(data[start:start + take])
+            start += take
+            if self._count >= self.interval:
+                quality = self._publish()
+                for call in self.callbacks:
+                    call(quality, block)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if isinstance(block, Block):
+            if block.gap:
+                self.reset()
+            self.process(block.data, block)
+        else:
+            self.process(np.asarray(block, dtype=np.float64))
+        return block
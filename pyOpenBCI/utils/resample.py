@@ -0,0 +1,116 @@
+"""
+Streaming sample rate conversion, to bring boards running at different rates (Ganglion 200 Hz,
+Cyton 250 Hz, Cyton on the WiFi Shield up to 16 kHz) to the single rate a consumer wants.
+
+Resampler converts by a rational ratio up / down (e.g. 250 -> 200 Hz is 4 / 5) with a
+polyphase FIR filter: the anti-aliasing lowpass is split into `up` phases and only the products
+needed for the output samples are computed, for all the channels at once. The last input
+samples are kept from one block to the next so that a stream resampled block by block is the
+same as the stream resampled at once.
+
+EXAMPLE USE:
+to_250 = Resampler(200, 250)
+board.start_stream(SampleBlocker(print_block, block_size=20, stages=[to_250]))
+"""
+from fractions import Fraction
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .stream import Block
+
+# largest numerator or denominator of the conversion ratio
+MAX_RATIO_TERM = 1000
+
+
+def lowpass_taps(num_taps, cutoff, beta=8.):
+    """Kaiser windowed sinc lowpass filter, `cutoff` as a fraction of the Nyquist frequency."""
+    n = np.arange(num_taps) - (num_taps - 1) / 2.
+    return cutoff * np.sinc(cutoff * n) * np.kaiser(num_taps, beta)
+
+
+class Resampler(object):
+    """ Stage converting blocks from `input_rate` to `output_rate` Hz.
+
+    Args:
+        input_rate: Sample rate of the blocks received.
+        output_rate: Sample rate of the blocks returned.
+        zero_crossings: Half length of the anti-aliasing filter, in periods of the lower of the
+        two Nyquist frequencies. Longer filters have a sharper cutoff and a longer delay.
+        cutoff: Cutoff of the anti-aliasing filter as a fraction of the lower of the two Nyquist
+        frequencies.
+    """
+
+    def __init__(self, input_rate, output_rate, zero_crossings=8, cutoff=0.9):
+        ratio = Fraction(output_rate / float(input_rate)).limit_denominator(MAX_RATIO_TERM)
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        # the filter runs at input_rate * up, and must span the same time whatever the ratio
+        self.taps_per_phase = int(np.ceil(2. * zero_crossings * max(self.up, self.down) /
+                                          cutoff / self.up))
+        taps = lowpass_taps(self.taps_per_phase * self.up, cutoff / max(self.up, self.down))
+        # gain of up, the zeros inserted between the input samples carry no energy
+        taps *= self.up
+        # phases[p, j] = taps[p + j * up], applied to the input samples from newest to oldest
+        self.phases = taps.reshape(self.taps_per_phase, self.up).T
+        self.reset()
+
+    @property
+    def delay(self):
+        """Delay of the filter in seconds."""
+        return (self.taps_per_phase * self.up - 1) / 2. / (self.up * self.input_rate)
+
+    def reset(self):
+        """Forgets the previous samples, e.g. after a gap in the stream."""
+        self._history = None
+        # position of the next output sample, in input samples times up, from the first sample
+        # of the next block
+        self._position = 0
+
+    def resample(self, data, gap=False):
+        """Resamples `data` of shape (n_samples, n_channels), continuing from the previous call
+        unless `gap` is True. Returns the output samples and the index of the input sample each
+        of them is the closest to."""
+        data = np.asarray(data, dtype=np.float64)
+        if gap or self._history is None or self._history.shape[1] != data.shape[1]:
+            self.reset()
+            if len(data) == 0:
+                return data, np.zeros(0, dtype=int)
+            # start as if the first sample had always been there, no transient on DC offsets
+            self._history = np.repeat(data[:1], self.taps_per_phase - 1, axis=0)
+        count = len(data)
+        up, down, taps = self.up, self.down, self.taps_per_phase
+        positions = np.arange(self._position, count * up, down)
+        latest = positions // up
+        phases = positions % up
+
+        extended = np.concatenate((self._history, data))
+        if len(positions):
+            # windows[i] holds the taps input samples ending with extended[i + taps - 1]
+            windows = as_strided(extended, shape=(len(extended) - taps + 1, taps,
+                                                  extended.shape[1]),
+                                 strides=(extended.strides[0],) + extended.strides)
+            # newest sample first
+            selected = windows[latest][:, ::-1, :]
+            output = np.einsum('okc,ok->oc', selected, self.phases[phases])
+        else:
+            output = np.zeros((0, data.shape[1]))
+
+        self._history = extended[len(extended) - (taps - 1):].copy()
+        next_position = positions[-1] + down if len(positions) else self._position
+        self._position = next_position - count * up
+        return output, latest
+
+    def __call__(self, block):
+        """Resamples a Block, or an array of shape (n_samples, n_channels). The aux data, ids
+        and timestamps of a Block are taken from the closest input sample."""
+        if not isinstance(block, Block):
+            return self.resample(block)[0]
+        data, nearest = self.resample(block.data, block.gap)
+        changes = dict(data=data)
+        for name in ('aux', 'ids', 'timestamps'):
+            values = getattr(block, name)
+            changes[name] = values[nearest] if values is not None else None
+        return block.replace(**changes)
@@ -0,0 +1,147 @@
+"""
+Preallocated circular buffer holding the last samples of all the channels of a board, for
+consumers analysing "the last N seconds" many times per second.
+
+Every sample is written twice, at its position and one capacity further (a mirrored layout),
+so that any window of the latest samples is contiguous in memory: windows are returned as
+read-only NumPy views, never copied, whatever their length and wherever the wrap point is.
+Several readers can follow the stream with their own cursor.
+
+A view shows the buffer memory itself: it stays valid until the writer has written
+capacity - len(view) more samples, copy it to keep it longer.
+
+EXAMPLE USE:
+ring = RingBuffer(capacity=250 * 10, num_channels=8)
+board.start_stream(SampleBlocker(ring, block_size=10))  # or board.start_stream(ring)
+
+last_4_seconds = ring.latest(250 * 4)  # array of shape (1000, 8)
+reader = ring.reader()
+new_samples = reader.read()  # samples written since the previous read
+"""
+from threading import Lock
+
+import numpy as np
+
+from .stream import Block
+
+
+class RingBuffer(object):
+    """ Circular buffer of samples with a mirrored layout.
+
+    Args:
+        capacity: Maximum number of samples kept, the longest window available.
+        num_channels: Number of channels of a sample.
+        dtype: NumPy dtype of the buffer.
+    """
+
+    def __init__(self, capacity, num_channels, dtype=np.float64):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.num_channels = num_channels
+        self._data = np.zeros((2 * capacity, num_channels), dtype=dtype)
+        self._lock = Lock()
+        # number of samples written since the creation of the buffer
+        self.written = 0
+
+    def __len__(self):
+        """Number of samples available, at most the capacity."""
+        return min(self.written, self.capacity)
+
+    def write(self, data):
+        """Appends samples, an array of shape (n_samples, num_channels) or a single sample of
+        shape (num_channels,)."""
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[np.newaxis, :]
+        count = len(data)
+        if count > self.capacity:
+            # only the last capacity samples can be kept
+            data = data[-self.capacity:]
+        n = len(data)
+        capacity = self.capacity
+        with self._lock:
+            # samples that did not fit are skipped
+            position = (self.written + count - n) % capacity
+            first = min(n, capacity - position)
+            self._data[position:position + first] = data[:first]
+            self._data[position + capacity:position + capacity + first] = data[:first]
+            rest = n - first
+            if rest:
+                self._data[:rest] = data[first:]
+                self._data[capacity:capacity + rest] = data[first:]
+            self.written += count
+
+    def __call__(self, block):
+        """Callback for start_stream (a sample), or callback or stage of a SampleBlocker (a
+        Block, returned unchanged)."""
+        if isinstance(block, Block):
+            self.write(block.data)
+        else:
+            self.write(block.channels_data)
+        return block
+
+    def _view(self, end, count):
+        """Read-only view of the `count` samples written before the sample number `end`."""
+        start = (end - count) % self.capacity
+        view = self._data[start:start + count]
+        view.flags.writeable = False
+        return view
+
+    def latest(self, count=None):
+        """Returns a read-only view of the last `count` samples (all the samples available if
+        None), oldest first."""
+        with self._lock:
+            available = min(self.written, self.capacity)
+            count = available if count is None else min(count, available)
+            return self._view(self.written, count)
+
+    def reader(self, from_start=False):
+        """Returns a new RingReader, reading the samples written from now on, or since the
+        oldest sample still in the buffer if `from_start`."""
+        with self._lock:
+            start = self.written - min(self.written, self.capacity) if from_start else self.written
+        return RingReader(self, start)
+
+
+class RingReader(object):
+    """ Cursor of a reader of a RingBuffer, see RingBuffer.reader.
+
+    Attributes:
+        position: Number of the next sample to read.
+        overruns: Number of samples the writer overwrote before they were read.
+    """
+
+    def __init__(self, ring, position=0):
+        self.ring = ring
+        self.position = position
+        self.overruns = 0
+
+    @property
+    def available(self):
+        """Number of samples that can be read."""
+        return min(self.ring.written - self.position, self.ring.capacity)
+
+    def read(self, max_count=None):
+        """Returns a read-only view of the samples written since the previous read, at most
+        `max_count`. Samples overwritten before being read are skipped and counted in
+        overruns."""
+        ring = self.ring
+        with ring._lock:
+            lost = ring.written - ring.capacity - self.position
+            if lost > 0:
+                self.overruns += lost
+                self.position += lost
+            count = ring.written - self.position
+            if max_count is not None:
+                count = min(count, max_count)
+            self.position += count
+            return ring._view(self.position, count)
+
+    def window(self, count):
+        """Returns a read-only view of the last `count` samples and moves the cursor past them,
+        for analyses of a sliding window at every update."""
+        ring = self.ring
+        with ring._lock:
+            self.position = ring.written
+            return ring._view(ring.written, min(count, ring.written, ring.capacity))
@@ -0,0 +1,276 @@
+"""
+Circular buffer of samples in shared memory, for consumers in other processes reading the
+latest samples at a high rate without any copy or socket.
+
+The acquisition process creates a SharedRingBuffer and writes the blocks into it. Other
+processes attach to it by name and follow it with their own readers, without any lock: the
+buffer holds two sample counters, `writing` moved before a block is written and `written`
+after it, and a reader reads up to `written` and knows that its samples are intact as long as
+`writing` has not gone a capacity past them. Readers that fall more than a capacity behind are
+lapped, they skip to the oldest sample still in the buffer and count the samples lost. Writing
+costs the same whatever the number of readers.
+
+Like RingBuffer, the samples are written twice (mirrored layout) so that every window is a
+contiguous NumPy view of the shared memory, and the arrival time of every sample is kept
+alongside. A view stays valid until the writer has written capacity - len(view) more samples,
+use reader.intact() after processing a view to check that it was not overwritten meanwhile.
+
+Needs Python 3.8 or later (multiprocessing.shared_memory).
+
+EXAMPLE USE:
+ring = SharedRingBuffer(capacity=250 * 10, num_channels=8, name='openbci')
+board.start_stream(SampleBlocker(ring, block_size=10))
+
+# in another process
+ring = SharedRingBuffer.attach('openbci')
+reader = ring.reader()
+new_samples = reader.read()
+"""
+import multiprocessing
+import time
+
+import numpy as np
+
+from .stream import Block
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+MAGIC = b'OBRING1'
+# header: magic (8 bytes), dtype (8 bytes), then int64 fields
+_HEADER_SIZE = 64
+_FIELDS_OFFSET = 16
+CAPACITY, NUM_CHANNELS, WRITTEN, WRITING = range(4)
+_NUM_FIELDS = 6
+# names of the buffers created by this process, registered with its resource tracker
+_created = set()
+
+
+def _layout(capacity, num_channels, dtype):
+    """Offsets of the data and timestamps, and size of the shared memory."""
+    data_size = 2 * capacity * num_channels * dtype.itemsize
+    # timestamps aligned on 8 bytes
+    timestamps_offset = _HEADER_SIZE + (data_size + 7) // 8 * 8
+    return _HEADER_SIZE, timestamps_offset, timestamps_offset + 2 * capacity * 8
+
+
+def _open(name):
+    try:
+        # Python 3.13 and later, the creator alone removes the memory
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name=name)
+        # the resource tracker of an unrelated process would remove the memory when it exits,
+        # the children of the creator share its tracker, and the creator keeps its own entry
+        if multiprocessing.parent_process() is None and name not in _created:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class SharedRingBuffer(object):
+    """ Circular buffer of samples in shared memory, with a mirrored layout.
+
+    Args:
+        capacity: Maximum number of samples kept, the longest window available.
+        num_channels: Number of channels of a sample.
+        name: Name of the shared memory, the one to attach to. Picked by the system if None,
+        see the name attribute.
+        dtype: NumPy dtype of the samples.
+    """
+
+    def __init__(self, capacity, num_channels, name=None, dtype=np.float64, _memory=None):
+        if shared_memory is None:
+            raise ImportError('Shared memory needs Python 3.8 or later')
+        dtype = np.dtype(dtype)
+        if _memory is None:
+            if capacity < 1:
+                raise ValueError('capacity must be at least 1')
+            size = _layout(capacity, num_channels, dtype)[2]
+            _memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            _created.add(_memory.name)
+            self.owner = True
+        else:
+            self.owner = False
+        self.memory = _memory
+        self.name = _memory.name
+        buffer = _memory.buf
+        self._fields = np.ndarray((_NUM_FIELDS,), dtype=np.int64, buffer=buffer,
+                                  offset=_FIELDS_OFFSET)
+        if self.owner:
+            buffer[:len(MAGIC)] = MAGIC
+            buffer[8:16] = dtype.str.encode('ascii').ljust(8, b'\0')
+            self._fields[:] = 0
+            self._fields[CAPACITY] = capacity
+            self._fields[NUM_CHANNELS] = num_channels
+        self.capacity = int(self._fields[CAPACITY])
+        self.num_channels = int(self._fields[NUM_CHANNELS])
+        data_offset, timestamps_offset, _ = _layout(self.capacity, self.num_channels, dtype)
+        self._data = np.ndarray((2 * self.capacity, self.num_channels), dtype=dtype,
+                                buffer=buffer, offset=data_offset)
+        self._timestamps = np.ndarray((2 * self.capacity,), dtype=np.float64, buffer=buffer,
+                                      offset=timestamps_offset)
+
+    @classmethod
+    def attach(cls, name):
+        """Returns the SharedRingBuffer created under `name` by another process, to read it."""
+        if shared_memory is None:
+            raise ImportError('Shared memory needs Python 3.8 or later')
+        memory = _open(name)
+        if bytes(memory.buf[:len(MAGIC)]) != MAGIC:
+            memory.close()
+            raise ValueError('%s is not a SharedRingBuffer' % name)
+        dtype = np.dtype(bytes(memory.buf[8:16]).rstrip(b'\0').decode('ascii'))
+        return cls(None, None, dtype=dtype, _memory=memory)
+
+    @property
+    def written(self):
+        """Number of samples written since the creation of the buffer."""
+        return int(self._fields[WRITTEN])
+
+    def __len__(self):
+        """Number of samples available, at most the capacity."""
+        return min(self.written, self.capacity)
+
+    def write(self, data, timestamps=None):
+        """Appends samples, an array of shape (n_samples, num_channels) or a single sample of
+        shape (num_channels,), received at `timestamps` (time.time() values, now if None).
+        Only one process may write."""
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[np.newaxis, :]
+        count = len(data)
+        if timestamps is None:
+            timestamps = np.full(count, time.time())
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        if count > self.capacity:
+            # only the last capacity samples can be kept
+            data = data[-self.capacity:]
+            timestamps = timestamps[-self.capacity:]
+        n = len(data)
+        capacity = self.capacity
+        written = int(self._fields[WRITTEN])
+        # readers of the samples about to be overwritten will know
+        self._fields[WRITING] = written + count
+        # samples that did not fit are skipped
+        position = (written + count - n) % capacity
+        first = min(n, capacity - position)
+        rest = n - first
+        for target, values in ((self._data, data), (self._timestamps, timestamps)):
+            target[position:position + first] = values[:first]
+            target[position + capacity:position + capacity + first] = values[:first]
+            if rest:
+                target[:rest] = values[first:]
+                target[capacity:capacity + rest] = values[first:]
+        self._fields[WRITTEN] = written + count
+
+    def __call__(self, block):
+        """Callback for start_stream (a sample), or callback or stage of a SampleBlocker (a
+        Block, returned unchanged)."""
+        if isinstance(block, Block):
+            self.write(block.data, block.timestamps)
+        else:
+            self.write(block.channels_data)
+        return block
+
+    def _view(self, end, count, timestamps=False):
+        """Read-only view of the `count` samples written before the sample number `end`, and
+        of their timestamps if `timestamps`."""
+        start = (end - count) % self.capacity
+        view = self._data[start:start + count]
+        view.flags.writeable = False
+        if not timestamps:
+            return view
+        stamps = self._timestamps[start:start + count]
+        stamps.flags.writeable = False
+        return view, stamps
+
+    def intact(self, position):
+        """True while the sample number `position` and the ones after it have not been
+        overwritten."""
+        return position >= int(self._fields[WRITING]) - self.capacity
+
+    def latest(self, count=None, timestamps=False):
+        """Returns a read-only view of the last `count` samples (all the samples available if
+        None), oldest first, and of their timestamps if `timestamps`."""
+        written = self.written
+        available = min(written, self.capacity)
+        count = available if count is None else min(count, available)
+        return self._view(written, count, timestamps)
+
+    def reader(self, from_start=False):
+        """Returns a new SharedRingReader, reading the samples written from now on, or since
+        the oldest sample still in the buffer if `from_start`."""
+        written = self.written
+        start = written - min(written, self.capacity) if from_start else written
+        return SharedRingReader(self, start)
+
+    def close(self):
+        """Closes the access of this process to the buffer, the views become invalid."""
+        self._data = self._timestamps = self._fields = None
+        self.memory.close()
+
+    def unlink(self):
+        """Removes the shared memory, once every process has closed it. For the creator."""
+        self.memory.unlink()
+        _created.discard(self.name)
+
+
+class SharedRingReader(object):
+    """ Cursor of a reader of a SharedRingBuffer, see SharedRingBuffer.reader.
+
+    Attributes:
+        position: Number of the next sample to read.
+        overruns: Number of samples the writer overwrote before they were read.
+        start: Number of the first sample of the last view returned.
+    """
+
+    def __init__(self, ring, position=0):
+        self.ring = ring
+        self.position = position
+        self.overruns = 0
+        self.start = position
+
+    @property
+    def available(self):
+        """Number of samples that can be read."""
+        return min(self.ring.written - self.position, self.ring.capacity)
+
+    @property
+    def lapped(self):
+        """True when samples were overwritten before being read."""
+        return self.ring.written - self.ring.capacity > self.position
+
+    def read(self, max_count=None, timestamps=False):
+        """Returns a read-only view of the samples written since the previous read, at most
+        `max_count`, and of their timestamps if `timestamps`. Samples overwritten before being
+        read are skipped and counted in overruns."""
+        ring = self.ring
+        written = ring.written
+        # the samples being written are not safe to read either
+        lost = max(written, int(ring._fields[WRITING])) - ring.capacity - self.position
+        if lost > 0:
+            self.overruns += lost
+            self.position += lost
+        count = max(written - self.position, 0)
+        if max_count is not None:
+            count = min(count, max_count)
+        self.start = self.position
+        self.position += count
+        return ring._view(self.position, count, timestamps)
+
+    def window(self, count, timestamps=False):
+        """Returns a read-only view of the last `count` samples and moves the cursor past them,
+        for analyses of a sliding window at every update."""
+        ring = self.ring
+        written = ring.written
+        count = min(count, written, ring.capacity)
+        self.start = written - count
+        self.position = written
+        return ring._view(written, count, timestamps)
+
+    def intact(self):
+        """True when the last view returned has not been overwritten since, check it after
+        processing the view."""
+        return self.ring.intact(self.start)
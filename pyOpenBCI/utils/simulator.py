@@ -0,0 +1,261 @@
+"""
+Simulated OpenBCI boards, to develop, test and benchmark without hardware.
+
+CytonSimulator stands in for the pyserial Serial object of a Cyton Dongle: it answers the soft
+reset with the Cyton banner and, once streaming, produces 33 byte packets at the sample rate of
+the board, sine waves or a replayed capture. Use it with OpenBCICyton(port='sim://').
+
+WiFiShieldSimulator stands in for a WiFi Shield streaming a Cyton: it connects to a
+WiFiShieldServer and sends it the packets over TCP, a write every `latency` micro seconds.
+
+EXAMPLE USE:
+board = OpenBCICyton(port='sim://')
+board.ser.data = counts  # to replay a capture
+board.start_stream(print_raw)
+
+server = WiFiShieldServer('127.0.0.1', 0, callback=print_raw)
+shield = WiFiShieldSimulator(server.socket.getsockname(), latency=10000)
+shield.start()
+asyncore.loop()
+"""
+import math
+import socket
+import struct
+import threading
+import time
+
+from .config import CHANNEL_SELECT
+from .impedance import LEAD_OFF_CURRENT, LEAD_OFF_FREQUENCY, SERIES_RESISTANCE
+
+SIMULATED_PORT = 'sim://'
+
+# start byte of the packets sent by the WiFi Shield, the one ParseRaw checks
+WIFI_START_BYTE = 33
+
+CYTON_BANNER = (b'OpenBCI V3 8-16 channel\n'
+                b'On Board ADS1299 Device ID: 0x3E\n'
+                b'LIS3DH Device ID: 0x33\n'
+                b'Firmware: v3.1.2\n'
+                b'$$$')
+
+
+class CytonSimulator(object):
+    """ Serial port of a simulated Cyton board.
+
+    Args:
+        daisy: A boolean indicating if the simulated board has a Daisy, the banner then lists it.
+        sample_rate: Packets per second sent while streaming.
+        reset_delay: Seconds the board takes to answer a soft reset.
+        timeout: Like the pyserial timeout, maximum seconds a read waits for data, None to
+        wait forever.
+        impedance: Impedance in Ohms of the simulated electrodes, seen in lead-off mode.
+        data: Counts to replay instead of the sine waves, of shape (n_samples, 8), or
+        (n_samples, 16) with a Daisy, looped over.
+    """
+
+    def __init__(self, daisy=False, sample_rate=250, reset_delay=0.05, timeout=None,
+                 impedance=10000., data=None, **kwargs):
+        self.daisy = daisy
+        self.sample_rate = sample_rate
+        self.reset_delay = reset_delay
+        self.timeout = timeout
+        self.port = SIMULATED_PORT
+        self._open = True
+        self._buffer = bytearray()
+        # text answers that become readable at a given time
+        self._pending = []
+        self._command = ''
+        self._streaming_since = None
+        self._packets_sent = 0
+        self.impedance = impedance
+        self.data = data
+        # channels driven by the lead-off current
+        self._lead_off = set()
+
+    def isOpen(self):
+        return self._open
+
+    is_open = property(isOpen)
+
+    def close(self):
+        self._open = False
+
+    def _answer(self, text, delay=0.):
+        self._pending.append((time.time() + delay, text))
+
+    def write(self, data):
+        for c in bytearray(data):
+            self._handle_command(chr(c))
+        return len(data)
+
+    def _handle_command(self, c):
+        if self._command:
+            # inside a x...X or z...Z channel command
+            self._command += c
+            if c in 'XZ':
+                if self._command[0] == 'z' and len(self._command) == 5:
+                    channel = CHANNEL_SELECT.find(self._command[1]) + 1
+                    if self._command[2] == '1' or self._command[3] == '1':
+                        self._lead_off.add(channel)
+                    else:
+                        self._lead_off.discard(channel)
+                if self._streaming_since is None:
+                    self._answer(b'Success: Channel set for %s$$$' % self._command[1:2].encode())
+                self._command = ''
+            return
+        if c in 'xz':
+            self._command = c
+        elif c == 'v':
+            self._lead_off = set()
+            self._streaming_since = None
+            self._buffer = bytearray()
+            self._pending = []
+            banner = CYTON_BANNER
+            if self.daisy:
+                banner = banner.replace(b'\n$$$', b'\nDaisy ADS1299 Device ID: 0x3E\n$$$')
+            self._answer(banner, self.reset_delay)
+        elif c == 'b':
+            if self._streaming_since is None:
+                self._streaming_since = time.time()
+                self._packets_sent = 0
+        elif c == 's':
+            self._streaming_since = None
+        elif c == '?':
+            self._answer(b'Board registers\n$$$')
+
+    def _packet(self, n):
+        """Sine waves of a different frequency on every channel, or the data replayed, in
+        counts, plus the response to the lead-off current (at the default gain of 24)."""
+        t = n / float(self.sample_rate)
+        # uVolts per count at a gain of 24
+        lead_off_counts = LEAD_OFF_CURRENT * (self.impedance + SERIES_RESISTANCE) * 1e6 / \
+            (4.5e6 / 24 / (2 ** 23 - 1))
+        row = None
+        if self.data is not None:
+            # with a Daisy, the packets with an even id hold the channels 9 to 16 of a sample
+            # and the next packet its channels 1 to 8
+            row = self.data[(n // 2 if self.daisy else n) % len(self.data)]
+            if self.daisy and n % 2 == 0:
+                row = row[8:]
+        channels = []
+        for i in range(8):
+            if row is not None:
+                value = row[i]
+            else:
+                value = 1000 * (i + 1) * math.sin(2 * math.pi * (i + 1) * t)
+            # the daisy channels of the packets with an even id are not simulated separately
+            if i + 1 in self._lead_off or (self.daisy and i + 9 in self._lead_off and n % 2 == 0):
+                value += lead_off_counts * math.sin(2 * math.pi * LEAD_OFF_FREQUENCY * t)
+            channels.append(int(value) & 0xFFFFFF)
+        packet = bytearray([0xA0, n % 256])
+        for value in channels:
+            packet += struct.pack('>I', value)[1:]
+        packet += struct.pack('>hhh', 0, 0, 1024)
+        packet.append(0xC0)
+        return packet
+
+    def _update(self):
+        now = time.time()
+        pending = []
+        for due, text in self._pending:
+            if due <= now:
+                self._buffer += text
+            else:
+                pending.append((due, text))
+        self._pending = pending
+        if self._streaming_since is not None:
+            due_packets = int((now - self._streaming_since) * self.sample_rate)
+            for n in range(self._packets_sent, due_packets):
+                self._buffer += self._packet(n)
+            self._packets_sent = max(due_packets, self._packets_sent)
+
+    def inWaiting(self):
+        self._update()
+        return len(self._buffer)
+
+    in_waiting = property(inWaiting)
+
+    def read(self, size=1):
+        end = None if self.timeout is None else time.time() + self.timeout
+        while self.inWaiting() < size:
+            if end is not None and time.time() >= end:
+                break
+            if self._streaming_since is None and not self._pending:
+                # nothing will ever come, like a serial port with a timeout, return early
+                if end is None:
+                    raise IOError('Simulated board is not sending any data')
+                time.sleep(max(min(end - time.time(), 0.001), 0))
+                continue
+            time.sleep(0.5 / self.sample_rate)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def flushInput(self):
+        self._update()
+        self._buffer = bytearray()
+
+    reset_input_buffer = flushInput
+
+
+class WiFiShieldSimulator(object):
+    """ A simulated WiFi Shield streaming a Cyton to a WiFiShieldServer, on a thread of its own.
+    Like the shield, the packets are held until the next TCP write, every `latency` micro
+    seconds.
+
+    Args:
+        address: (host, port) of the WiFiShieldServer.
+        sample_rate: Samples per second, with a Daisy every sample is a pair of packets.
+        latency: Micro seconds between two writes.
+        daisy: A boolean indicating if the simulated board has a Daisy.
+        data: Counts to replay, see CytonSimulator.
+    """
+
+    def __init__(self, address, sample_rate=1000, latency=10000, daisy=False, data=None):
+        self.address = address
+        self.sample_rate = sample_rate
+        self.latency = latency
+        self.packets_sent = 0
+        # packets per sample, the main board's and the Daisy's
+        self._packets_per_sample = 2 if daisy else 1
+        self._board = CytonSimulator(daisy=daisy, data=data,
+                                     sample_rate=sample_rate * self._packets_per_sample)
+        self._stop = threading.Event()
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        """Connects to the server and starts streaming."""
+        self._socket = socket.create_connection(self.address)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._stream)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _stream(self):
+        start = time.time()
+        sent = 0
+        try:
+            while not self._stop.wait(self.latency / 1e6):
+                due = int((time.time() - start) * self.sample_rate) * self._packets_per_sample
+                if due <= sent:
+                    continue
+                chunk = bytearray()
+                for n in range(sent, due):
+                    packet = self._board._packet(n)
+                    packet[0] = WIFI_START_BYTE
+                    chunk += packet
+                self._socket.sendall(bytes(chunk))
+                sent = self.packets_sent = due
+        except socket.error:
+            # the server closed the connection
+            pass
+
+    def stop(self):
+        """Stops streaming and closes the connection."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
@@ -0,0 +1,217 @@
+"""
+Spectral features of the streams of the boards, updated incrementally.
+
+BandPower estimates the power of every channel in frequency bands (delta to gamma by default)
+with Welch's method over a sliding window: the window is split in overlapping segments, the
+spectrum of a segment is computed once when the segment is complete, and the average is
+updated by adding the new segment and removing the one leaving the window. An update costs
+one FFT of a segment for all the channels, instead of the spectrum of the whole window.
+
+StreamingDFT follows the amplitude of a few frequencies only (mains noise, a lead-off
+excitation) like a lock-in amplifier: every sample is multiplied by the reference phasor of
+each frequency and accumulated, at a constant cost per sample.
+
+EXAMPLE USE:
+def print_alpha(powers, block):
+    print(powers[:, band_power.band_names.index('alpha')])
+
+band_power = BandPower(sample_rate=250, callback=print_alpha)
+board.start_stream(SampleBlocker([], block_size=25, stages=[band_power]))
+"""
+import numpy as np
+
+from .ringbuffer import RingBuffer
+from .stream import Block, _as_list
+
+# Frequency bands of the EEG, in Hz
+EEG_BANDS = [('delta', 1., 4.), ('theta', 4., 8.), ('alpha', 8., 13.), ('beta', 13., 30.),
+             ('gamma', 30., 45.)]
+
+# the running sum of the spectra is computed again from scratch every this many updates
+RESUM_INTERVAL = 1000
+
+
+class BandPower(object):
+    """ Stage estimating band powers with an incremental Welch average.
+
+    Args:
+        sample_rate: Sample rate of the stream in Hz.
+        callback: A function, or a list of functions, called at every hop with an array of
+        shape (n_channels, n_bands) of band powers (in units of the data squared) and the Block
+        that completed the segment.
+        bands: A list of (name, low Hz, high Hz) tuples.
+        segment_seconds: Length of a Welch segment, its inverse is the frequency resolution.
+        hop_seconds: Time between two segments, and between two updates of the band powers.
+        window_seconds: Length of the sliding window averaged.
+        detrend: 'constant' to remove the mean of every segment before windowing, as
+        scipy.signal.welch does, so that the DC offset of raw counts does not leak into the low
+        bands. None to keep it.
+    """
+
+    def __init__(self, sample_rate, callback=None, bands=EEG_BANDS, segment_seconds=1.,
+                 hop_seconds=0.25, window_seconds=4., detrend='constant'):
+        if detrend not in ('constant', None):
+            raise ValueError("detrend must be 'constant' or None")
+        self.sample_rate = float(sample_rate)
+        self.detrend = detrend
+        self.callbacks = _as_list(callback)
+        self.band_names = [name for name, _, _ in bands]
+        self.segment_length = int(round(segment_seconds * sample_rate))
+        self.hop = int(round(hop_seconds * sample_rate))
+        if self.segment_length < 2 or self.hop < 1:
+            raise ValueError('Segment and hop are too short for a sample rate of %s Hz' %
+                             sample_rate)
+        self.num_segments = max(1, int(round((window_seconds - segment_seconds) /
+                                             hop_seconds)) + 1)
+        self.window = np.hanning(self.segment_length)[:, np.newaxis]
+        # one-sided power spectral density scaling, see scipy.signal.welch
+        frequencies = np.fft.rfftfreq(self.segment_length, 1. / self.sample_rate)
+        scale = np.full(len(frequencies), 2. / (self.sample_rate * np.sum(self.window ** 2)))
+        scale[0] /= 2
+        if self.segment_length % 2 == 0:
+            scale[-1] /= 2
+        self.frequencies = frequencies
+        self._psd_scale = scale
+        # band powers are the PSD summed over the bins of each band, times the bin width
+        df = frequencies[1] - frequencies[0]
+        self._band_matrix = np.array([(frequencies >= low) & (frequencies < high)
+                                      for _, low, high in bands], dtype=np.float64) * scale * df
+        self.ring = None
+        self.reset()
+
+    def reset(self):
+        """Forgets the samples and segments, e.g. after a gap in the stream."""
+        self._segments = None
+        self._sum = None
+        self._index = 0
+        self._count = 0
+        self._updates = 0
+        self._until_segment = self.segment_length
+        if self.ring is not None:
+            self.ring = RingBuffer(self.segment_length, self.ring.num_channels)
+
+    @property
+    def ready(self):
+        """True once the sliding window is full."""
+        return self._count >= self.num_segments
+
+    def _add_segment(self, segment):
+        if self.detrend == 'constant':
+            segment = segment - segment.mean(axis=0)
+        power = np.abs(np.fft.rfft(segment * self.window, axis=0)) ** 2
+        if self._segments is None:
+            self._segments = np.zeros((self.num_segments,) + power.shape)
+            self._sum = np.zeros(power.shape)
+        self._sum += power - self._segments[self._index]
+        self._segments[self._index] = power
+        self._index = (self._index + 1) % self.num_segments
+        self._count = min(self._count + 1, self.num_segments)
+        self._updates += 1
+        if self._updates % RESUM_INTERVAL == 0:
+            # no drift from adding and removing floats for hours
+            self._sum = self._segments.sum(axis=0)
+
+    def powers(self):
+        """Band powers of every channel, an array of shape (n_channels, n_bands), over the
+        segments received so far."""
+        if self._sum is None:
+            return None
+        return self._band_matrix.dot(self._sum / self._count).T
+
+    def spectrum(self):
+        """Welch power spectral density, an array of shape (n_frequencies, n_channels), see
+        frequencies."""
+        if self._sum is None:
+            return None
+        return self._sum / self._count * self._psd_scale[:, np.newaxis]
+
+    def process(self, data, block=None):
+        """Adds samples, an array of shape (n_samples, n_channels), calling the callbacks
+        at every completed segment."""
+        if self.ring is None or self.ring.num_channels != data.shape[1]:
+            self.ring = RingBuffer(self.segment_length, data.shape[1])
+        start = 0
+        while start < len(data):
+            # write up to the end of the next segment
+            take = min(len(data) - start, self._until_segment)
+            self.ring.write(data[start:start + take])
+            start += take
+            self._until_segment -= take
+            if self._until_segment == 0:
+                self._until_segment = self.hop
+                self._add_segment(self.ring.latest(self.segment_length))
+                if self.callbacks:
+                    powers = self.powers()
+                    for call in self.callbacks:
+                        call(powers, block)
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, the block is returned unchanged."""
+        if isinstance(block, Block):
+            if block.gap:
+                self.reset()
+            self.process(block.data, block)
+        else:
+            self.process(np.asarray(block, dtype=np.float64))
+        return block
+
+
+class StreamingDFT(object):
+    """ Running discrete Fourier transform at a few frequencies, for all the channels.
+
+    Args:
+        frequencies: A list of frequencies in Hz.
+        sample_rate: Sample rate of the stream in Hz.
+    """
+
+    def __init__(self, frequencies, sample_rate):
+        self.frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+        self.sample_rate = float(sample_rate)
+        self._omega = 2 * np.pi * self.frequencies / self.sample_rate
+        self._phasors = {}
+        self.reset()
+
+    def reset(self):
+        """Starts a new accumulation."""
+        self.count = 0
+        self._phase = np.zeros(len(self.frequencies))
+        self._sums = None
+        self._data_sum = None
+        self._phasor_sum = np.zeros(len(self.frequencies), dtype=np.complex128)
+
+    def _block_phasors(self, length):
+        phasors = self._phasors.get(length)
+        if phasors is None:
+            if len(self._phasors) > 8:
+                self._phasors.clear()
+            phasors = self._phasors[length] = np.exp(
+                -1j * np.outer(self._omega, np.arange(length)))
+        return phasors
+
+    def update(self, data):
+        """Accumulates `data` of shape (n_samples, n_channels)."""
+        if len(data) == 0:
+            return
+        if self._sums is None:
+            self._sums = np.zeros((len(self.frequencies), data.shape[1]), dtype=np.complex128)
+            self._data_sum = np.zeros(data.shape[1])
+        # the phase is kept modulo 2 pi so that it does not lose precision over hours
+        phasors = np.exp(-1j * self._phase)[:, np.newaxis] * self._block_phasors(len(data))
+        self._sums += phasors.dot(data)
+        self._phasor_sum += phasors.sum(axis=1)
+        self._data_sum += data.sum(axis=0)
+        self._phase = (self._phase + self._omega * len(data)) % (2 * np.pi)
+        self.count += len(data)
+
+    def amplitudes(self, remove_mean=True):
+        """Peak amplitude of a sine at every frequency, an array of shape
+        (n_frequencies, n_channels). The mean of the data is removed first so that a DC offset
+        does not leak into the frequencies when the accumulation is not a whole number of
+        periods."""
+        if not self.count:
+            return None
+        sums = self._sums
+        if remove_mean:
+            mean = self._data_sum / self.count
+            sums = sums - np.outer(self._phasor_sum, mean)
+        return 2 * np.abs(sums) / self.count
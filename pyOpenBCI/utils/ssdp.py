@@ -12,8 +12,10 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import select
 import socket
 import sys
+import time
 
 pyVersion = sys.version_info[0]
 if pyVersion == 2:
@@ -42,13 +44,22 @@ class SSDPResponse(object):
         self.location = r.getheader("location")
         self.usn = r.getheader("usn")
         self.st = r.getheader("st")
-        self.cache = r.getheader("cache-control").split("=")[1]
+        self.cache = r.getheader("cache-control", "max-age=0").split("=")[-1]
+        try:
+            self.max_age = int(self.cache)
+        except ValueError:
+            self.max_age = 0
 
     def __repr__(self):
         return "<SSDPResponse({location}, {st}, {usn})>".format(**self.__dict__)
 
 
-def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None):
+def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None, stop=None):
+    """
+    Sends a M-SEARCH for `service` and collects the responses for `timeout` seconds.
+    `wifi_found_cb` is called with every new response as soon as it arrives, it should not block.
+    Discovery ends early when the `stop` threading.Event is set.
+    """
     group = ("239.255.255.250", 1900)
     message = "\r\n".join([
         'M-SEARCH * HTTP/1.1',
@@ -56,7 +67,6 @@ def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None):
         'MAN: "ssdp:discover"',
         'ST: {st}', 'MX: {mx}', '', ''])
 
-    socket.setdefaulttimeout(timeout)
     responses = {}
     for _ in range(retries):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -65,13 +75,26 @@ def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None):
         sockMessage = message.format(*group, st=service, mx=mx)
         if pyVersion == 3:
             sockMessage = sockMessage.encode("utf-8")
-        sock.sendto(sockMessage, group)
-        while True:
-            try:
-                response = SSDPResponse(sock.recv(1024))
+        try:
+            sock.sendto(sockMessage, group)
+            end = time.time() + timeout
+            while time.time() < end and not (stop is not None and stop.is_set()):
+                # wake up regularly to check the stop event
+                readable = select.select([sock], [], [], min(end - time.time(), 0.1))[0]
+                if not readable:
+                    continue
+                try:
+                    response = SSDPResponse(sock.recv(1024))
+                except Exception:
+                    # not a valid SSDP response
+                    continue
+                if response.location in responses:
+                    continue
+                responses[response.location] = response
                 if wifi_found_cb is not None:
                     wifi_found_cb(response)
-                responses[response.location] = response
-            except socket.timeout:
-                break
+        finally:
+            sock.close()
+        if stop is not None and stop.is_set():
+            break
     return list(responses.values())
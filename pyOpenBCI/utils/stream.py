@@ -0,0 +1,280 @@
+"""
+Blocks of samples, to process the streams of the boards a block at a time instead of a sample
+at a time.
+
+start_stream calls its callback for every single sample. A SampleBlocker collects these samples
+into Blocks of consecutive samples (a NumPy array of shape (n_samples, n_channels)) and calls
+the processing stages, e.g. an IIRFilter, then the callbacks, once per block. A block never
+spans a gap in the stream (dropped packets, reconnection of the board), the block following a
+gap is marked so that stages carrying state between blocks start again.
+
+EXAMPLE USE:
+def print_block(block):
+    print(block.data.mean(axis=0))
+
+notch = IIRFilter.notch(50, sample_rate=250)
+board.start_stream(SampleBlocker(print_block, block_size=25, stages=[notch], id_step=1))
+"""
+import logging
+import time
+
+import numpy as np
+
+# sample ids are sent by the boards as a single byte
+ID_MODULO = 256
+
+
+class Block(object):
+    """ Consecutive samples of a board.
+
+    Attributes:
+        data: A float array of shape (n_samples, n_channels) with the channels data.
+        aux: A float array of shape (n_samples, n_aux) with the aux data, None if the samples
+        have none.
+        ids: An int array with the sample ids.
+        timestamps: A float array with the time.time() at which each sample was received, as
+        stamped by the driver when it read the sample (see the arrival of the samples).
+        board_type: A string specifying the board type, e.g 'cyton', 'daisy', 'ganglion'.
+        source: The WiFi Shield address the samples come from, None for the other boards.
+        gap: True when samples were lost just before this block.
+    """
+
+    def __init__(self, data, aux=None, ids=None, timestamps=None, board_type=None, source=None,
+                 gap=False):
+        self.data = data
+        self.aux = aux
+        self.ids = ids
+        self.timestamps = timestamps
+        self.board_type = board_type
+        self.source = source
+        self.gap = gap
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def num_channels(self):
+        return self.data.shape[1]
+
+    def replace(self, **changes):
+        """Returns a new block with some of the attributes changed, e.g. the filtered data.
+        The arrays that are not changed are shared with this block."""
+        values = dict(data=self.data, aux=self.aux, ids=self.ids, timestamps=self.timestamps,
+                      board_type=self.board_type, source=self.source, gap=self.gap)
+        values.update(changes)
+        return Block(**values)
+
+    def __repr__(self):
+        return "<Block(%d samples, %d channels%s)>" % (len(self), self.num_channels,
+                                                       ', gap' if self.gap else '')
+
+
+def concatenate_blocks(blocks):
+    """Returns a Block of the samples of consecutive `blocks`, following a gap if the first
+    one does."""
+    first = blocks[0]
+    if len(blocks) == 1:
+        return first
+
+    def joined(name):
+        values = [getattr(block, name) for block in blocks]
+        if any(value is None for value in values):
+            return None
+        return np.concatenate(values)
+
+    return first.replace(data=joined('data'), aux=joined('aux'), ids=joined('ids'),
+                         timestamps=joined('timestamps'))
+
+
+def _as_list(callback):
+    if callback is None:
+        return []
+    if not isinstance(callback, list):
+        return [callback]
+    return callback
+
+
+class SampleBlocker(object):
+    """ Callback for start_stream, turning the samples of a board into Blocks.
+
+    Args:
+        callback: A function, or a list of functions, called with every block.
+        block_size: Number of samples in a block.
+        stages: A list of processing stages, callables taking and returning a Block, applied in
+        order to every block before the callbacks, e.g. [IIRFilter.notch(50, 250)].
+        id_step: Difference between the ids of two consecutive samples, 1 for the Cyton and 2
+        for the Cyton with Daisy, to detect dropped packets. None to only rely on the samples
+        marked as invalid by the driver (WiFi Shield, Ganglion).
+    """
+
+    def __init__(self, callback, block_size=25, stages=None, id_step=None):
+        if block_size < 1:
+            raise ValueError('block_size must be at least 1')
+        self.callbacks = _as_list(callback)
+        self.block_size = block_size
+        self.stages = list(stages or [])
+        self.id_step = id_step
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._samples = []
+        self._timestamps = []
+        self._gap = False
+        self._last_id = None
+
+    @staticmethod
+    def _is_marker(sample):
+        """True for samples carrying no data: gap markers of the WiFi Shield, dummy samples of
+        the Ganglion."""
+        data = sample.channels_data
+        return not getattr(sample, 'valid', True) or data is None or len(data) == 0 or \
+            np.isnan(np.sum(data))
+
+    def _dropped_before(self, sample):
+        if self.id_step is None or self._last_id is None:
+            return False
+        if sample.id == (self._last_id + self.id_step) % ID_MODULO:
+            return False
+        self._logger.debug('Sample %s follows %s, samples were dropped' %
+                           (sample.id, self._last_id))
+        return True
+
+    def __call__(self, sample):
+        now = time.time()
+        if self._is_marker(sample):
+            self.flush()
+            self._gap = True
+            self._last_id = None
+            return
+        if self._dropped_before(sample):
+            # the block in progress ends where the samples were dropped
+            self.flush()
+            self._gap = True
+        self._last_id = sample.id
+        self._samples.append(sample)
+        arrival = getattr(sample, 'arrival', None)
+        if arrival is None:
+            # the WiFi Shield stamps its samples in milliseconds
+            stamp = getattr(sample, 'timestamp', 0)
+            arrival = stamp / 1000. if stamp else now
+        self._timestamps.append(arrival)
+        if len(self._samples) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """Processes the samples received so far as a (shorter) block."""
+        if not self._samples:
+            return
+        samples, self._samples = self._samples, []
+        timestamps, self._timestamps = self._timestamps, []
+        block = Block(np.array([s.channels_data for s in samples], dtype=np.float64),
+                      aux=self._aux(samples),
+                      ids=np.array([s.id for s in samples]),
+                      timestamps=np.array(timestamps),
+                      board_type=getattr(samples[0], 'board_type', None),
+                      source=getattr(samples[0], 'source', None),
+                      gap=self._gap)
+        self._gap = False
+        self.process(block)
+
+    def process(self, block):
+        """Applies the stages to `block` and calls the callbacks with the result."""
+        for stage in self.stages:
+            block = stage(block)
+        for call in self.callbacks:
+            call(block)
+
+    @staticmethod
+    def _aux(samples):
+        try:
+            aux = np.array([s.aux_data for s in samples], dtype=np.float64)
+        except (TypeError, ValueError):
+            return None
+        if aux.ndim != 2 or aux.shape[1] == 0:
+            return None
+        return aux
+
+    def reset(self):
+        """Drops the samples not yet processed and restarts the stages."""
+        self._samples = []
+        self._timestamps = []
+        self._gap = False
+        self._last_id = None
+        for stage in self.stages:
+            if hasattr(stage, 'reset'):
+                stage.reset()
+
+
+class ClockDejitter(object):
+    """ Stage replacing the arrival times of the samples, which jitter with the buffering of
+    the serial port, Bluetooth or network, with times on a straight line fitted to them: a
+    least squares fit of the arrival time against the sample number, forgetting the old samples
+    so that it follows the drift of the clock of the board. The line is fitted again after a
+    gap in the stream.
+
+    Args:
+        sample_rate: Nominal sample rate of the stream in Hz.
+        half_life: Time in seconds after which a sample has half of its weight in the fit.
+        min_fit_seconds: The slope of the line is the nominal sample period until this time is
+        received, only the offset is fitted.
+    """
+
+    def __init__(self, sample_rate, half_life=90., min_fit_seconds=2.):
+        self.sample_rate = float(sample_rate)
+        self._forget = 0.5 ** (1. / (half_life * sample_rate))
+        self.min_fit = int(min_fit_seconds * sample_rate)
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous samples, e.g. after a gap in the stream."""
+        self._origin = None
+        self._count = 0
+        self._count_in_block = 0
+        # weighted sums of 1, n, t, n * n, n * t; n counted from the first sample of the latest
+        # block, t from the first arrival
+        self._sums = np.zeros(5)
+
+    @property
+    def period(self):
+        """Sample period of the fitted line in seconds, the nominal one before the fit."""
+        return self._line()[1]
+
+    def _line(self):
+        s0, sn, st, snn, snt = self._sums
+        slope = 1. / self.sample_rate
+        if self._count >= self.min_fit:
+            variance = s0 * snn - sn * sn
+            if variance > 0:
+                slope = (s0 * snt - sn * st) / variance
+        intercept = (st - slope * sn) / s0 if s0 else 0.
+        return intercept, slope
+
+    def timestamps(self, arrivals, gap=False):
+        """Returns the times on the line of the samples received at `arrivals` (time.time()
+        values), continuing from the previous call unless `gap` is True."""
+        arrivals = np.asarray(arrivals, dtype=np.float64)
+        if gap:
+            self.reset()
+        count = len(arrivals)
+        if count == 0:
+            return arrivals
+        if self._origin is None:
+            self._origin = arrivals[0]
+        # move n to start at this block, keeps the sums small however long the stream
+        s0, sn, st, snn, snt = self._sums
+        shift = self._count_in_block
+        self._sums = np.array([s0, sn - shift * s0, st, snn - 2 * shift * sn + shift ** 2 * s0,
+                               snt - shift * st])
+        n = np.arange(count, dtype=np.float64)
+        t = arrivals - self._origin
+        weights = self._forget ** (count - 1 - n)
+        self._sums = self._sums * self._forget ** count + \
+            np.array([weights.sum(), weights.dot(n), weights.dot(t), weights.dot(n * n),
+                      weights.dot(n * t)])
+        self._count += count
+        self._count_in_block = count
+        intercept, slope = self._line()
+        return self._origin + intercept + slope * n
+
+    def __call__(self, block):
+        """Stage of a SampleBlocker, returns the block with the fitted timestamps."""
+        return block.replace(timestamps=self.timestamps(block.timestamps, block.gap))
+
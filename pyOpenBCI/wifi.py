@@ -16,11 +16,13 @@ import asyncore
 import atexit
 import json
 import logging
+import math
 import re
 import socket
 import timeit
 import time
 import struct
+from threading import Event, Lock, Thread, Timer, current_thread
 
 try:
     import urllib2
@@ -29,11 +31,28 @@ except ImportError:
 
 import requests
 import xmltodict
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.util.retry import Retry
+except ImportError:
+    from requests.packages.urllib3.util.retry import Retry
 
 from pyOpenBCI.utils import ssdp
+from pyOpenBCI.utils.aio import BlockStream
+from pyOpenBCI.utils.cache import cache_delete, cache_get, cache_set
+from pyOpenBCI.utils.config import BoardConfig, batch_commands
+from pyOpenBCI.utils.impedance import ImpedanceEstimator, ImpedanceTap, lead_off_commands
+from pyOpenBCI.utils.metrics import StreamStats
+from pyOpenBCI.utils.profiling import clock_ns
+from pyOpenBCI.utils.stream import SampleBlocker
 
 SAMPLE_RATE = 0  # Hz
 
+# The shield forwards commands to the board over SPI, one 32 byte frame at a time
+MAX_COMMAND_LENGTH = 31
+# sample rate of the Cyton when streaming through the WiFi Shield, unless set
+DEFAULT_WIFI_SAMPLE_RATE = 1000
+
 '''
 #Commands for in SDK
 command_stop = "s";
@@ -56,18 +75,39 @@ class OpenBCIWiFi(object):
       timeout: in seconds, disconnect / reconnect after a period without new data
         should be high if impedance check
       max_packets_to_skip: will try to disconnect / reconnect after too many packets are skipped
+      http_timeout: (connect, read) timeouts in seconds for the HTTP control requests
+      http_retries: how many times a failed HTTP control request is retried, with backoff
+      http_backoff: backoff factor in seconds between HTTP retries
+      watchdog_interval: in seconds, how often the streaming watchdog checks the connection,
+        the reconnections are done by the thread running the network loop
+      min_bytes_per_sec: reconnect when the data rate falls below this value while streaming,
+        "None" to derive it from the sample rate (half the expected rate)
+      latency: in micro seconds, how long the shield buffers packets before sending them over
+        TCP, "auto" to tune it while streaming from the observed jitter, chunk sizes and loss
+      latency_bounds: (min, max) latency in micro seconds allowed in "auto" mode
+      target_delay: in seconds, end-to-end delay aimed at in "auto" mode
+      local_wifi_server: a WiFiShieldServer shared with other shields, "None" to open a new one
     """
 
     def __init__(self, ip_address=None, shield_name=None, sample_rate=None, log=True, timeout=3,
                  max_packets_to_skip=20, latency=10000, high_speed=True, ssdp_attempts=5,
-                 num_channels=8, local_ip_address=None):
+                 num_channels=8, local_ip_address=None, http_timeout=(1.0, 3.0), http_retries=3,
+                 http_backoff=0.05, watchdog_interval=1.0, min_bytes_per_sec=None,
+                 latency_bounds=(2000, 50000), target_delay=0.05, local_wifi_server=None):
         # these one are used
+        self.config = None
         self.daisy = False
         self.gains = None
         self.high_speed = high_speed
         self.impedance = False
+        self._impedance_channels = None
         self.ip_address = ip_address
+        self.latency_tuner = None
+        if latency == 'auto':
+            self.latency_tuner = LatencyTuner(latency_bounds[0], latency_bounds[1], target_delay)
+            latency = self.latency_tuner.latency
         self.latency = latency
+        self._tuner_snapshot = None
         self.log = log  # print_incoming_text needs log
         self.max_packets_to_skip = max_packets_to_skip
         self.num_channels = num_channels
@@ -76,6 +116,12 @@ class OpenBCIWiFi(object):
         self.ssdp_attempts = ssdp_attempts
         self.streaming = False
         self.timeout = timeout
+        self.http_timeout = http_timeout
+        self.watchdog_interval = watchdog_interval
+        self.min_bytes_per_sec = min_bytes_per_sec
+
+        # one keep-alive session per shield, reused by every control request
+        self._session = self._make_session(http_retries, http_backoff)
 
         # might be handy to know API
         self.board_type = "none"
@@ -85,16 +131,34 @@ class OpenBCIWiFi(object):
         self.log_packet_count = 0
         self.packets_dropped = 0
         self.time_last_packet = 0
+        self.reconnects = 0
+        self.time_last_data = 0
+
+        self._watchdog = None
+        # the watchdog and other threads only ask for reconnections, the network loop does them
+        self._watchdog_thread = None
+        self._reconnect_requested = Event()
+        self._reconnect_wakeup = None
+        # thread running loop or stream, None if the application runs the network loop itself
+        self._stream_thread = None
+        self._watchdog_handler = None
+        self._watchdog_bytes = 0
+        self._watchdog_gaps = 0
+        self._watchdog_time = 0
 
         if self.log:
             print("Welcome to OpenBCI Native WiFi Shield Driver - Please contribute code!")
 
         self.local_ip_address = local_ip_address
-        if not self.local_ip_address:
-            self.local_ip_address = self._get_local_ip_address()
-
-        # Intentionally bind to port 0
-        self.local_wifi_server = WiFiShieldServer(self.local_ip_address, 0)
+        if local_wifi_server is not None:
+            self.local_wifi_server = local_wifi_server
+            if not self.local_ip_address:
+                self.local_ip_address = local_wifi_server.socket.getsockname()[0]
+        else:
+            if not self.local_ip_address:
+                self.local_ip_address = self._get_local_ip_address()
+            # Intentionally bind to port 0
+            self.local_wifi_server = WiFiShieldServer(self.local_ip_address, 0)
         self.local_wifi_server_port = self.local_wifi_server.socket.getsockname()[1]
         if self.log:
             print("Opened socket on %s:%d" %
@@ -103,7 +167,8 @@ class OpenBCIWiFi(object):
         if ip_address is None:
             for i in range(ssdp_attempts):
                 try:
-                    self.find_wifi_shield(wifi_shield_cb=self.on_shield_found)
+                    self.find_wifi_shield(shield_name=self.shield_name,
+                                          wifi_shield_cb=self.on_shield_found)
                     break
                 except OSError:
                     # Try again
@@ -115,11 +180,17 @@ class OpenBCIWiFi(object):
     def on_shield_found(self, ip_address):
         self.ip_address = ip_address
         self.connect()
+        if self.sample_rate is not None:
+            self.set_sample_rate(self.sample_rate)
         # Disconnects from board when terminated
         atexit.register(self.disconnect)
 
     def loop(self):
-        asyncore.loop()
+        self._stream_thread = current_thread()
+        try:
+            asyncore.loop()
+        finally:
+            self._stream_thread = None
 
     def _get_local_ip_address(self):
         """
@@ -132,13 +203,92 @@ class OpenBCIWiFi(object):
         s.close()
         return local_ip_address
 
+    def _make_session(self, retries, backoff):
+        """
+        Creates the pooled HTTP session used for the control plane of the shield.
+        Connection errors are retried for every request, read errors only for GET. Once the
+        retries of a 5xx status are exhausted the last response is returned, for the status
+        code checks of the callers.
+        """
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        return session
+
+    def _get(self, path):
+        """ GET an endpoint of the shield over the keep-alive session """
+        return self._session.get("http://%s/%s" % (self.ip_address, path),
+                                 timeout=self.http_timeout)
+
+    def _post(self, path, payload):
+        """ POST a JSON payload to an endpoint of the shield over the keep-alive session """
+        return self._session.post("http://%s/%s" % (self.ip_address, path), json=payload,
+                                  timeout=self.http_timeout)
+
     def getBoardType(self):
         """ Returns the version of the board """
         return self.board_type
 
-    def setImpedance(self, flag):
-        """ Enable/disable impedance measure """
-        self.impedance = bool(flag)
+    def setImpedance(self, flag, channels=None):
+        """
+        Enable/disable impedance measure. The Cyton drives the lead-off current through the
+        electrodes of `channels` (all if "None"), while streaming the samples then carry the
+        impedance of every channel in Ohms in imp_data. The Ganglion measures all its channels.
+        """
+        flag = bool(flag)
+        if self.board_type in ('cyton', 'daisy'):
+            if channels is None:
+                channels = self._impedance_channels or range(1, self.config.num_channels + 1)
+            self._impedance_channels = list(channels)
+            self.write_commands(lead_off_commands(self._impedance_channels, enabled=flag))
+        elif self.board_type == 'ganglion' and flag:
+            # stop sends 'Z' to end the measure
+            self.write_command('z')
+        self.impedance = flag
+
+    def measure_impedance(self, channels=None, seconds=2.0):
+        """
+        Measures the impedance of the electrodes of `channels` (1 based, all if "None") of a
+        Cyton from their response to the lead-off current, over `seconds` of data.
+        Runs the network loop itself, do not call while streaming.
+        :return: dict {channel: Ohms}
+        """
+        if self.board_type not in ('cyton', 'daisy'):
+            raise ValueError("Impedance measure through the WiFi Shield needs a Cyton")
+        if self.streaming:
+            self.stop()
+        if not self.sample_rate:
+            self.set_sample_rate(DEFAULT_WIFI_SAMPLE_RATE)
+        if channels is None:
+            channels = range(1, self.config.num_channels + 1)
+        channels = list(channels)
+        # the parser outputs Volts
+        estimator = ImpedanceEstimator(self.sample_rate, volts_per_unit=1.)
+        needed = int(seconds * self.sample_rate)
+        measured = Event()
+
+        def check_measured(block):
+            if estimator.count >= needed:
+                measured.set()
+
+        self.setImpedance(True, channels)
+        self.local_wifi_server.set_callback(
+            SampleBlocker(check_measured, block_size=max(1, self.sample_rate // 10),
+                          stages=[estimator]),
+            ip_address=self.ip_address)
+        end = time.time() + seconds + self.timeout
+        try:
+            self.init_streaming()
+            while not measured.is_set() and time.time() < end:
+                asyncore.loop(timeout=0.05, count=1)
+        finally:
+            self.stop()
+        impedances = estimator.impedances()
+        return dict((channel, float(impedances[channel - 1]) if impedances is not None else None)
+                    for channel in channels)
 
     def connect(self):
         """ Connect to the board and configure it. Note: recreates various objects upon call. """
@@ -153,7 +303,7 @@ class OpenBCIWiFi(object):
         https://app.swaggerhub.com/apis/pushtheworld/openbci-wifi-server/1.3.0
         """
 
-        res_board = requests.get("http://%s/board" % self.ip_address)
+        res_board = self._get("board")
 
         if res_board.status_code == 200:
             board_info = res_board.json()
@@ -167,33 +317,33 @@ class OpenBCIWiFi(object):
                 print("Connected to %s with %s channels" %
                       (self.board_type, self.eeg_channels_per_sample))
 
-        self.gains = None
-        if self.board_type == 'cyton':
-            self.gains = [24, 24, 24, 24, 24, 24, 24, 24]
-            self.daisy = False
-        elif self.board_type == 'daisy':
-            self.gains = [24, 24, 24, 24, 24, 24, 24,
-                          24, 24, 24, 24, 24, 24, 24, 24, 24]
-            self.daisy = True
-        elif self.board_type == 'ganglion':
-            self.gains = [51, 51, 51, 51]
-            self.daisy = False
-        self.local_wifi_server.set_daisy(daisy=self.daisy)
+        if self.board_type in ('cyton', 'daisy', 'ganglion'):
+            # keep the configuration given to the board across reconnects
+            if self.config is None or self.config.board_type != self.board_type:
+                self.config = BoardConfig(self.board_type)
+                # the shield picks the sample rate of the board, unknown until it is set
+                self.config.sample_rate = None
+            self.gains = self.config.gains
+        else:
+            self.config = None
+            self.gains = None
+        self.daisy = self.board_type == 'daisy'
+        self.local_wifi_server.register_shield(self.ip_address, name=self.shield_name)
+        self.local_wifi_server.set_daisy(daisy=self.daisy, ip_address=self.ip_address)
         self.local_wifi_server.set_parser(
-            ParseRaw(gains=self.gains, board_type=self.board_type))
+            ParseRaw(gains=self.gains, board_type=self.board_type), ip_address=self.ip_address)
 
         if self.high_speed:
             output_style = 'raw'
         else:
             output_style = 'json'
-        res_tcp_post = requests.post("http://%s/tcp" % self.ip_address,
-                                     json={
-                                         'ip': self.local_ip_address,
-                                         'port': self.local_wifi_server_port,
-                                         'output': output_style,
-                                         'delimiter': True,
-                                         'latency': self.latency
-                                     })
+        res_tcp_post = self._post("tcp", {
+            'ip': self.local_ip_address,
+            'port': self.local_wifi_server_port,
+            'output': output_style,
+            'delimiter': True,
+            'latency': self.latency
+        })
         if res_tcp_post.status_code == 200:
             tcp_status = res_tcp_post.json()
             if tcp_status['connected']:
@@ -205,8 +355,7 @@ class OpenBCIWiFi(object):
 
     def init_streaming(self):
         """ Tell the board to record like crazy. """
-        res_stream_start = requests.get(
-            "http://%s/stream/start" % self.ip_address)
+        res_stream_start = self._get("stream/start")
         if res_stream_start.status_code == 200:
             self.streaming = True
             self.packets_dropped = 0
@@ -217,7 +366,25 @@ class OpenBCIWiFi(object):
                                    % res_stream_start.status_code)
 
     def find_wifi_shield(self, shield_name=None, wifi_shield_cb=None):
-        """Detects Ganglion board MAC address if more than 1, will select first. Needs root."""
+        """
+        Finds the IP address of the WiFi Shield named `shield_name`, or of the first WiFi Shield
+        found if None, and calls `wifi_shield_cb` with it.
+        Shields found are cached by name for the max-age they announce, a cached shield is
+        connected to right away without scanning.
+        """
+        if shield_name is not None:
+            cached_ip_address = cache_get('wifi', shield_name)
+            if cached_ip_address is not None:
+                try:
+                    if wifi_shield_cb is not None:
+                        wifi_shield_cb(cached_ip_address)
+                    return cached_ip_address
+                except (requests.RequestException, RuntimeError, RuntimeWarning) as e:
+                    # stale entry, the shield moved or is off
+                    cache_delete('wifi', shield_name)
+                    if self.log:
+                        print("WiFi Shield %s is not at %s anymore: %s" %
+                              (shield_name, cached_ip_address, e))
 
         if self.log:
             print("Try to find WiFi shields on your local wireless network")
@@ -225,43 +392,64 @@ class OpenBCIWiFi(object):
 
         list_ip = []
         list_id = []
-        found_shield = False
+        lock = Lock()
+        found = Event()
+        fetches = []
 
-        def wifi_shield_found(response):
-            res = requests.get(response.location, verify=False).text
-            device_description = xmltodict.parse(res)
-            cur_shield_name = str(
-                device_description['root']['device']['serialNumber'])
-            cur_base_url = str(device_description['root']['URLBase'])
-            cur_ip_address = re.findall(r'[0-9]+(?:\.[0-9]+){3}', cur_base_url)[0]
-            list_id.append(cur_shield_name)
-            list_ip.append(cur_ip_address)
-            found_shield = True
-            if shield_name is None:
+        def fetch_description(response):
+            try:
+                res = requests.get(response.location, verify=False,
+                                   timeout=self.http_timeout).text
+                device_description = xmltodict.parse(res)
+                cur_shield_name = str(
+                    device_description['root']['device']['serialNumber'])
+                cur_base_url = str(device_description['root']['URLBase'])
+                cur_ip_address = re.findall(r'[0-9]+(?:\.[0-9]+){3}', cur_base_url)[0]
+            except Exception:
+                # not a WiFi Shield
+                return
+            if response.max_age > 0:
+                cache_set('wifi', cur_shield_name, cur_ip_address, ttl=response.max_age)
+            with lock:
+                list_id.append(cur_shield_name)
+                list_ip.append(cur_ip_address)
+            if self.log:
                 print("Found WiFi Shield %s with IP Address %s" %
                       (cur_shield_name, cur_ip_address))
-                if wifi_shield_cb is not None:
-                    wifi_shield_cb(cur_ip_address)
-            else:
-                if shield_name == cur_shield_name:
-                    if wifi_shield_cb is not None:
-                        wifi_shield_cb(cur_ip_address)
+            if shield_name is None or shield_name == cur_shield_name:
+                found.set()
 
-        ssdp_hits = ssdp.discover("urn:schemas-upnp-org:device:Basic:1", timeout=self.timeout,
-                                  wifi_found_cb=wifi_shield_found)
-
-        nb_wifi_shields = len(list_id)
-
-        if nb_wifi_shields < 1:
+        def wifi_shield_found(response):
+            # fetch device descriptions without holding up the SSDP responses
+            fetch = Thread(target=fetch_description, args=(response,))
+            fetch.daemon = True
+            fetch.start()
+            fetches.append(fetch)
+
+        ssdp.discover("urn:schemas-upnp-org:device:Basic:1", timeout=self.timeout,
+                      wifi_found_cb=wifi_shield_found, stop=found)
+        if not found.is_set():
+            for fetch in fetches:
+                fetch.join(sum(self.http_timeout))
+
+        with lock:
+            candidates = [(name, ip) for name, ip in zip(list_id, list_ip)
+                          if shield_name is None or name == shield_name]
+        if not candidates:
             print("No WiFi Shields found ;(")
             raise OSError('Cannot find OpenBCI WiFi Shield with local name')
 
-        if nb_wifi_shields > 1:
+        cur_shield_name, cur_ip_address = candidates[0]
+        if len(list_id) > 1 and shield_name is None:
             print(
-                "Found " + str(nb_wifi_shields) +
-                ", selecting first named: " + list_id[0] +
-                " with IPV4: " + list_ip[0])
-            return list_ip[0]
+                "Found " + str(len(list_id)) +
+                ", selecting first named: " + cur_shield_name +
+                " with IPV4: " + cur_ip_address)
+        if self.shield_name is None:
+            self.shield_name = cur_shield_name
+        if wifi_shield_cb is not None:
+            wifi_shield_cb(cur_ip_address)
+        return cur_ip_address
 
     def write_command(self, output):
         """
@@ -269,9 +457,12 @@ class OpenBCIWiFi(object):
         :param output:
         :return:
         """
-        res_command_post = requests.post("http://%s/command" % self.ip_address,
-                                         json={'command': output})
+        res_command_post = self._post("command", {'command': output})
         if res_command_post.status_code == 200:
+            if self.config is not None:
+                # follow the settings changed by raw commands too
+                self.config.update_from_commands(output)
+                self._update_gains()
             ret_val = res_command_post.text
             if self.log:
                 print(ret_val)
@@ -283,6 +474,48 @@ class OpenBCIWiFi(object):
             raise RuntimeError("Error code: %d %s" % (
                 res_command_post.status_code, res_command_post.text))
 
+    def write_commands(self, commands):
+        """
+        Pass through a batch of commands in as few HTTP requests as possible.
+        Commands are concatenated up to MAX_COMMAND_LENGTH characters per request, a single
+        command is never split across two requests.
+        :param commands: list of command strings
+        :return: list of the responses of the shield
+        """
+        return [self.write_command(batch)
+                for batch in batch_commands(commands, MAX_COMMAND_LENGTH)]
+
+    def apply_config(self, config):
+        """
+        Configure the board as described by `config`, sending only the commands needed to go
+        from the current configuration to this one, batched in as few requests as possible.
+        The scale factors of the parser follow the new gains.
+        :param config: BoardConfig
+        """
+        if self.config is None:
+            raise ValueError("Board type %s cannot be configured" % self.board_type)
+        commands = self.config.commands_to(config)
+        if commands:
+            self.write_commands(commands)
+        self.config = config.copy()
+        if config.sample_rate is not None:
+            self.sample_rate = config.sample_rate
+        self._update_gains()
+
+    def replay_configuration(self):
+        """ Send again every setting that differs from the power up configuration of the board """
+        if self.config is not None:
+            commands = BoardConfig(self.board_type).commands_to(self.config)
+            if commands:
+                self.write_commands(commands)
+
+    def _update_gains(self):
+        """ Make sure the gains used for scaling match the gains set on the board """
+        gains = self.config.gains
+        if gains != self.gains:
+            self.gains = gains
+            self.local_wifi_server.set_gains(gains=self.gains, ip_address=self.ip_address)
+
     def getSampleRate(self):
         return self.sample_rate
 
@@ -298,184 +531,88 @@ class OpenBCIWiFi(object):
           callback: A callback function, or a list of functions, that will receive a single
             argument of the OpenBCISample object captured.
         """
-        start_time = timeit.default_timer()
-
         # Enclose callback function in a list if it comes alone
-        if not isinstance(callback, list):
-            self.local_wifi_server.set_callback(callback)
-        else:
-            self.local_wifi_server.set_callback(callback[0])
+        if isinstance(callback, list):
+            callback = callback[0]
+        if self.impedance and self.board_type in ('cyton', 'daisy'):
+            if self.sample_rate:
+                callback = ImpedanceTap(callback,
+                                        ImpedanceEstimator(self.sample_rate, volts_per_unit=1.),
+                                        block_size=max(1, self.sample_rate // 10))
+            else:
+                self.warn("Set the sample rate to get impedances in the samples")
+        self.local_wifi_server.set_callback(callback, ip_address=self.ip_address)
 
         if not self.streaming:
             self.init_streaming()
 
-        # while self.streaming:
-        #     # should the board get disconnected and we could not wait for notification anymore
-        #     #  a reco should be attempted through timeout mechanism
-        #     try:
-        #         # at most we will get one sample per packet
-        #         self.waitForNotifications(1. / self.getSampleRate())
-        #     except Exception as e:
-        #         print("Something went wrong while waiting for a new sample: " + str(e))
-        #     # retrieve current samples on the stack
-        #     samples = self.delegate.getSamples()
-        #     self.packets_dropped = self.delegate.getMaxPacketsDropped()
-        #     if samples:
-        #         self.time_last_packet = timeit.default_timer()
-        #         for call in callback:
-        #             for sample in samples:
-        #                 call(sample)
-        #
-        #     if (lapse > 0 and timeit.default_timer() - start_time > lapse):
-        #         self.stop();
-        #     if self.log:
-        #         self.log_packet_count = self.log_packet_count + 1;
-        #
-        #     # Checking connection -- timeout and packets dropped
-        #     self.check_connection()
+        self.start_watchdog()
+
+    def stream(self, block_size=50, stages=None, disconnect=True, max_queue=100):
+        """Returns the blocks of samples as an asynchronous iterator, for asyncio applications:
+        async for block in shield.stream(block_size=50). The network loop runs on a thread of
+        its own, do not run asyncore.loop() meanwhile. Closing the stream stops the board and,
+        if `disconnect`, disconnects from the shield."""
+        stopped = Event()
+
+        def run(callback):
+            self._stream_thread = current_thread()
+            try:
+                self.start_stream(callback)
+                while not stopped.is_set():
+                    asyncore.loop(timeout=0.05, count=1)
+            finally:
+                self._stream_thread = None
+
+        def stop():
+            stopped.set()
+            self.stop()
+
+        return BlockStream(run, stop, release=self.disconnect if disconnect else None,
+                           block_size=block_size, stages=stages, max_queue=max_queue)
 
     def test_signal(self, signal):
         """ Enable / disable test signal """
         if signal == 0:
             self.warn("Disabling synthetic square wave")
-            try:
-                self.write_command(']')
-            except Exception as e:
-                print("Something went wrong while setting signal: " + str(e))
         elif signal == 1:
             self.warn("Enabling synthetic square wave")
-            try:
-                self.write_command('[')
-            except Exception as e:
-                print("Something went wrong while setting signal: " + str(e))
         else:
             self.warn("%s is not a known test signal. Valid signal is 0-1" % signal)
+            return
+        try:
+            desired = self.config.copy()
+            desired.test_signal = signal == 1
+            self.apply_config(desired)
+        except Exception as e:
+            print("Something went wrong while setting signal: " + str(e))
 
     def set_channel(self, channel, toggle_position):
         """ Enable / disable channels """
         try:
             if channel > self.num_channels:
                 raise ValueError('Cannot set non-existant channel')
-            # Commands to set toggle to on position
-            if toggle_position == 1:
-                if channel is 1:
-                    self.write_command('!')
-                if channel is 2:
-                    self.write_command('@')
-                if channel is 3:
-                    self.write_command('#')
-                if channel is 4:
-                    self.write_command('$')
-                if channel is 5:
-                    self.write_command('%')
-                if channel is 6:
-                    self.write_command('^')
-                if channel is 7:
-                    self.write_command('&')
-                if channel is 8:
-                    self.write_command('*')
-                if channel is 9:
-                    self.write_command('Q')
-                if channel is 10:
-                    self.write_command('W')
-                if channel is 11:
-                    self.write_command('E')
-                if channel is 12:
-                    self.write_command('R')
-                if channel is 13:
-                    self.write_command('T')
-                if channel is 14:
-                    self.write_command('Y')
-                if channel is 15:
-                    self.write_command('U')
-                if channel is 16:
-                    self.write_command('I')
-            # Commands to set toggle to off position
-            elif toggle_position == 0:
-                if channel is 1:
-                    self.write_command('1')
-                if channel is 2:
-                    self.write_command('2')
-                if channel is 3:
-                    self.write_command('3')
-                if channel is 4:
-                    self.write_command('4')
-                if channel is 5:
-                    self.write_command('5')
-                if channel is 6:
-                    self.write_command('6')
-                if channel is 7:
-                    self.write_command('7')
-                if channel is 8:
-                    self.write_command('8')
-                if channel is 9:
-                    self.write_command('q')
-                if channel is 10:
-                    self.write_command('w')
-                if channel is 11:
-                    self.write_command('e')
-                if channel is 12:
-                    self.write_command('r')
-                if channel is 13:
-                    self.write_command('t')
-                if channel is 14:
-                    self.write_command('y')
-                if channel is 15:
-                    self.write_command('u')
-                if channel is 16:
-                    self.write_command('i')
+            if toggle_position not in (0, 1):
+                return
+            desired = self.config.copy()
+            desired.set_channel(channel, enabled=toggle_position == 1)
+            self.apply_config(desired)
         except Exception as e:
             print("Something went wrong while setting channels: " + str(e))
 
     # See Cyton SDK for options
     def set_channel_settings(self, channel, enabled=True, gain=24, input_type=0,
-                             include_bias=True, use_srb2=True, use_srb1=True):
+                             include_bias=True, use_srb2=True, use_srb1=False):
         try:
             if channel > self.num_channels:
                 raise ValueError('Cannot set non-existant channel')
             if self.board_type == 'ganglion':
                 raise ValueError('Cannot use with Ganglion')
-            ch_array = list("12345678QWERTYUI")
-            # defaults
-            command = list("x1060110X")
-            # Set channel
-            command[1] = ch_array[channel - 1]
-            # Set power down if needed (default channel enabled)
-            if not enabled:
-                command[2] = '1'
-            # Set gain (default 24)
-            if gain == 1:
-                command[3] = '0'
-            if gain == 2:
-                command[3] = '1'
-            if gain == 4:
-                command[3] = '2'
-            if gain == 6:
-                command[3] = '3'
-            if gain == 8:
-                command[3] = '4'
-            if gain == 12:
-                command[3] = '5'
-
-            # TODO: Implement input type (default normal)
-
-            # Set bias inclusion (default include)
-            if not include_bias:
-                command[5] = '0'
-            # Set srb2 use (default use)
-            if not use_srb2:
-                command[6] = '0'
-            # Set srb1 use (default don't use)
-            if use_srb1:
-                command[6] = '1'
-            command_send = ''.join(command)
-            self.write_command(command_send)
-
-            # Make sure to update gain in wifi
-            self.gains[channel - 1] = gain
-            self.local_wifi_server.set_gains(gains=self.gains)
-            self.local_wifi_server.set_parser(
-                ParseRaw(gains=self.gains, board_type=self.board_type))
+            desired = self.config.copy()
+            desired.set_channel(channel, enabled=enabled, gain=gain, input_type=input_type,
+                                bias=include_bias, srb2=use_srb2, srb1=use_srb1)
+            # Makes sure to update gain in wifi
+            self.apply_config(desired)
 
         except ValueError as e:
             print("Something went wrong while setting channel settings: " + str(e))
@@ -483,44 +620,14 @@ class OpenBCIWiFi(object):
     def set_sample_rate(self, sample_rate):
         """ Change sample rate """
         try:
-            if self.board_type == 'cyton' or self.board_type == 'daisy':
-                if sample_rate == 250:
-                    self.write_command('~6')
-                elif sample_rate == 500:
-                    self.write_command('~5')
-                elif sample_rate == 1000:
-                    self.write_command('~4')
-                elif sample_rate == 2000:
-                    self.write_command('~3')
-                elif sample_rate == 4000:
-                    self.write_command('~2')
-                elif sample_rate == 8000:
-                    self.write_command('~1')
-                elif sample_rate == 16000:
-                    self.write_command('~0')
-                else:
-                    print("Sample rate not supported: " + str(sample_rate))
-            elif self.board_type == 'ganglion':
-                if sample_rate == 200:
-                    self.write_command('~7')
-                elif sample_rate == 400:
-                    self.write_command('~6')
-                elif sample_rate == 800:
-                    self.write_command('~5')
-                elif sample_rate == 1600:
-                    self.write_command('~4')
-                elif sample_rate == 3200:
-                    self.write_command('~3')
-                elif sample_rate == 6400:
-                    self.write_command('~2')
-                elif sample_rate == 12800:
-                    self.write_command('~1')
-                elif sample_rate == 25600:
-                    self.write_command('~0')
-                else:
-                    print("Sample rate not supported: " + str(sample_rate))
-            else:
+            if self.config is None:
                 print("Board type not supported for setting sample rate")
+                return
+            desired = self.config.copy()
+            desired.set_sample_rate(sample_rate)
+            self.apply_config(desired)
+        except ValueError as e:
+            print(str(e))
         except Exception as e:
             print("Something went wrong while setting sample rate: " + str(e))
 
@@ -528,12 +635,11 @@ class OpenBCIWiFi(object):
         """ Enable / disable accelerometer """
         try:
             if self.board_type == 'ganglion':
-                # Commands to set toggle to on position
-                if toggle_position == 1:
-                    self.write_command('n')
-                # Commands to set toggle to off position
-                elif toggle_position == 0:
-                    self.write_command('N')
+                if toggle_position not in (0, 1):
+                    return
+                desired = self.config.copy()
+                desired.aux_mode = 'accel' if toggle_position == 1 else None
+                self.apply_config(desired)
             else:
                 print("Board type not supported for setting accelerometer")
         except Exception as e:
@@ -550,7 +656,12 @@ class OpenBCIWiFi(object):
         try:
             if self.impedance:
                 print("Stopping with impedance testing")
-                self.write_command('Z')
+                if self.board_type == 'ganglion':
+                    self.write_command('Z')
+                else:
+                    self.setImpedance(False)
+                    self.write_command('s')
+                self.impedance = False
             else:
                 self.write_command('s')
         except Exception as e:
@@ -578,36 +689,277 @@ class OpenBCIWiFi(object):
             logging.warning(text)
         print("Warning: %s" % text)
 
+    def start_watchdog(self):
+        """ Start checking the connection every `watchdog_interval` seconds while streaming """
+        if self._watchdog is not None or self.watchdog_interval <= 0:
+            return
+        if self._reconnect_wakeup is None:
+            self._reconnect_wakeup = LoopWakeup(self._reconnect_if_requested)
+        self._watch_handler(self.local_wifi_server.get_handler(self.ip_address))
+        self._schedule_watchdog()
+
+    def _watch_handler(self, handler):
+        """ Take the counters of the current connection as the watchdog baseline """
+        self._watchdog_handler = handler
+        self._watchdog_bytes = handler.bytes_received if handler is not None else 0
+        self._watchdog_gaps = handler.samples_missed if handler is not None else 0
+        self._watchdog_time = timeit.default_timer()
+
+    def stop_watchdog(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _schedule_watchdog(self):
+        self._watchdog = self._watchdog_thread = Timer(self.watchdog_interval,
+                                                       self._watchdog_tick)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _watchdog_tick(self):
+        if not self.streaming:
+            self._watchdog = None
+            return
+        try:
+            self.check_connection()
+            if self.latency_tuner is not None:
+                self._tune_latency()
+        except Exception as e:
+            self.warn("Watchdog failed to check the connection: " + str(e))
+        if self.streaming:
+            self._schedule_watchdog()
+        else:
+            self._watchdog = None
+
+    def _tune_latency(self):
+        """ Give the tuner the stream observed since the last tick, apply the latency it picks """
+        handler = self.local_wifi_server.get_handler(self.ip_address)
+        if handler is None:
+            return
+        counters = (handler.reads, handler.read_interval_sum, handler.read_interval_sq_sum,
+                    handler.bytes_received, handler.samples_missed)
+        snapshot = self._tuner_snapshot
+        self._tuner_snapshot = (handler, counters)
+        if snapshot is None or snapshot[0] is not handler:
+            return
+        deltas = [now - before for now, before in zip(counters, snapshot[1])]
+        latency = self.latency_tuner.update(deltas[0], deltas[1], deltas[2], deltas[3] // 33,
+                                            deltas[4])
+        if latency != self.latency:
+            self.set_latency(latency)
+
+    def set_latency(self, latency):
+        """ Set how long, in micro seconds, the shield buffers packets before a TCP write """
+        res_latency = self._post("latency", {'latency': int(latency)})
+        if res_latency.status_code == 200:
+            self.latency = int(latency)
+            if self.latency_tuner is not None:
+                self.latency_tuner.latency = self.latency
+        else:
+            if self.latency_tuner is not None:
+                self.latency_tuner.latency = self.latency
+            self.warn("Unable to set latency, status code %d on /latency" %
+                      res_latency.status_code)
+
+    def set_profiler(self, profiler):
+        """ Records the spans of the stages of the acquisition (read, decode, daisy, callback)
+        into a Profiler, None to stop profiling """
+        self.local_wifi_server.set_profiler(profiler, ip_address=self.ip_address)
+
+    def stats(self):
+        """ Returns a snapshot of the counters of the stream of the shield (see StreamStats),
+        kept across its connections, the queue depth being the bytes of a partial packet """
+        handler = self.local_wifi_server.get_handler(self.ip_address)
+        queue_depth = len(handler._buffer) if handler is not None else 0
+        return self.local_wifi_server.get_device(self.ip_address).metrics.snapshot(
+            queue_depth=queue_depth)
+
+    def latency_stats(self):
+        """ Returns the latency in use and, in "auto" mode, the statistics it was chosen from """
+        stats = {'latency': self.latency}
+        if self.latency_tuner is not None:
+            stats.update(self.latency_tuner.stats)
+        return stats
+
+    def _expected_bytes_per_sec(self):
+        if self.min_bytes_per_sec is not None:
+            return self.min_bytes_per_sec
+        if not self.sample_rate:
+            return 0
+        # 33 bytes per packet, daisy boards interleave two packets per sample
+        packets_per_sec = self.sample_rate * (2 if self.daisy else 1)
+        return packets_per_sec * 33 / 2.
+
     def check_connection(self):
-        """ Check connection quality in term of lag and number of packets drop.
-        Reinit connection if necessary.
-        FIXME: parameters given to the board will be lost.
+        """ Check connection quality in term of data rate, lag and number of packets drop.
+        Reinit connection if necessary, the configuration of the board is replayed.
         """
         # stop checking when we're no longer streaming
         if not self.streaming:
             return
+        now = timeit.default_timer()
+        handler = self.local_wifi_server.get_handler(self.ip_address)
+        bytes_per_sec = None
+        if handler is not self._watchdog_handler:
+            # the shield opened a new connection, start counting again
+            self._watch_handler(handler)
+        elif handler is not None:
+            if handler.time_last_packet > self.time_last_packet:
+                self.time_last_packet = handler.time_last_packet
+            if handler.time_last_packet > self.time_last_data:
+                self.time_last_data = handler.time_last_packet
+            elapsed = now - self._watchdog_time
+            if elapsed > 0:
+                bytes_per_sec = (handler.bytes_received - self._watchdog_bytes) / elapsed
+            self.packets_dropped = handler.samples_missed - self._watchdog_gaps
+            self._watch_handler(handler)
+
         # check number of dropped packets and duration without new packets, deco/reco if too large
         if self.packets_dropped > self.max_packets_to_skip:
             self.warn("Too many packets dropped, attempt to reconnect")
             self.reconnect()
-        elif self.timeout > 0 and timeit.default_timer() - self.time_last_packet > self.timeout:
+        elif self.timeout > 0 and now - self.time_last_packet > self.timeout:
             self.warn("Too long since got new data, attempt to reconnect")
             # if error, attempt to reconect
             self.reconnect()
+        elif bytes_per_sec is not None and bytes_per_sec < self._expected_bytes_per_sec():
+            self.warn("Data rate dropped to %d bytes/s, attempt to reconnect" % bytes_per_sec)
+            self.reconnect()
 
     def reconnect(self):
         """ In case of poor connection, will shut down and relaunch everything.
-        FIXME: parameters given to the board will be lost."""
+        The cached configuration of the board is sent again before streaming resumes and
+        the data gap is reported to the callback as an invalid sample.
+        Called from the watchdog, or from another thread while loop or stream runs the network
+        loop, the reconnection is done by the network loop: the connections and the parsers of
+        the server are only changed by the thread running it."""
+        stream_thread = self._stream_thread
+        if current_thread() is self._watchdog_thread or \
+                (stream_thread is not None and stream_thread is not current_thread()):
+            self._reconnect_requested.set()
+            if self._reconnect_wakeup is None:
+                self._reconnect_wakeup = LoopWakeup(self._reconnect_if_requested)
+            self._reconnect_wakeup.wake()
+            return
+        self._reconnect_requested.clear()
         self.warn('Reconnecting')
+        self.reconnects += 1
+        self.local_wifi_server.get_device(self.ip_address).metrics.reconnects += 1
         self.stop()
         self.disconnect()
         self.connect()
+        self.replay_configuration()
+        if self.time_last_data:
+            # no gap to report if the shield never sent data
+            self.local_wifi_server.report_gap(self.time_last_data, ip_address=self.ip_address)
         self.init_streaming()
 
+    def _reconnect_if_requested(self):
+        """ Do the reconnection asked from another thread, on the thread of the network loop """
+        if self._reconnect_requested.is_set():
+            if self.streaming:
+                self.reconnect()
+            else:
+                self._reconnect_requested.clear()
+
+
+class LatencyTuner(object):
+    """
+    Picks the latency of the WiFi Shield TCP output. The shield holds packets up to `latency`
+    micro seconds before a TCP write, so the end-to-end delay is about the latency plus the
+    arrival jitter. Larger latencies mean fewer, larger writes, which survive a lossy link
+    better and cost less CPU.
+    Args:
+      min_latency: lowest latency in micro seconds that can be picked
+      max_latency: highest latency in micro seconds that can be picked
+      target_delay: end-to-end delay in seconds to aim for
+      max_loss: fraction of lost samples above which the latency is raised regardless of delay
+    """
+
+    def __init__(self, min_latency, max_latency, target_delay, max_loss=0.01):
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.target_delay = target_delay
+        self.max_loss = max_loss
+        self.latency = self._clamp(10000)
+        self.stats = {}
+
+    def _clamp(self, latency):
+        return int(min(max(latency, self.min_latency), self.max_latency))
+
+    def update(self, reads, interval_sum, interval_sq_sum, packets, missed):
+        """
+        Returns the latency to use next, given the stream observed since the last update.
+        :param reads: number of TCP chunks received
+        :param interval_sum: sum of the times between two chunks, in seconds
+        :param interval_sq_sum: sum of the squared times between two chunks
+        :param packets: number of packets received
+        :param missed: number of samples missing in the sample numbers
+        """
+        if reads < 2:
+            return self.latency
+        mean_interval = interval_sum / reads
+        jitter = math.sqrt(max(interval_sq_sum / reads - mean_interval ** 2, 0.))
+        loss = missed / float(packets + missed) if packets + missed else 0.
+        delay = self.latency / 1e6 + 2 * jitter
+
+        if loss > self.max_loss:
+            # bigger batches, less writes over the lossy link
+            latency = self.latency * 1.5
+        else:
+            # move half way to the latency that would hit the target delay
+            wanted = (self.target_delay - 2 * jitter) * 1e6
+            latency = self.latency + (wanted - self.latency) / 2.
+            if abs(latency - self.latency) < 0.1 * self.latency:
+                latency = self.latency
+
+        self.stats = {
+            'mean_interval': mean_interval,
+            'jitter': jitter,
+            'packets_per_chunk': packets / float(reads),
+            'loss': loss,
+            'estimated_delay': delay,
+            'target_delay': self.target_delay,
+        }
+        self.latency = self._clamp(latency)
+        return self.latency
+
+
+class LoopWakeup(asyncore.dispatcher):
+    """
+    Calls `function` on the thread running the asyncore loop, whichever runs it, when another
+    thread calls wake. The wake up is a byte written to a socket pair watched by the loop.
+    """
+
+    def __init__(self, function):
+        self._writer, reader = socket.socketpair()
+        self._writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader)
+        self.function = function
+
+    def wake(self):
+        try:
+            self._writer.send(b'!')
+        except socket.error:
+            # the socket is full of wake ups not handled yet
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.function()
+
+    def handle_close(self):
+        self.close()
+        self._writer.close()
+
 
 class WiFiShieldHandler(asyncore.dispatcher_with_send):
     def __init__(self, sock, callback=None, high_speed=True,
-                 parser=None, daisy=False):
+                 parser=None, daisy=False, gap_since=None, source=None, metrics=None,
+                 profiler=None):
         asyncore.dispatcher_with_send.__init__(self, sock)
 
         self.callback = callback
@@ -616,21 +968,105 @@ class WiFiShieldHandler(asyncore.dispatcher_with_send):
         self.last_odd_sample = OpenBCISample()
         self.parser = parser if parser is not None else ParseRaw(
             gains=[24, 24, 24, 24, 24, 24, 24, 24])
+        # name of the shield, given to every sample
+        self.source = source
+        # bytes of a packet split across two TCP chunks
+        self._buffer = bytearray()
+
+        # connection health, read by the OpenBCIWiFi watchdog
+        self.bytes_received = 0
+        self.samples_missed = 0
+        self.last_sample_number = None
+        self.time_last_packet = 0
+        # counters of the stream of the shield, see OpenBCIWiFi.stats
+        self.metrics = metrics if metrics is not None else StreamStats()
+        # Profiler of the stages of the acquisition, see OpenBCIWiFi.set_profiler
+        self.profiler = profiler
+        # arrival of the TCP chunks, read by the latency tuner
+        self.reads = 0
+        self.read_interval_sum = 0.
+        self.read_interval_sq_sum = 0.
+        self.time_last_read = 0
+        # time of the last data before a gap still to be reported to the callback
+        self.gap_since = gap_since
+
+    def count_missed_samples(self, sample_number):
+        """ Sample numbers wrap around at 255, any jump is a run of missed samples """
+        if self.last_sample_number is not None:
+            self.samples_missed += (sample_number - self.last_sample_number - 1) % 256
+        self.last_sample_number = sample_number
+
+    def report_gap(self):
+        """ Send the data gap of the last reconnect to the callback as an invalid sample """
+        duration = self.time_last_packet - self.gap_since
+        gap = OpenBCISample(valid=False,
+                            error='Data gap of %.3f s while reconnecting' % duration)
+        gap.gap_duration = duration
+        gap.source = self.source
+        self.gap_since = None
+        if self.callback is not None:
+            self.callback(gap)
 
     def handle_read(self):
+        profiler = self.profiler
+        if profiler is not None:
+            profile_start = clock_ns()
         # 3000 is the max data the WiFi shield is allowed to send over TCP
         data = self.recv(3000)
+        arrival = time.time()
+        if profiler is not None:
+            profiler.record('read', profile_start)
+        self.bytes_received += len(data)
+        now = timeit.default_timer()
+        if data:
+            self.metrics.read(len(data))
+        if self.time_last_read:
+            interval = now - self.time_last_read
+            self.reads += 1
+            self.read_interval_sum += interval
+            self.read_interval_sq_sum += interval * interval
+        self.time_last_read = now
         if len(data) > 2:
+            self.time_last_packet = now
+            if self.gap_since is not None:
+                self.report_gap()
+        if data:
+            # even a byte or two, they may be the end of a packet split across reads
             if self.high_speed:
-                packets = int(len(data) / 33)
+                self._buffer.extend(data)
+                # resync on the stop byte if the stream got misaligned
+                skipped = 0
+                while len(self._buffer) - skipped >= 33 and \
+                        not self.parser.is_stop_byte(self._buffer[skipped + 32]):
+                    skipped += 1
+                if skipped:
+                    self.metrics.resync_bytes += skipped
+                    self.metrics.bad_stop_bytes += 1
+                packets = int((len(self._buffer) - skipped) / 33)
                 raw_data_packets = []
                 for i in range(packets):
-                    raw_data_packets.append(
-                        bytearray(data[i * 33: i * 33 + 33]))
+                    start = skipped + i * 33
+                    raw_data_packets.append(self._buffer[start: start + 33])
+                del self._buffer[:skipped + packets * 33]
+                if profiler is not None:
+                    profile_start = clock_ns()
+                decode_start = timeit.default_timer()
                 samples = self.parser.transform_raw_data_packets_to_sample(
                     raw_data_packets=raw_data_packets)
+                callback_start = timeit.default_timer()
+                self.metrics.decode_seconds += callback_start - decode_start
+                if profiler is not None:
+                    profiler.record('decode', profile_start)
 
+                delivered = 0
                 for sample in samples:
+                    sample.source = self.source
+                    sample.arrival = arrival
+                    if sample.valid:
+                        self.count_missed_samples(sample.sample_number)
+                        # with a Daisy, a sample takes two packets
+                        self.metrics.packet_id(sample.sample_number,
+                                               samples_per_packet=0.5 if self.daisy else 1)
                     # if a daisy module is attached, wait to concatenate two samples
                     # (main board + daisy) before passing it to callback
                     if self.daisy:
@@ -642,13 +1078,30 @@ class WiFiShieldHandler(asyncore.dispatcher_with_send):
                         elif sample.sample_number - 1 == self.last_odd_sample.sample_number:
                             # the aux data will be the average between the two samples, as the
                             # channel samples themselves have been averaged by the board
+                            if profiler is not None:
+                                profile_start = clock_ns()
                             daisy_sample = self.parser.make_daisy_sample_object_wifi(
                                 self.last_odd_sample, sample)
+                            daisy_sample.source = self.source
+                            daisy_sample.arrival = arrival
+                            if profiler is not None:
+                                profiler.record('daisy', profile_start)
                             if self.callback is not None:
+                                if profiler is not None:
+                                    profile_start = clock_ns()
                                 self.callback(daisy_sample)
+                                delivered += 1
+                                if profiler is not None:
+                                    profiler.record('callback', profile_start)
                     else:
                         if self.callback is not None:
+                            if profiler is not None:
+                                profile_start = clock_ns()
                             self.callback(sample)
+                            delivered += 1
+                            if profiler is not None:
+                                profiler.record('callback', profile_start)
+                self.metrics.delivered(delivered, timeit.default_timer() - callback_start)
 
             else:
                 try:
@@ -671,7 +1124,30 @@ class WiFiShieldHandler(asyncore.dispatcher_with_send):
                     print(e)
 
 
+class WiFiShieldDevice(object):
+    """Settings of one WiFi Shield streaming to a WiFiShieldServer, kept across its connections."""
+
+    def __init__(self, name, callback=None, parser=None, daisy=False):
+        self.name = name
+        self.callback = callback
+        self.parser = parser
+        self.daisy = daisy
+        # time of the last data before a gap still to be reported to the callback
+        self.gap_since = None
+        # counters of the stream, see OpenBCIWiFi.stats
+        self.metrics = StreamStats()
+        self.profiler = None
+
+
 class WiFiShieldServer(asyncore.dispatcher):
+    """
+    Local TCP server the WiFi Shields stream to. Any number of shields can stream to the same
+    server, each connection is identified by the IP address of the shield and gets its own
+    parser, gains, daisy pairing and reassembly buffer. Samples are tagged with the name of the
+    shield they come from in `sample.source`.
+    Settings given without an IP address apply to every shield, and are the defaults of shields
+    that were not registered.
+    """
 
     def __init__(self, host, port, callback=None, gains=None, high_speed=True, daisy=False):
         asyncore.dispatcher.__init__(self)
@@ -680,36 +1156,115 @@ class WiFiShieldServer(asyncore.dispatcher):
         self.bind((host, port))
         self.daisy = daisy
         self.listen(5)
-        self.callback = None
+        self.callback = callback
+        # most recent connection, and the current connection of each shield
         self.handler = None
+        self.handlers = {}
+        self.devices = {}
         self.parser = ParseRaw(gains=gains)
         self.high_speed = high_speed
+        self.gap_since = None
+
+    def get_device(self, ip_address):
+        """ Returns the settings of the shield at `ip_address`, created from the defaults """
+        ip_address = _host(ip_address)
+        device = self.devices.get(ip_address)
+        if device is None:
+            device = WiFiShieldDevice(ip_address, callback=self.callback, daisy=self.daisy,
+                                      parser=ParseRaw(gains=self.parser.gains,
+                                                      board_type=self.parser.board_type))
+            self.devices[ip_address] = device
+        return device
+
+    def get_handler(self, ip_address=None):
+        """ Returns the current connection of the shield at `ip_address`, or the most recent one """
+        if ip_address is None:
+            return self.handler
+        return self.handlers.get(_host(ip_address))
+
+    def register_shield(self, ip_address, name=None):
+        """ Name the samples coming from the shield at `ip_address` """
+        device = self.get_device(ip_address)
+        if name is not None:
+            device.name = name
+            handler = self.get_handler(ip_address)
+            if handler is not None:
+                handler.source = name
+        return device
 
     def handle_accept(self):
         pair = self.accept()
         if pair is not None:
             sock, addr = pair
             print('Incoming connection from %s' % repr(addr))
-            self.handler = WiFiShieldHandler(sock, self.callback, high_speed=self.high_speed,
-                                             parser=self.parser, daisy=self.daisy)
+            device = self.get_device(addr[0])
+            gap_since = device.gap_since if device.gap_since is not None else self.gap_since
+            handler = WiFiShieldHandler(sock, device.callback, high_speed=self.high_speed,
+                                        parser=device.parser, daisy=device.daisy,
+                                        gap_since=gap_since, source=device.name,
+                                        metrics=device.metrics, profiler=device.profiler)
+            # the sample numbers of a new connection do not follow the previous ones
+            device.metrics.restart_ids()
+            device.gap_since = None
+            self.gap_since = None
+            self.handlers[_host(addr[0])] = handler
+            self.handler = handler
+
+    def _targets(self, ip_address):
+        """ The devices and live connections a setting applies to """
+        if ip_address is None:
+            return list(self.devices.values()), list(self.handlers.values())
+        handler = self.get_handler(ip_address)
+        return [self.get_device(ip_address)], [handler] if handler is not None else []
 
-    def set_callback(self, callback):
-        self.callback = callback
-        if self.handler is not None:
-            self.handler.callback = callback
+    def report_gap(self, since, ip_address=None):
+        """ The next connection reports the data gap from `since` to its first sample """
+        if ip_address is None:
+            if self.gap_since is None or since < self.gap_since:
+                self.gap_since = since
+            return
+        device = self.get_device(ip_address)
+        if device.gap_since is None or since < device.gap_since:
+            device.gap_since = since
 
-    def set_daisy(self, daisy):
-        self.daisy = daisy
-        if self.handler is not None:
-            self.handler.daisy = daisy
+    def set_callback(self, callback, ip_address=None):
+        if ip_address is None:
+            self.callback = callback
+        devices, handlers = self._targets(ip_address)
+        for target in devices + handlers:
+            target.callback = callback
 
-    def set_gains(self, gains):
-        self.parser.set_ads1299_scale_factors(gains)
+    def set_profiler(self, profiler, ip_address=None):
+        devices, handlers = self._targets(ip_address)
+        for target in devices + handlers:
+            target.profiler = profiler
 
-    def set_parser(self, parser):
-        self.parser = parser
-        if self.handler is not None:
-            self.handler.parser = parser
+    def set_daisy(self, daisy, ip_address=None):
+        if ip_address is None:
+            self.daisy = daisy
+        devices, handlers = self._targets(ip_address)
+        for target in devices + handlers:
+            target.daisy = daisy
+
+    def set_gains(self, gains, ip_address=None):
+        if ip_address is None:
+            self.parser.set_ads1299_scale_factors(gains)
+        devices, handlers = self._targets(ip_address)
+        # handlers share the parser of their device
+        for device in devices:
+            device.parser.set_ads1299_scale_factors(gains)
+
+    def set_parser(self, parser, ip_address=None):
+        if ip_address is None:
+            self.parser = parser
+        devices, handlers = self._targets(ip_address)
+        for target in devices + handlers:
+            target.parser = parser
+
+
+def _host(ip_address):
+    """ The host part of an `ip:port` address """
+    return ip_address.split(':')[0]
 
 
 class ParseRaw(object):
@@ -871,7 +1426,10 @@ class ParseRaw(object):
         pass
 
     def set_ads1299_scale_factors(self, gains, micro_volts=None):
+        self.gains = gains
         self.scale_factors = self.get_ads1299_scale_factors(gains, micro_volts=micro_volts)
+        self.raw_data_to_sample.gains = gains
+        self.raw_data_to_sample.scale_factors = self.scale_factors
 
     def transform_raw_data_packet_to_sample(self, raw_data):
         """
@@ -1074,5 +1632,7 @@ class OpenBCISample(object):
         self.stop_byte = stop_byte
         self.timestamp = 0
         self._timestamps = {}
+        # time.time() at which the packet was read from the socket
+        self.arrival = None
         self.valid = valid
         self.accel_data = accel_data if accel_data is not None else []
@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+import pytest
+
+from pyOpenBCI.utils.codec import decode_block, encode_block, read_block, write_block
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def assert_round_trip(data):
+    data = np.asarray(data)
+    decoded = decode_block(encode_block(data))
+    assert decoded.dtype == np.int32
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    np.testing.assert_array_equal(decoded, data)
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 3, 250])
+def test_round_trip_lengths(count):
+    rng = np.random.RandomState(count)
+    assert_round_trip(rng.randint(-2 ** 23, 2 ** 23, size=(count, 8)))
+
+
+def test_round_trip_smooth_counts():
+    t = np.arange(500) / 250.
+    data = np.round(np.outer(np.sin(2 * np.pi * 10 * t), [1000, 50000, -8e6])).astype(np.int64)
+    assert_round_trip(data + 30000)
+    # the prediction makes a smooth signal much smaller than int32
+    assert len(encode_block(data)) < data.size * 4 / 2
+
+
+def test_round_trip_full_int32_range():
+    extremes = np.array([[INT32_MIN, INT32_MAX], [INT32_MAX, INT32_MIN], [INT32_MIN, INT32_MAX],
+                         [0, -1], [INT32_MAX, INT32_MAX], [INT32_MIN, INT32_MIN]])
+    for count in range(len(extremes) + 1):
+        assert_round_trip(extremes[:count])
+    assert_round_trip(np.full((3, 1), INT32_MAX))
+    assert_round_trip(np.full((3, 1), INT32_MIN))
+
+
+def test_round_trip_constant_and_one_channel():
+    assert_round_trip(np.zeros((10, 3), dtype=np.int32))
+    assert_round_trip(np.arange(-5, 5))
+
+
+def test_float_counts_must_be_integers():
+    assert_round_trip(np.array([[1.], [2.], [-3.]]))
+    with pytest.raises(ValueError):
+        encode_block(np.array([[0.5]]))
+
+
+def test_stream_of_blocks():
+    stream = io.BytesIO()
+    blocks = [np.arange(12).reshape(4, 3), np.zeros((0, 3), dtype=np.int32),
+              np.full((1, 3), INT32_MIN)]
+    for block in blocks:
+        write_block(stream, block)
+    stream.seek(0)
+    for block in blocks:
+        np.testing.assert_array_equal(read_block(stream), block)
+    assert read_block(stream) is None
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from pyOpenBCI import OpenBCICyton
+from pyOpenBCI.utils.lsl import LSLSink, MemoryOutlet
+
+# uVolts per count of the ADS1299 at the default gain of 24
+UV_PER_COUNT = 4.5e6 / 24 / (2 ** 23 - 1)
+
+
+def stream_blocks(board, sink, count=5):
+    """Streams `count` blocks through `sink`, returns the blocks as given to it."""
+    blocks = []
+
+    def keep(block):
+        blocks.append(block)
+        if len(blocks) == count:
+            board.stop_stream()
+        return block
+
+    board.start_stream(sink.blocker(block_size=10, stages=[keep]))
+    return blocks
+
+
+@pytest.mark.parametrize('daisy, channels, rate', [(False, 8, 250.), (True, 16, 125.)])
+def test_description_from_the_board(daisy, channels, rate):
+    board = OpenBCICyton(port='sim://', daisy=daisy)
+    try:
+        sink = LSLSink(board, outlet_factory=MemoryOutlet)
+    finally:
+        board.disconnect()
+    assert sink.outlet.description['channel_count'] == channels
+    assert sink.outlet.description['nominal_srate'] == rate
+    assert [c['unit'] for c in sink.outlet.description['channels']] == ['microvolts'] * channels
+    assert sink.aux_outlet.description['channel_count'] == 3
+
+
+def test_counts_pushed_in_microvolts():
+    board = OpenBCICyton(port='sim://', scaled=False)
+    try:
+        sink = LSLSink(board, outlet_factory=MemoryOutlet)
+        blocks = stream_blocks(board, sink)
+    finally:
+        board.disconnect()
+    counts = np.concatenate([block.data for block in blocks])
+    pushed = sink.outlet.data()
+    assert pushed.shape == (50, 8)
+    assert pushed.dtype == np.float32
+    np.testing.assert_allclose(pushed, counts * UV_PER_COUNT, rtol=1e-6, atol=1e-3)
+    assert len(sink.aux_outlet.chunks) == len(blocks)
+
+
+def test_scaled_board_pushed_unchanged():
+    board = OpenBCICyton(port='sim://', scaled=True)
+    try:
+        sink = LSLSink(board, outlet_factory=MemoryOutlet)
+        blocks = stream_blocks(board, sink)
+    finally:
+        board.disconnect()
+    np.testing.assert_allclose(sink.outlet.data(),
+                               np.concatenate([block.data for block in blocks]), rtol=1e-6)
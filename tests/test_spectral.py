@@ -0,0 +1,25 @@
+import numpy as np
+
+from pyOpenBCI.utils.spectral import BandPower
+
+
+def band_powers(data, **kwargs):
+    band_power = BandPower(sample_rate=250, **kwargs)
+    band_power.process(data)
+    return band_power.powers(), band_power.band_names
+
+
+def test_dc_offset_leaves_band_powers_unchanged():
+    t = np.arange(250 * 4) / 250.
+    sine = 10 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis]
+    powers, names = band_powers(sine)
+    offset_powers, _ = band_powers(sine + 50000)
+    np.testing.assert_allclose(offset_powers, powers, rtol=1e-6, atol=1e-6)
+    assert np.argmax(powers[0]) == names.index('alpha')
+
+
+def test_without_detrend_dc_leaks_into_delta():
+    t = np.arange(250 * 4) / 250.
+    sine = 10 * np.sin(2 * np.pi * 10 * t)[:, np.newaxis]
+    powers, names = band_powers(sine + 50000, detrend=None)
+    assert np.argmax(powers[0]) == names.index('delta')